@@ -0,0 +1,429 @@
+"""
+HTTP job API for programmatic use of Context Chameleon.
+
+    POST   /v1/analyses            submit an image for analysis
+    POST   /v1/generations         submit a generation (vibes, or a campaign matrix)
+    GET    /v1/jobs/<id>           job status, items and (for analyses) the result
+    DELETE /v1/jobs/<id>           cancel a job
+    GET    /v1/jobs/<id>/events    server-sent events as items complete
+    GET    /v1/jobs/<id>/result    analysis JSON, or ?item=<label> for a generated image
+                                   (redirect to the CDN URL; &download=1 streams the file;
+                                   &variant=<n> picks a render of a multi-variant item)
+
+Run with `python api_server.py`. Work runs on the shared worker pool; the
+IOLoop only parses requests and relays events, so one process can hold
+hundreds of open jobs and event streams.
+"""
+import asyncio
+import base64
+import binascii
+import io
+import json
+from typing import Dict, Any, Optional, Tuple
+
+import tornado.web
+import tornado.httpserver
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.locks import Event
+from PIL import Image
+
+from config.settings import Settings
+from services.analysis_model import ImageAnalysis
+from services.gemini_service import GeminiService
+from services.bria_service import BriaService
+from services.campaign_planner import CampaignPlanner, CampaignSpec
+from services.image_service import ImageService
+from services.job_store import Job, get_job_store, RUNNING, SUCCEEDED, FAILED, CANCELLED
+from services.rate_limiter import PRIORITY_BATCH, PRIORITY_INTERACTIVE
+from services.worker_pool import get_worker_pool
+from utils.cancellation import CancelledError
+
+
+def _decode_image(data: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def _result_payload(result) -> Dict[str, Any]:
+    payload = {
+        "image_url": result.image_url,
+        "preview_url": result.preview_url,
+        "expires_at": result.expires_at,
+        "metadata": result.metadata,
+    }
+    if len(result.variants) > 1:
+        payload["variants"] = [
+            {"image_url": variant.image_url, "preview_url": variant.preview_url} for variant in result.variants
+        ]
+    return payload
+
+
+def run_analysis(job: Job, image: Image.Image, mode: Optional[str], priority: str):
+    """Worker-pool body of an analysis job"""
+    if job.token.cancelled:
+        job.set_status(CANCELLED, job.token.reason)
+        return
+    job.set_status(RUNNING)
+    try:
+        gemini_service = GeminiService(
+            Settings.GEMINI_API_KEY, session_id=job.client_id, priority=priority,
+            user_id=job.client_id, batch_id=job.job_id,
+        )
+        analysis = gemini_service.analyze_image(image, mode=mode, cancel_token=job.token)
+        if job.token.cancelled:
+            job.set_status(CANCELLED, job.token.reason)  # a reply that was already in flight
+        elif analysis is None:
+            job.set_status(FAILED, "analysis returned no result")
+        else:
+            # Generation jobs reuse the parsed model; clients get its JSON form
+            job.inputs["analysis"] = analysis
+            job.result = analysis.to_dict()
+            job.set_status(SUCCEEDED)
+    except CancelledError as e:
+        job.set_status(CANCELLED, str(e))
+    except Exception as e:
+        job.set_status(FAILED, str(e))
+
+
+def run_generation_item(job: Job, label: str, image: Image.Image, image_digest: str, analysis: ImageAnalysis,
+                        item: Dict[str, Any], bria_service: BriaService):
+    """Worker-pool body of one generation item; the last item to finish closes the job"""
+    try:
+        if job.token.cancelled:
+            raise CancelledError(job.token.reason or "cancelled")
+        job.set_status(RUNNING)
+        job.update_item(label, RUNNING)
+        result = bria_service.generate_image(
+            image,
+            item["vibe_name"],
+            analysis,
+            specific_config=item["specific_config"],
+            resolution=item["resolution"],
+            cancel_token=job.token.child(timeout=Settings.GENERATION_DEADLINE),
+            variants=item.get("variants", 1),
+            image_digest=image_digest,
+        )
+        if result is None:
+            job.update_item(label, FAILED, error="generation returned no image")
+        else:
+            job.inputs.setdefault("results", {})[label] = result
+            job.update_item(label, SUCCEEDED, result=_result_payload(result))
+    except CancelledError as e:
+        job.update_item(label, CANCELLED, error=str(e))
+    except Exception as e:  # includes BudgetExceeded
+        job.update_item(label, FAILED, error=str(e))
+    finally:
+        if job.pending_items() == 0:
+            statuses = {i["status"] for i in job.items.values()}
+            if job.token.cancelled:
+                job.set_status(CANCELLED, job.token.reason)
+            elif SUCCEEDED in statuses:
+                job.set_status(SUCCEEDED)
+            else:
+                job.set_status(FAILED, "no item succeeded")
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    """JSON errors and bearer-token auth; the token doubles as the client id"""
+
+    def prepare(self):
+        self.client_id = "anonymous"
+        if Settings.API_TOKENS:
+            header = self.request.headers.get("Authorization", "")
+            token = header[7:] if header.startswith("Bearer ") else ""
+            if token not in Settings.API_TOKENS:
+                raise tornado.web.HTTPError(401, reason="Missing or invalid bearer token")
+            self.client_id = token
+
+    def write_error(self, status_code: int, **kwargs):
+        self.set_header("Content-Type", "application/json")
+        self.finish({"error": self._reason, "status": status_code})
+
+    def json_body(self) -> Dict[str, Any]:
+        if not self.request.body:
+            return {}
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Body is not valid JSON")
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, reason="Body must be a JSON object")
+        return body
+
+    def upload_bytes(self, body: Dict[str, Any]) -> bytes:
+        """Image from a multipart "image" field or a base64 "image_base64" JSON field"""
+        files = self.request.files.get("image")
+        if files:
+            data = files[0]["body"]
+        elif body.get("image_base64"):
+            try:
+                data = base64.b64decode(body["image_base64"], validate=True)
+            except (binascii.Error, ValueError):
+                raise tornado.web.HTTPError(400, reason="image_base64 is not valid base64")
+        else:
+            raise tornado.web.HTTPError(400, reason="Provide an image (multipart 'image' or 'image_base64')")
+        if len(data) > Settings.API_MAX_UPLOAD_BYTES:
+            raise tornado.web.HTTPError(413, reason="Image too large")
+        return data
+
+    def priority(self, body: Dict[str, Any]) -> str:
+        priority = body.get("priority", PRIORITY_BATCH)
+        if priority not in (PRIORITY_BATCH, PRIORITY_INTERACTIVE):
+            raise tornado.web.HTTPError(400, reason=f"Unknown priority: {priority}")
+        return priority
+
+    def get_job(self, job_id: str) -> Job:
+        job = get_job_store().get(job_id, self.client_id)
+        if job is None:
+            raise tornado.web.HTTPError(404, reason="Unknown job")
+        return job
+
+    def create_job(self, kind: str) -> Job:
+        try:
+            return get_job_store().create(kind, self.client_id)
+        except RuntimeError as e:
+            raise tornado.web.HTTPError(503, reason=str(e))
+
+    def accepted(self, job: Job):
+        self.set_status(202)
+        self.finish({
+            "job_id": job.job_id,
+            "status_url": f"/v1/jobs/{job.job_id}",
+            "events_url": f"/v1/jobs/{job.job_id}/events",
+            **job.to_dict(),
+        })
+
+
+class AnalysisHandler(BaseHandler):
+    async def post(self):
+        if self.request.files:
+            body = {name: self.get_body_argument(name) for name in self.request.body_arguments}
+        else:
+            body = self.json_body()
+        image_bytes = self.upload_bytes(body)
+        mode = body.get("mode")
+        if mode is not None and mode not in Settings.ANALYSIS_MODES:
+            raise tornado.web.HTTPError(400, reason=f"Unknown analysis mode: {mode}")
+
+        # Reject undecodable uploads now rather than in the job, which reuses the decoded image
+        try:
+            image = await IOLoop.current().run_in_executor(None, _decode_image, image_bytes)
+        except Exception:
+            raise tornado.web.HTTPError(400, reason="Image could not be decoded")
+
+        job = self.create_job("analysis")
+        job.inputs["image"] = image_bytes
+        get_worker_pool().submit(run_analysis, job, image, mode, self.priority(body))
+        self.accepted(job)
+
+
+class GenerationHandler(BaseHandler):
+    async def post(self):
+        body = self.json_body()
+        image_bytes, analysis = self._inputs(body)
+        # Decoded once per job; every item renders from the same read-only image
+        try:
+            image = await IOLoop.current().run_in_executor(None, _decode_image, image_bytes)
+        except Exception:
+            raise tornado.web.HTTPError(400, reason="Image could not be decoded")
+        image_digest = await IOLoop.current().run_in_executor(None, ImageService.image_digest, image)
+        job = self.create_job("generation")
+        bria_service = BriaService(
+            Settings.BRIA_API_KEY, session_id=self.client_id, priority=self.priority(body),
+            user_id=self.client_id, batch_id=job.job_id,
+        )
+        try:
+            items = await IOLoop.current().run_in_executor(None, self._items, body, analysis, bria_service)
+        except (ValueError, KeyError, TypeError) as e:
+            job.set_status(FAILED, str(e))
+            raise tornado.web.HTTPError(400, reason=str(e))
+
+        if not items:
+            job.set_status(FAILED, "nothing to generate")
+            raise tornado.web.HTTPError(400, reason="Nothing to generate")
+        for label, item in items:
+            job.add_item(label, vibe_name=item["vibe_name"], specific_config=item["specific_config"],
+                         resolution=list(item["resolution"]), prompt=item["prompt"])
+        for label, item in items:
+            get_worker_pool().submit(run_generation_item, job, label, image, image_digest, analysis, item, bria_service)
+        self.accepted(job)
+
+    def _inputs(self, body: Dict[str, Any]) -> Tuple[bytes, ImageAnalysis]:
+        """Image and analysis from a finished analysis job, or passed inline"""
+        if body.get("analysis_job_id"):
+            analysis_job = self.get_job(body["analysis_job_id"])
+            if analysis_job.kind != "analysis" or analysis_job.status != SUCCEEDED:
+                raise tornado.web.HTTPError(409, reason="Analysis job has not succeeded")
+            return analysis_job.inputs["image"], analysis_job.inputs["analysis"]
+        if not isinstance(body.get("analysis"), dict):
+            raise tornado.web.HTTPError(400, reason="Provide analysis_job_id, or image_base64 with analysis")
+        try:
+            analysis = ImageAnalysis.from_dict(body["analysis"])
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Invalid analysis")
+        return self.upload_bytes(body), analysis
+
+    @staticmethod
+    def _items(body: Dict[str, Any], analysis: ImageAnalysis, bria_service: BriaService):
+        """(label, item) pairs with the exact prompt Bria will receive"""
+        preview = body.get("resolution") == "preview"
+        resolution = (Settings.PREVIEW_WIDTH, Settings.PREVIEW_HEIGHT) if preview else None
+
+        if body.get("matrix"):
+            matrix = body["matrix"]
+            spec = CampaignSpec(
+                matrix["vibes"], matrix.get("camera_angles"), matrix.get("scenario_ids"),
+                previews=bool(matrix.get("previews", False)),
+            )
+            plan = CampaignPlanner.plan(spec, analysis, bria_service)
+            return [
+                (job.label, {
+                    "vibe_name": job.vibe_name,
+                    "specific_config": job.specific_config,
+                    "resolution": job.resolution,
+                    "prompt": job.payload["prompt"],
+                })
+                for job in plan.jobs
+            ]
+
+        vibes = body.get("vibes") or []
+        if not vibes:
+            raise ValueError("Provide 'vibes' or a 'matrix'")
+        configs = body.get("configs") or {}
+        items = []
+        for vibe_name in vibes:
+            # "variants" asks for several renders in one call; it is not part of the prompt config
+            config = dict(configs.get(vibe_name) or {})
+            variants = min(int(config.pop("variants", 1)), Settings.MAX_VARIANTS)
+            payload = bria_service.build_payload(vibe_name, analysis, config or None, resolution, variants)
+            items.append((vibe_name, {
+                "vibe_name": vibe_name,
+                "specific_config": config or None,
+                "resolution": (payload["width"], payload["height"]),
+                "variants": variants,
+                "prompt": payload["prompt"],
+            }))
+        return items
+
+
+class JobHandler(BaseHandler):
+    def get(self, job_id: str):
+        self.finish(self.get_job(job_id).to_dict())
+
+    def delete(self, job_id: str):
+        job = self.get_job(job_id)
+        # The worker stops at its next checkpoint and reports CANCELLED itself
+        job.token.cancel("cancelled by client")
+        self.finish(job.to_dict())
+
+
+class JobEventsHandler(BaseHandler):
+    """Server-sent events: one "item" event per finished render, "status" events, then the stream ends"""
+
+    async def get(self, job_id: str):
+        job = self.get_job(job_id)
+        resume_from = self.request.headers.get("Last-Event-ID") or self.get_argument("after", "0") or "0"
+        if not resume_from.isdigit():
+            raise tornado.web.HTTPError(400, reason="Last-Event-ID must be an event number")
+        last_seq = int(resume_from)
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("X-Accel-Buffering", "no")
+
+        # An Event rather than a Condition: a publish that lands while this loop
+        # is busy flushing stays set, so it is never lost until the keep-alive
+        wakeup = Event()
+        loop = IOLoop.current()
+        unsubscribe = job.subscribe(lambda: loop.add_callback(wakeup.set))
+        try:
+            while True:
+                wakeup.clear()  # before draining: anything published from here on wakes the wait below
+                for event in job.events_after(last_seq):
+                    self.write(f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n")
+                    last_seq = event["id"]
+                if job.finished and not job.events_after(last_seq):
+                    self.write("event: done\ndata: {}\n\n")
+                    await self.flush()
+                    break
+                await self.flush()
+                try:
+                    await wakeup.wait(timeout=loop.time() + Settings.API_SSE_KEEPALIVE)
+                except gen.TimeoutError:
+                    self.write(": keep-alive\n\n")
+        except StreamClosedError:
+            pass  # client went away; the job keeps running
+        finally:
+            unsubscribe()
+
+
+class JobResultHandler(BaseHandler):
+    async def get(self, job_id: str):
+        job = self.get_job(job_id)
+        if job.kind == "analysis":
+            if job.status != SUCCEEDED:
+                raise tornado.web.HTTPError(409, reason=f"Job is {job.status}")
+            self.finish({"analysis": job.result})
+            return
+
+        label = self.get_argument("item", None)
+        result = job.inputs.get("results", {}).get(label) if label else None
+        if result is None:
+            raise tornado.web.HTTPError(404, reason="No finished item with that label")
+        variant = self.get_argument("variant", None)
+        if variant is not None:
+            if not variant.isdigit() or int(variant) >= len(result.variants):
+                raise tornado.web.HTTPError(404, reason="No such variant")
+            result = result.variants[int(variant)]
+        if not self.get_argument("download", None):
+            if not result.image_url:
+                raise tornado.web.HTTPError(409, reason="Result has no URL; use download=1")
+            self.redirect(result.image_url)
+            return
+
+        asset = await IOLoop.current().run_in_executor(None, result.fetch)
+        self.set_header("Content-Type", asset.mime_type)
+        self.set_header("Content-Length", str(asset.nbytes))
+        self.set_header("Content-Disposition", f'attachment; filename="{job.job_id}.{asset.extension}"')
+        # Read chunk by chunk so the asset's lock is never held across an await:
+        # another download of the same item would block the IOLoop on it
+        offset = 0
+        while True:
+            chunk = asset.read_chunk(offset, Settings.DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            offset += len(chunk)
+            self.write(chunk)
+            await self.flush()
+        self.finish()
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.finish({"status": "ok", "active_jobs": get_job_store().active_count()})
+
+
+def make_app() -> tornado.web.Application:
+    return tornado.web.Application([
+        (r"/healthz", HealthHandler),
+        (r"/v1/analyses", AnalysisHandler),
+        (r"/v1/generations", GenerationHandler),
+        (r"/v1/jobs/([0-9a-f]{32})", JobHandler),
+        (r"/v1/jobs/([0-9a-f]{32})/events", JobEventsHandler),
+        (r"/v1/jobs/([0-9a-f]{32})/result", JobResultHandler),
+    ])
+
+
+async def main():
+    if not Settings.has_api_keys():
+        raise SystemExit("GEMINI_API_KEY and BRIA_API_KEY must be set")
+    server = tornado.httpserver.HTTPServer(make_app(), max_body_size=Settings.API_MAX_UPLOAD_BYTES * 2)
+    server.listen(Settings.API_PORT)
+    print(f"Context Chameleon API listening on :{Settings.API_PORT}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,16 +1,26 @@
 import streamlit as st
 import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from PIL import Image
 import os
+import uuid
 
 from config.settings import Settings
 from services.gemini_service import GeminiService
 from services.bria_service import BriaService
-from services.image_service import ImageService
+from services.rate_limiter import PRIORITY_BATCH, get_scheduler
+from services.speculation import history as selection_history, match_scenario_category
+from services.worker_pool import get_worker_pool
+from services.phash_index import get_phash_index
+from services.local_analyzer import LocalImageAnalyzer
+from services.campaign_planner import CampaignPlanner
+from services.usage_ledger import BudgetExceeded, get_usage_ledger
+from services.vibe_registry import get_registry
 from ui.styles import get_custom_css
 from ui.components import UIComponents
 
 from utils.session_state import SessionState
+from utils.cancellation import CancellationToken, CancelledError, DeadlineExceeded
 
 # Page Configuration
 st.set_page_config(
@@ -27,19 +37,89 @@ st.markdown(get_custom_css(), unsafe_allow_html=True)
 SessionState.initialize()
 
 
-def analyze_image_handler(image: Image.Image, gemini_key: str):
+def analyze_image_handler(
+    image: Image.Image, gemini_key: str, bria_key: str = None, speculate: bool = False, mode: str = None
+):
     """Handle image analysis"""
     with st.spinner("🔍 Analyzing image with Gemini AI..."):
         try:
-            gemini_service = GeminiService(gemini_key)
-            analysis = gemini_service.analyze_image(image)
+            gemini_service = GeminiService(
+                gemini_key, session_id=SessionState.get_session_id(), user_id=SessionState.get_user_id()
+            )
+            if Settings.GEMINI_STREAM_ANALYSIS:
+                live = st.empty()
+                shown = {}
+
+                def on_partial(partial):
+                    # Fields arrive one by one; redraw only when a displayed one changed
+                    SessionState.set_partial_analysis(partial)
+                    visible = {
+                        "scene_type": partial.scene_type,
+                        "lighting": partial.lighting.type,
+                        "subject": partial.subjects[0].detailed_description if partial.subjects else None,
+                    }
+                    if visible != shown:
+                        shown.update(visible)
+                        UIComponents.render_partial_analysis(live, partial)
+            else:
+                on_partial = None
+
+            analysis = gemini_service.analyze_image(image, mode=mode, on_partial=on_partial)
             SessionState.set_image_analysis(analysis)
+
+            # Use the idle time while the user picks vibes to pre-render likely choices
+            if speculate and bria_key:
+                SessionState.get_speculation().start(
+                    image,
+                    analysis,
+                    UIComponents._get_consumption_scenarios(analysis),
+                    bria_key,
+                    session_id=SessionState.get_session_id(),
+                    image_digest=SessionState.get_upload_digest(image),
+                )
             st.success("✅ Image analysis complete!")
             st.rerun()
         except Exception as e:
+            SessionState.set_partial_analysis(None)
             st.error(f"Analysis failed: {str(e)}")
 
 
+def reuse_analysis_handler(image: Image.Image, entry, distance: int, mode: str = None):
+    """Adopt the analysis of a near-duplicate upload instead of calling Gemini"""
+    local = LocalImageAnalyzer.analyze(image) if (mode or Settings.ANALYSIS_MODE) != "gemini" else None
+    analysis = GeminiService.reuse_analysis(entry.analysis, local, distance)
+    get_phash_index().add(image, SessionState.get_upload_digest(image), analysis)
+    SessionState.set_image_analysis(analysis)
+    st.rerun()
+
+
+def start_fresh_handler():
+    """Drop the resumed session and reload with a new one"""
+    SessionState.start_fresh()
+    st.rerun()
+
+
+def _await_job(future: Future, token: CancellationToken, status_text, label: str):
+    """
+    Wait for a background job while touching the UI regularly.
+
+    Each UI update is a point where Streamlit can interrupt the script (stop
+    button, widget change, tab closed); the job's token is cancelled on the way
+    out so the worker slot and API quota are released immediately.
+    """
+    started = time.monotonic()
+    try:
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except FutureTimeoutError:
+                status_text.markdown(f"**Processing:** {label} · {time.monotonic() - started:.0f}s")
+    except BaseException:
+        if not future.done():
+            token.cancel("interrupted")
+        raise
+
+
 def generate_assets_handler(
     image: Image.Image,
     selected_vibes: list,
@@ -57,11 +137,15 @@ def generate_assets_handler(
 
     progress_bar = st.progress(0)
     status_text = st.empty()
+    st.button("⏹️ Stop Generation", key="stop_generation")  # any click reruns, which cancels the campaign
+    speculation = SessionState.get_speculation()
+    campaign_token = SessionState.start_generation()
+    image_digest = SessionState.get_upload_digest(image)  # hashed once per upload, not per render
+    stopped = False
 
     for idx, vibe_name in enumerate(selected_vibes):
         # Fetch emoji safely
-        from config.vibe_configs import VIBE_CONFIGS
-        emoji = VIBE_CONFIGS.get(vibe_name, {}).get("emoji", "✨")
+        emoji = get_registry().emoji(vibe_name)
         
         status_text.markdown(f"**Processing:** {vibe_name} {emoji}")
 
@@ -71,32 +155,68 @@ def generate_assets_handler(
                 st.error("Image analysis required. Please analyze the image first.")
                 continue
 
-            # Extract specific config for this vibe if available
-            specific_config = vibe_configs.get(vibe_name, {})
+            # Extract specific config for this vibe if available; the variant count is not part of the prompt
+            specific_config = dict(vibe_configs.get(vibe_name, {}))
+            variants = specific_config.pop("variants", 1)
+            selection_history.record(match_scenario_category(analysis), vibe_name, specific_config)
+
+            # A finished speculative preview for this exact config is promoted instantly
+            promoted = speculation.take(vibe_name, specific_config) if variants == 1 else None
+            if promoted:
+                promoted.metadata["speculative"] = True
+                SessionState.add_generated_image(vibe_name, promoted)
+                progress_bar.progress((idx + 1) / len(selected_vibes))
+                continue
 
             with st.spinner(f"🤖 Generating {vibe_name} with Bria FIBO..."):
-                bria_service = BriaService(bria_key)
+                bria_service = BriaService(
+                    bria_key, session_id=SessionState.get_session_id(), user_id=SessionState.get_user_id()
+                )
+                job_token = campaign_token.child(timeout=Settings.GENERATION_DEADLINE)
                 
                 # Pass vibe config (which may contain scenario_id for Consumption/Active)
-                generated_image = bria_service.generate_image(
+                future = get_worker_pool().submit(
+                    bria_service.generate_image,
                     image, 
                     vibe_name, 
                     analysis,
-                    specific_config=specific_config  # Pass specific config for the vibe
+                    specific_config=specific_config,  # Pass specific config for the vibe
+                    cancel_token=job_token,
+                    variants=variants,
+                    image_digest=image_digest,
                 )
+                generated_image = _await_job(future, job_token, status_text, f"{vibe_name} {emoji}")
 
                 if generated_image:
                     SessionState.add_generated_image(vibe_name, generated_image)
                 else:
                     st.error(f"Failed to generate {vibe_name}")
 
+        except BudgetExceeded as e:
+            st.warning(f"💰 {vibe_name}: {e}")
+        except DeadlineExceeded:
+            st.error(f"Generating {vibe_name} took longer than {Settings.GENERATION_DEADLINE}s and was stopped")
+        except CancelledError as e:
+            st.warning(f"⏹️ Generation stopped: {e}")
+            stopped = True
+            break
         except Exception as e:
+            if campaign_token.cancelled:
+                # Streamlit is stopping or rerunning the script; let it unwind
+                raise
             st.error(f"Error generating {vibe_name}: {str(e)}")
             import traceback
             st.error(traceback.format_exc())
 
         progress_bar.progress((idx + 1) / len(selected_vibes))
 
+    # Evict speculative renders the user did not pick
+    speculation.cancel_all()
+    if stopped:
+        progress_bar.empty()
+        status_text.empty()
+        return
+
     status_text.markdown("**✅ Generation Complete!**")
     time.sleep(0.5)
     progress_bar.empty()
@@ -106,6 +226,51 @@ def generate_assets_handler(
     st.balloons()
 
 
+def campaign_matrix_handler(image: Image.Image, plan, bria_key: str):
+    """Run a planned campaign matrix, previews first, storing each result as it lands"""
+    st.markdown("### 🧮 Rendering Campaign Matrix...")
+
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    st.button("⏹️ Stop Generation", key="stop_matrix")  # any click reruns, which cancels the campaign
+    campaign_token = SessionState.start_generation()
+    bria_service = BriaService(
+        bria_key,
+        session_id=SessionState.get_session_id(),
+        user_id=SessionState.get_user_id(),
+        priority=PRIORITY_BATCH,  # matrix renders yield to other sessions' interactive generations
+        batch_id=uuid.uuid4().hex,  # the whole matrix is accounted as one batch job
+    )
+    jobs = CampaignPlanner.submit(
+        plan, image, SessionState.get_image_analysis(), bria_service, campaign_token,
+        image_digest=SessionState.get_upload_digest(image),
+    )
+
+    for idx, (job, job_token, future) in enumerate(jobs):
+        try:
+            result = _await_job(future, job_token, status_text, job.label)
+            if result:
+                SessionState.add_generated_image(job.label, result)
+            else:
+                st.error(f"Failed to generate {job.label}")
+        except BudgetExceeded as e:
+            st.warning(f"💰 {job.label}: {e}")
+        except DeadlineExceeded:
+            st.error(f"Generating {job.label} took longer than {Settings.GENERATION_DEADLINE}s and was stopped")
+        except CancelledError as e:
+            campaign_token.cancel(str(e))
+            st.warning(f"⏹️ Generation stopped: {e}")
+            break
+        except Exception as e:
+            if campaign_token.cancelled:
+                raise
+            st.error(f"Error generating {job.label}: {str(e)}")
+        progress_bar.progress((idx + 1) / len(jobs))
+
+    progress_bar.empty()
+    status_text.empty()
+
+
 def main():
     """Main application entry point"""
 
@@ -121,12 +286,23 @@ def main():
 
     # Render header
     UIComponents.render_header()
+    speculate = UIComponents.render_speculation_toggle()
+    analysis_mode = UIComponents.render_analysis_mode_selector()
 
     # Upload section
     uploaded_image = UIComponents.render_upload_section()
+    if uploaded_image is None:
+        # After a restart the uploader is empty; a resumed session brings its image back
+        uploaded_image = SessionState.get_restored_upload()
+        if uploaded_image is not None:
+            UIComponents.render_restored_upload(uploaded_image, start_fresh_handler)
+
+    # A new (or removed) upload cancels whatever is still rendering for the old one
+    upload_digest = SessionState.get_upload_digest(uploaded_image)
+    SessionState.track_upload(upload_digest)
 
     if uploaded_image is not None:
-        SessionState.set_uploaded_image(uploaded_image)
+        SessionState.set_uploaded_image(uploaded_image, upload_digest)
 
         # Analysis section
         if gemini_key:
@@ -134,15 +310,21 @@ def main():
             UIComponents.render_analysis_section(
                 uploaded_image,
                 SessionState.get_image_analysis(),
-                on_analyze_callback=lambda: analyze_image_handler(uploaded_image, gemini_key),
-                on_reanalyze_callback=lambda: analyze_image_handler(uploaded_image, gemini_key)
+                on_analyze_callback=lambda: analyze_image_handler(uploaded_image, gemini_key, bria_key, speculate, analysis_mode),
+                on_reanalyze_callback=lambda: analyze_image_handler(uploaded_image, gemini_key, bria_key, speculate, analysis_mode),
+                similar_match=SessionState.get_similar_match(uploaded_image, upload_digest) if SessionState.get_image_analysis() is None else None,
+                on_reuse_callback=lambda entry, distance: reuse_analysis_handler(uploaded_image, entry, distance, analysis_mode)
             )
 
         st.markdown("---")
 
         # Get selected vibes and configs using existing method
         analysis_data = SessionState.get_image_analysis()
+        restored_selection = SessionState.take_restored_selection()
+        if restored_selection:
+            UIComponents.seed_vibe_selection(*restored_selection)
         selected_vibes, vibe_configs = UIComponents.render_vibe_selection_and_config(analysis_data)
+        SessionState.set_selection(selected_vibes, vibe_configs)
         
         # Debug: Show what was selected
         with st.expander("🔍 Debug Selection", expanded=False):
@@ -155,8 +337,33 @@ def main():
                 if scenario_id:
                     st.write(f"Selected scenario ID: {scenario_id}")
 
+        # Grid campaigns: estimate before launch, then render previews first
+        matrix_spec = UIComponents.render_campaign_matrix(analysis_data)
+        if matrix_spec is not None:
+            if not analysis_data:
+                st.warning("Please analyze the image first to plan a campaign matrix.")
+            else:
+                try:
+                    plan = CampaignPlanner.plan(
+                        matrix_spec, analysis_data, BriaService(bria_key, session_id=SessionState.get_session_id())
+                    )
+                    UIComponents.render_campaign_plan(plan.to_dict())
+                    if st.button("🧮 Launch Campaign Matrix", use_container_width=True):
+                        campaign_matrix_handler(uploaded_image, plan, bria_key)
+                except ValueError as e:
+                    st.warning(str(e))
+
         # Technical details
         UIComponents.render_technical_details(selected_vibes, vibe_configs)
+        UIComponents.render_scheduler_metrics(get_scheduler().metrics())
+        ledger = get_usage_ledger()
+        UIComponents.render_usage_summary(
+            ledger.totals("session", SessionState.get_session_id()),
+            ledger.totals("user", SessionState.get_user_id()),
+            # ?user= is not authenticated, so a session may only export its own calls
+            lambda: ledger.export_csv("session", SessionState.get_session_id()),
+            lambda: ledger.export_json("session", SessionState.get_session_id()),
+        )
 
         # Generation button
         if selected_vibes:
@@ -180,10 +387,16 @@ def main():
                     )
                         
             # Display results
-            UIComponents.render_generation_results(SessionState.get_generated_images())
+            UIComponents.render_generation_results(
+                SessionState.get_generated_images(), on_select_variant=SessionState.select_variant
+            )
         else:
             if uploaded_image:
                 st.info("👆 Select at least one marketing vibe to begin generation")
+            # Campaign matrix results do not depend on the single-vibe selection
+            UIComponents.render_generation_results(
+                SessionState.get_generated_images(), on_select_variant=SessionState.select_variant
+            )
 
     else:
         # Placeholder content
@@ -0,0 +1,352 @@
+"""
+Load test: N concurrent simulated users driving the real app.py script.
+
+Each simulated session is a Streamlit AppTest running app.py in this
+process, scripted through upload -> analyze -> select vibes -> generate ->
+download. Gemini is replaced by an in-process stand-in and Bria by the local
+HTTP stand-in from the memory benchmark, both with configurable latencies,
+so the pod's own overhead (script reruns, scheduling, image handling) is
+what gets measured.
+
+    python -m benchmarks.load_test --concurrency 1 4 16 --gemini-latency 1 --bria-latency 5
+
+For each concurrency level it reports session throughput, p50/p95/p99
+latency per step, peak RSS and peak thread count.
+
+AppTest cannot drive st.file_uploader, so the upload step goes through
+session resume: the product is put in the upload cache with a snapshot
+pointing at it, and the session opens app.py with ?session=<token>.
+
+AppTest installs and clears a mock Runtime and compiles the script afresh
+around every run, which breaks as soon as two sessions overlap (concurrent
+compiles of app.py can fail on CPython 3.11); _share_test_runtime() installs
+one mock Runtime and one script cache for the whole load test, as a real
+server has.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from types import SimpleNamespace
+from typing import Dict, Any, List, Optional
+
+from PIL import Image, ImageDraw
+
+from benchmarks.memory_benchmark import RESOLUTIONS, _RssSampler, _StandInBria, _rss_bytes
+from config.settings import Settings
+
+STEPS = ("upload", "analyze", "select", "generate", "download")
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+_MB = 1024 * 1024
+
+CANNED_ANALYSIS = {
+    "subjects": [{
+        "name": "beverage can",
+        "detailed_description": "a matte black aluminum beverage can with a silver pull tab",
+        "primary_colors": ["black", "silver"],
+        "material": "aluminum",
+    }],
+    "global_description": "a single product on a plain background",
+    "scene_type": "studio",
+    "metadata_confidence": 0.9,
+}
+
+
+class _StandInGemini:
+    """
+    Drop-in for genai.GenerativeModel that answers with a canned analysis after `latency` seconds.
+
+    For a `hard_fraction` of products the base model answers with low confidence,
+    so the analysis escalates; escalation models take `escalated_latency_factor` times longer.
+    """
+
+    latency = 0.0
+    hard_fraction = 0.0
+    escalated_latency_factor = 2.0
+
+    def __init__(self, model_name: str, *args, **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, contents, *args, stream: bool = False, **kwargs):
+        usage_metadata = SimpleNamespace(prompt_token_count=1300, candidates_token_count=250)
+        analysis, latency = dict(CANNED_ANALYSIS), self.latency
+        if self.model_name != Settings.GEMINI_MODEL:
+            latency *= self.escalated_latency_factor
+        elif zlib.crc32(contents[-1]["data"]) % 1000 < self.hard_fraction * 1000:
+            analysis["metadata_confidence"] = 0.3
+        text = json.dumps(analysis)
+        if not stream:
+            time.sleep(latency)
+            return SimpleNamespace(text=text, usage_metadata=usage_metadata)
+        return _StandInStream(text, usage_metadata, latency)
+
+
+class _StandInStream:
+    """Streamed reply: the text in a few chunks spread over the latency"""
+
+    def __init__(self, text: str, usage_metadata, latency: float, chunks: int = 5):
+        size = -(-len(text) // chunks)
+        self._chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        self._delay = latency / len(self._chunks)
+        self.usage_metadata = usage_metadata
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            time.sleep(self._delay)
+            yield SimpleNamespace(text=chunk)
+
+
+class _ThreadSampler(threading.Thread):
+    """Peak number of live threads while a level runs"""
+
+    def __init__(self, interval: float = 0.05):
+        super().__init__(name="thread-sampler", daemon=True)
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _share_test_runtime():
+    """One mock Runtime and script cache for all concurrent AppTests"""
+    from unittest.mock import MagicMock
+    from streamlit import config, logger as streamlit_logger
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+    # AppTest's per-run install/clear now lands on a subclass and leaves the shared one alone
+    app_test.Runtime = type("PerRunRuntime", (Runtime,), {})
+    script_cache = ScriptCache()  # compiles app.py once, under its own lock
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+    config.set_option("global.appTest", True)
+    config.set_option("logger.level", "error")
+    streamlit_logger.set_log_level("error")
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _product_image(seed: int) -> Image.Image:
+    """A distinct product per session, so caches and request coalescing do not merge sessions"""
+    rng = random.Random(seed)
+    image = Image.new("RGBA", (1024, 1024), (0, 0, 0, 0))
+    color = (rng.randrange(256), rng.randrange(256), rng.randrange(256), 255)
+    ImageDraw.Draw(image).ellipse((256, 192, 768, 832), fill=color)
+    ImageDraw.Draw(image).rectangle((rng.randrange(300, 500), 400, 600, 480), fill=(255, 255, 255, 255))
+    return image
+
+
+class SimulatedSession:
+    """One user walking through the app; records how long each step took"""
+
+    def __init__(self, index: int, vibes: List[str], timeout: float, variants: int = 1):
+        self.index = index
+        self.vibes = vibes
+        self.timeout = timeout
+        self.variants = variants
+        self.escalated = False
+        self.timings: Dict[str, float] = {}
+        self.error: Optional[str] = None
+
+    def _step(self, name: str, app, action=None):
+        started = time.perf_counter()
+        if action is not None:
+            action()
+        app.run(timeout=self.timeout)
+        self.timings[name] = time.perf_counter() - started
+        if app.exception:
+            raise RuntimeError(f"{name}: {app.exception[0].message}")
+
+    @staticmethod
+    def _button(app, label_prefix: str):
+        for button in app.button:
+            if button.label.startswith(label_prefix):
+                return button
+        shown = [e.value for e in app.error]
+        raise RuntimeError(f"no button starting with {label_prefix!r}" + (f": {shown[0]}" if shown else ""))
+
+    def run(self):
+        from streamlit.testing.v1 import AppTest
+        from services.image_service import ImageService
+        from services.session_store import SessionSnapshot, SessionStore
+
+        try:
+            # "Upload": hand the product over through a resumable session
+            started = time.perf_counter()
+            product = _product_image(self.index)
+            digest = ImageService.image_digest(product)
+            ImageService.encode_image(product, "PNG", digest)
+            token = uuid.uuid4().hex
+            SessionStore.save(token, SessionSnapshot(upload_digest=digest).to_bytes())
+            app = AppTest.from_file(APP_PATH, default_timeout=self.timeout)
+            app.query_params["session"] = token
+            app.query_params["user"] = f"load-{self.index}"
+            app.run(timeout=self.timeout)
+            self.timings["upload"] = time.perf_counter() - started
+            if app.exception:
+                raise RuntimeError(f"upload: {app.exception[0].message}")
+
+            self._step("analyze", app, self._button(app, "🔍 Analyze").click)
+            self.escalated = bool(app.session_state["image_analysis"].model_tier)
+
+            def select():
+                for vibe_name in self.vibes:
+                    app.checkbox(key=f"vibe_{vibe_name}").check()
+            self._step("select", app, select)
+            if self.variants > 1:
+                for vibe_name in self.vibes:
+                    app.number_input(key=f"variants_{vibe_name}").set_value(self.variants)
+                app.run(timeout=self.timeout)
+
+            self._step("generate", app, self._button(app, "🚀 Generate").click)
+            generated = app.session_state["generated_images"]
+            missing = [v for v in self.vibes if v not in generated]
+            if missing:
+                raise RuntimeError(f"generate: no result for {', '.join(missing)}")
+            if any(len(generated[v].variants) != self.variants for v in self.vibes):
+                raise RuntimeError(f"generate: expected {self.variants} variants per vibe")
+
+            # Each fetch button reruns the script, so they are pressed one run at a time
+            started = time.perf_counter()
+            for vibe_name in self.vibes:
+                app.button(key=f"fetch_{vibe_name}").click()
+                app.run(timeout=self.timeout)
+                if app.exception:
+                    raise RuntimeError(f"download: {app.exception[0].message}")
+            self.timings["download"] = time.perf_counter() - started
+            if not all(variant.is_fetched for v in self.vibes for variant in generated[v].variants):
+                raise RuntimeError("download: assets were not fetched")
+        except Exception as e:
+            self.error = str(e)
+
+
+def run_level(concurrency: int, vibes: List[str], timeout: float, variants: int = 1) -> Dict[str, Any]:
+    sessions = [SimulatedSession(i, vibes, timeout, variants) for i in range(concurrency)]
+    sampler = _RssSampler()
+    threads = _ThreadSampler()
+    rss_before = sampler.reset()
+    sampler.start()
+    threads.start()
+    started = time.perf_counter()
+    workers = [threading.Thread(target=s.run, name=f"session-{s.index}") for s in sessions]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    threads.stop()
+    sampler.stop()
+
+    completed = [s for s in sessions if s.error is None]
+    steps = {}
+    for step in STEPS:
+        values = [s.timings[step] for s in sessions if step in s.timings]
+        steps[step] = {
+            "p50": _percentile(values, 50),
+            "p95": _percentile(values, 95),
+            "p99": _percentile(values, 99),
+            "mean": statistics.fmean(values) if values else None,
+        }
+    return {
+        "concurrency": concurrency,
+        "completed": len(completed),
+        "failed": len(sessions) - len(completed),
+        "errors": sorted({s.error for s in sessions if s.error}),
+        "seconds": round(elapsed, 2),
+        "sessions_per_minute": round(len(completed) / elapsed * 60, 2) if elapsed else 0.0,
+        "steps": steps,
+        "rss_peak_mb": round(max(sampler.peak, _rss_bytes()) / _MB, 1),
+        "rss_growth_mb": round((max(sampler.peak, _rss_bytes()) - rss_before) / _MB, 1),
+        "threads_peak": threads.peak,
+        "escalated_analyses": sum(s.escalated for s in sessions),
+    }
+
+
+def _print_level(result: Dict[str, Any]):
+    print(
+        f"\nconcurrency {result['concurrency']}: {result['completed']} ok / {result['failed']} failed in "
+        f"{result['seconds']:.1f}s ({result['sessions_per_minute']:.1f} sessions/min), "
+        f"RSS peak {result['rss_peak_mb']:.0f} MB (+{result['rss_growth_mb']:.0f}), "
+        f"threads peak {result['threads_peak']}, {result['escalated_analyses']} analyses escalated"
+    )
+    print(f"  {'step':<10}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}")
+    for step, stats in result["steps"].items():
+        if stats["p50"] is None:
+            continue
+        print(f"  {step:<10}{stats['p50']:>8.2f}{stats['p95']:>8.2f}{stats['p99']:>8.2f}")
+    for error in result["errors"]:
+        print(f"  error: {error}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 8])
+    parser.add_argument("--vibes", nargs="+", default=["Midnight Luxury", "Hero Spotlight"])
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="seconds per stand-in Gemini call")
+    parser.add_argument("--bria-latency", type=float, default=3.0, help="seconds per stand-in Bria render")
+    parser.add_argument("--resolution", choices=list(RESOLUTIONS), default="1k", help="size of generated assets")
+    parser.add_argument("--variants", type=int, default=1, help="renders requested per vibe")
+    parser.add_argument("--hard-fraction", type=float, default=0.0,
+                        help="share of products the base Gemini model is unsure about (escalated)")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds a single script run may take")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("GEMINI_API_KEY", "load-test")
+    os.environ.setdefault("BRIA_API_KEY", "load-test")
+
+    import services.gemini_service as gemini_service
+
+    _StandInGemini.latency = args.gemini_latency
+    _StandInGemini.hard_fraction = args.hard_fraction
+    gemini_service.genai.GenerativeModel = _StandInGemini
+    _share_test_runtime()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir, _StandInBria(workdir, latency=args.bria_latency) as stand_in:
+        Settings.BRIA_API_ENDPOINT = f"http://127.0.0.1:{stand_in.port}/v2/image/generate"
+        Settings.OUTPUT_WIDTH, Settings.OUTPUT_HEIGHT = RESOLUTIONS[args.resolution]
+        Settings.RATE_LIMITS = {name: {"rate": 1000.0, "burst": 1000} for name in Settings.RATE_LIMITS}
+        Settings.USAGE_BUDGETS = {}
+        Settings.CACHE_DIR = os.path.join(workdir, "cache")  # a cold cache per run
+        stand_in.image_path(*RESOLUTIONS[args.resolution])
+
+        for concurrency in args.concurrency:
+            result = run_level(concurrency, args.vibes, args.timeout, args.variants)
+            _print_level(result)
+            results.append(result)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"args": vars(args), "levels": results}, f, indent=2)
+    return 1 if any(r["failed"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
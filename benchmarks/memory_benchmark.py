@@ -0,0 +1,288 @@
+"""
+Memory benchmark for the generate -> store -> render-results -> download path,
+plus the tiled mock renderer used while Bria is unavailable.
+
+Runs BriaService against a local stand-in for the Bria API that returns
+pre-encoded PNGs at the requested resolution, so no API key or network is
+needed. For every stage it reports the tracemalloc peak/retained bytes
+(Python allocations) and the sampled RSS peak/retained bytes (which also
+covers Pillow's raster buffers, invisible to tracemalloc).
+
+    python -m benchmarks.memory_benchmark --resolutions 1k 4k 8k --ceiling-mb 1500
+
+Exits with status 1 when any stage's peak exceeds the ceiling.
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional, Tuple
+
+from PIL import Image, ImageDraw
+
+from config.settings import Settings
+from services.analysis_model import ImageAnalysis
+from services.assets import GeneratedAsset
+from services.bria_service import BriaService
+from services.image_service import ImageService
+
+RESOLUTIONS = {
+    "1k": (1024, 1024),
+    "4k": (3840, 2160),
+    "8k": (7680, 4320),
+}
+_MB = 1024 * 1024
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+ANALYSIS = ImageAnalysis.from_dict({
+    "subjects": [{
+        "detailed_description": "a matte black ceramic coffee mug with a curved handle",
+        "primary_colors": ["black", "white"],
+        "material": "ceramic",
+    }],
+})
+
+
+def _rss_bytes() -> int:
+    """Current resident set size; falls back to the lifetime peak where /proc is missing"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class _RssSampler:
+    """Background thread recording the highest RSS seen since the last reset"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = _rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def reset(self) -> int:
+        current = _rss_bytes()
+        self.peak = current
+        return current
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class _StandInBria:
+    """Local HTTP server speaking just enough of the Bria v2 generate API"""
+
+    def __init__(self, workdir: str, latency: float = 0.0):
+        self.workdir = workdir
+        self.latency = latency  # seconds each generate call takes
+        self._images: Dict[Tuple[int, int], str] = {}
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                width, height = body["width"], body["height"]
+                stand_in.image_path(width, height)
+                time.sleep(stand_in.latency)
+                url = f"http://127.0.0.1:{stand_in.port}/images/{width}x{height}.png"
+                count = body.get("num_results", 1)
+                result = {"image_url": url} if count == 1 else [{"image_url": f"{url}?variant={i}"} for i in range(count)]
+                self._send(200, "application/json", json.dumps({"result": result}).encode())
+
+            def do_GET(self):
+                width, height = map(int, self.path.rsplit("/", 1)[-1].split(".")[0].split("x"))
+                path = stand_in.image_path(width, height)
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(os.path.getsize(path)))
+                self.end_headers()
+                with open(path, "rb") as f:
+                    while True:
+                        chunk = f.read(Settings.DOWNLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+
+            def _send(self, status: int, content_type: str, data: bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+
+    def image_path(self, width: int, height: int) -> str:
+        """Encode the stand-in output once per size, outside any measured stage"""
+        with self._lock:
+            if (width, height) not in self._images:
+                path = os.path.join(self.workdir, f"{width}x{height}.png")
+                gradient = Image.linear_gradient("L").resize((width, height))
+                Image.merge("RGB", (gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), gradient)).save(
+                    path, format="PNG", compress_level=1
+                )
+                self._images[(width, height)] = path
+            return self._images[(width, height)]
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, name="bria-stand-in", daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MemoryBenchmark:
+    """Runs the stages for one resolution and collects per-stage memory figures"""
+
+    def __init__(self, sampler: _RssSampler):
+        self.sampler = sampler
+        self.stages: List[Dict[str, Any]] = []
+
+    @contextmanager
+    def stage(self, resolution: str, name: str):
+        gc.collect()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        rss_before = self.sampler.reset()
+        started = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - started
+        traced_after, traced_peak = tracemalloc.get_traced_memory()
+        rss_peak = max(self.sampler.peak, _rss_bytes())
+        gc.collect()
+        rss_after = _rss_bytes()
+        self.stages.append({
+            "resolution": resolution,
+            "stage": name,
+            "seconds": round(elapsed, 3),
+            "traced_peak_mb": round((traced_peak - traced_before) / _MB, 1),
+            "traced_retained_mb": round((traced_after - traced_before) / _MB, 1),
+            "rss_peak_mb": round((rss_peak - rss_before) / _MB, 1),
+            "rss_retained_mb": round((rss_after - rss_before) / _MB, 1),
+        })
+
+    def run(self, resolution: str, size: Tuple[int, int], product: Image.Image, decode: bool):
+        session_state: Dict[str, Any] = {}
+        bria_service = BriaService("benchmark")
+
+        with self.stage(resolution, "generate"):
+            result = bria_service.generate_image(product, "Marketplace Clean", ANALYSIS, resolution=size)
+        with self.stage(resolution, "store"):
+            session_state[resolution] = result
+        with self.stage(resolution, "render_results"):
+            # What st.image receives: a URL unless the file was already fetched
+            preview = session_state[resolution].preview_source
+        with self.stage(resolution, "download"):
+            asset = session_state[resolution].fetch()
+            data = asset.getvalue()  # what st.download_button receives
+        del preview, data
+
+        if decode:
+            # Legacy paths: rasters kept in session state and PNG re-encoding
+            with self.stage(resolution, "decode"):
+                raster = asset.image
+            with self.stage(resolution, "image_to_bytes"):
+                # Kept like the legacy app kept it, so the stage reports it as retained
+                session_state["encoded"] = ImageService.image_to_bytes(raster)
+            del raster
+
+        with self.stage(resolution, "mock"):
+            mock = GeneratedAsset.from_mock("Marketplace Clean", product, size)
+        mock.close()
+
+        asset.close()
+        session_state.clear()
+
+
+def _product_image() -> Image.Image:
+    image = Image.new("RGBA", (1024, 1024), (0, 0, 0, 0))
+    ImageDraw.Draw(image).ellipse((256, 192, 768, 832), fill=(30, 30, 30, 255))
+    return image
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--resolutions", nargs="+", choices=list(RESOLUTIONS), default=list(RESOLUTIONS))
+    parser.add_argument(
+        "--ceiling-mb",
+        type=float,
+        default=float(os.getenv("MEMORY_CEILING_MB", "0")) or None,
+        help="fail when any stage's RSS or traced peak exceeds this (env MEMORY_CEILING_MB)",
+    )
+    parser.add_argument("--no-decode", action="store_true", help="skip the decode / PNG re-encode stages")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir, _StandInBria(workdir) as stand_in:
+        Settings.BRIA_API_ENDPOINT = f"http://127.0.0.1:{stand_in.port}/v2/image/generate"
+        Settings.RATE_LIMITS = {**Settings.RATE_LIMITS, "bria": {"rate": 1000.0, "burst": 1000}}
+        Settings.PHASH_AUTO_REUSE = False
+        Settings.CACHE_DIR = os.path.join(workdir, "cache")  # never the shared .cache; cold per run
+        for resolution in args.resolutions:
+            stand_in.image_path(*RESOLUTIONS[resolution])
+
+        product = _product_image()
+        sampler = _RssSampler()
+        sampler.start()
+        tracemalloc.start()
+        benchmark = MemoryBenchmark(sampler)
+        try:
+            for resolution in args.resolutions:
+                benchmark.run(resolution, RESOLUTIONS[resolution], product, decode=not args.no_decode)
+        finally:
+            tracemalloc.stop()
+            sampler.stop()
+
+    header = f"{'res':<5}{'stage':<16}{'time s':>8}{'traced pk':>11}{'traced ret':>12}{'rss pk':>9}{'rss ret':>9}"
+    print(header)
+    print("-" * len(header))
+    for row in benchmark.stages:
+        print(
+            f"{row['resolution']:<5}{row['stage']:<16}{row['seconds']:>8.2f}{row['traced_peak_mb']:>11.1f}"
+            f"{row['traced_retained_mb']:>12.1f}{row['rss_peak_mb']:>9.1f}{row['rss_retained_mb']:>9.1f}"
+        )
+    print("(MB; peaks and retained sizes are relative to the start of each stage)")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"ceiling_mb": args.ceiling_mb, "stages": benchmark.stages}, f, indent=2)
+
+    if args.ceiling_mb:
+        over = [
+            row for row in benchmark.stages
+            if max(row["rss_peak_mb"], row["traced_peak_mb"]) > args.ceiling_mb
+        ]
+        for row in over:
+            print(f"FAIL: {row['resolution']} {row['stage']} peaked above {args.ceiling_mb:.0f} MB")
+        if over:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -76,4 +76,54 @@ Ensure every field is filled with maximum detail and precision.
 
 
 
-"""
\ No newline at end of file
+"""
+# Semantic-only variant used in "hybrid" analysis mode: palette, colors and layout
+# are measured locally (services/local_analyzer.py), so Gemini skips them.
+GEMINI_SEMANTIC_PROMPT = """
+You are an advanced visual-analysis agent specialized in professional, structured, JSON-native product descriptions.
+Analyze this image and describe its semantic content only. Do not report colors as hex codes and do not describe composition.
+
+OUTPUT RULES:
+- Output ONLY valid JSON.
+- JSON must contain no comments, explanation, or text outside the JSON structure.
+- Never invent objects that do not appear in the image.
+
+JSON FORMAT REQUIREMENTS:
+{
+  "global_description": "A detailed paragraph summarizing the full scene.",
+  "scene_type": "indoor | outdoor | studio | abstract | unknown",
+  "camera": {
+    "shot_type": "wide | medium | close-up | macro | aerial | etc",
+    "camera_angle": "eye-level | low-angle | high-angle | bird's-eye | dutch-angle | etc"
+  },
+  "lighting": {
+    "type": "natural | studio | ambient | harsh | soft | cinematic | etc",
+    "direction": "front | side | back | top | multiple",
+    "color_temperature": "warm | neutral | cool"
+  },
+  "subjects": [
+    {
+      "type": "person | animal | object | environment feature",
+      "count": 1,
+      "detailed_description": "Highly detailed description of each subject.",
+      "attributes": {
+         "shape": "descriptive shape",
+         "material": "wood | metal | fabric | plastic | etc",
+         "texture": "smooth | rough | glossy | matte | etc",
+         "expressions_or_state": "if applicable (e.g. sealed, opened, worn)"
+      }
+    }
+  ],
+  "overall_mood": "emotionally and atmospherically descriptive phrase",
+  "metadata_confidence": 0.9
+}
+"""
+
+# Wrapper for batched analysis (GeminiService.analyze_images): one of the prompts
+# above is appended and applied to each image of the request.
+GEMINI_BATCH_PROMPT = """
+You will receive {count} separate product images, each preceded by a label "Image <n>:".
+Analyze every image on its own, following the instructions below for each one.
+Return a JSON array with exactly one element per image, in label order:
+{{"image": <n>, "analysis": <the JSON object described below for that image>}}
+"""
@@ -19,12 +19,141 @@ class Settings:
     DEFAULT_IMAGE_WIDTH = 1024
     DEFAULT_IMAGE_HEIGHT = 1024
     MAX_PRODUCT_SIZE_RATIO = 0.6
+    MOCK_TILE_HEIGHT = 256  # rows per strip when rendering mocks tile by tile
+    MOCK_TILED_MIN_PIXELS = 2048 * 2048  # larger mocks render into a memory-mapped canvas
+    MOCK_PNG_COMPRESS_LEVEL = 1  # zlib level for streamed mock PNGs; speed over size
+    MAX_VARIANTS = 4  # renders per vibe requested in one Bria call (num_results)
     
+    # Vibe / Scenario Registry
+    REGISTRY_PATH = os.getenv("REGISTRY_PATH", "config/registry.json")  # vibes/scenarios file; built-ins when absent
+    REGISTRY_RELOAD_INTERVAL = 2.0  # seconds between registry file change checks (0 disables hot reload)
+
+    # Session Resume
+    SESSION_SNAPSHOTS = True  # persist sessions so ?session=<token> resumes after restarts
+
     # API Settings
     BRIA_API_ENDPOINT = "https://engine.prod.bria-api.com/v2/image/generate"
     GEMINI_MODEL = "gemini-flash-lite-latest"
+    # "gemini": full Gemini analysis; "hybrid": Gemini for semantics only, palette/layout
+    # computed locally; "local_only": no Gemini call, reusing semantics of known SKUs
+    ANALYSIS_MODE = os.getenv("ANALYSIS_MODE", "gemini")
+    ANALYSIS_MODES = ("gemini", "hybrid", "local_only")
+    KNOWN_SKU_CACHE_SIZE = 512  # analyses remembered per process for local-only re-runs
+    GEMINI_STREAM_ANALYSIS = True  # stream analyses in the app so fields show up as they arrive
+
+    # Batched Analysis (GeminiService.analyze_images)
+    GEMINI_BATCH_MAX_IMAGES = 8  # images packed into one Gemini request
+    GEMINI_BATCH_IMAGE_SIZE = 768  # longest side sent per image: a single 258-token tile
+    GEMINI_BATCH_MAX_INPUT_TOKENS = 32_000
+    GEMINI_BATCH_MAX_OUTPUT_TOKENS = 8192
+    GEMINI_BATCH_OUTPUT_TOKENS_PER_IMAGE = 1000  # starting estimate, refined from observed usage
+
+    # Model Tiering (analyses start on GEMINI_MODEL and escalate only when the reply is weak)
+    GEMINI_ESCALATION_MODELS = ["gemini-flash-latest", "gemini-2.5-pro"]  # stronger tiers, in order
+    GEMINI_ESCALATION_CONFIDENCE = 0.6  # escalate when metadata_confidence is below this
+    GEMINI_REQUIRED_FIELDS = ("subjects", "global_description", "scene_type", "metadata_confidence")
+
+    # Near-Duplicate Reuse (perceptual hashing)
+    PHASH_MAX_DISTANCE = 6  # max differing bits (of 64) to treat two uploads as the same SKU
+    PHASH_AUTO_REUSE = False  # reuse analyses/assets silently; otherwise the UI offers reuse
+    PHASH_INDEX_MAX_ENTRIES = 100_000
     MAX_POLL_ATTEMPTS = 30
     POLL_INTERVAL = 2  # seconds
+    BRIA_REQUEST_TIMEOUT = 120  # seconds for the generate call
+    BRIA_STATUS_TIMEOUT = 15  # seconds per status poll
+    BRIA_DOWNLOAD_TIMEOUT = 120  # seconds for the result download
+    GENERATION_DEADLINE = 300  # seconds a single generation job may take end to end
+    WORKER_POOL_SIZE = 16  # shared threads running generation jobs off the script thread
+    IMAGE_POOL_SIZE = int(os.getenv("IMAGE_POOL_SIZE", "2"))  # processes for large encode/decode/resize jobs (0 = in-process)
+    IMAGE_POOL_MIN_PIXELS = 1024 * 1024  # smaller images are processed in-process; hand-off would cost more
+    DOWNLOAD_CHUNK_SIZE = 256 * 1024  # bytes per streamed read
+    DOWNLOAD_SPOOL_MAX_BYTES = 8 * 1024 * 1024  # larger downloads spill to a temp file
+    BRIA_RESULT_URL_TTL = 3600  # seconds a returned image_url is assumed to stay valid
+    PREFETCH_FULL_RESULTS = False  # fetch full-res results in the background when no download runs
+
+    # Tail Latency Protection
+    BRIA_HEDGE_ENABLED = False
+    BRIA_HEDGE_PERCENTILE = 0.95  # duplicate a request once it is slower than this quantile
+    BRIA_HEDGE_MIN_SAMPLES = 20  # observed latencies required before hedging kicks in
+    BRIA_HEDGE_MAX_WORKERS = 8
+    BREAKER_ERROR_RATE = 0.5
+    BREAKER_MIN_CALLS = 5
+    BREAKER_WINDOW = 60  # seconds of outcomes considered
+    BREAKER_COOLDOWN = 30  # seconds the circuit stays open before a probe
+    BRIA_BREAKER_FALLBACK_TO_MOCK = True  # serve mock previews instead of failing while open
+
+    # Output Resolution
+    OUTPUT_WIDTH = 7680  # 8K
+    OUTPUT_HEIGHT = 4320
+    PREVIEW_WIDTH = 2048
+    PREVIEW_HEIGHT = 1152
+
+    # Cost & Latency Estimates (per Bria render, by resolution tier)
+    BRIA_RENDER_COST = {"preview": 0.02, "full": 0.04}  # USD
+    BRIA_DEFAULT_RENDER_SECONDS = {"preview": 20.0, "full": 45.0}  # used until latencies are observed
+    CAMPAIGN_MAX_JOBS = 200  # refuse matrices that expand beyond this many unique renders
+    CAMPAIGN_MAX_IN_FLIGHT = 3  # renders of one campaign holding worker-pool threads at once
+    GEMINI_TOKEN_COST = {"input": 0.10, "output": 0.40}  # USD per million tokens
+
+    # Usage Budgets (None or missing = unlimited)
+    # Metrics: "cost" (USD), "full_renders", "gemini_tokens"
+    USAGE_BUDGETS = {
+        "session": {"cost": 5.0, "full_renders": 50},
+        "user": {},
+        "batch": {"cost": 20.0},
+    }
+    BUDGET_EXCEEDED_ACTION = "downgrade"  # "downgrade" to preview renders / local analysis, or "reject"
+    USAGE_LEDGER_MAX_RECORDS = 50_000  # calls kept in memory for export
+
+    # Speculative Pre-generation (opt-in from the sidebar)
+    SPECULATIVE_GENERATION = False  # default state of the sidebar toggle
+    SPECULATION_MAX_RENDERS_PER_SESSION = 3  # spend cap: preview renders started per session
+    SPECULATION_MAX_WORKERS = 4
+    SPECULATION_HISTORY_PATH = os.getenv("SPECULATION_HISTORY_PATH", ".cache/selection_history.json")
+
+    # Outbound Rate Limiting
+    # Token buckets per provider: "rate" is requests/second, "burst" is bucket capacity
+    RATE_LIMITS = {
+        "bria": {"rate": 0.5, "burst": 4},
+        "gemini": {"rate": 2.0, "burst": 10},
+    }
+    # Optional per-API-key overrides: {"<api key>": {"rate": ..., "burst": ...}}
+    RATE_LIMITS_PER_KEY = {}
+    BATCH_RESERVE_FRACTION = 0.25  # share of each bucket kept free for interactive calls
+    RATE_LIMIT_MAX_WAIT = 300  # seconds a call may queue before giving up
+
+    # Shared Cache (analyses, encoded uploads, generated assets, thumbnails)
+    # "sqlite": SQLite index + files in CACHE_DIR, shared by every process on the host
+    # "redis": any Redis-compatible server at REDIS_URL; "memory": per process only
+    CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite")
+    CACHE_DIR = os.getenv("CACHE_DIR", ".cache/shared")
+    CACHE_MAX_BYTES = 2 * 1024 ** 3
+    CACHE_MEMORY_MAX_BYTES = 256 * 1024 ** 2
+    CACHE_INLINE_MAX_BYTES = 64 * 1024  # smaller values are stored in the index itself
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    CACHE_TTLS = {  # seconds
+        "analyses": 7 * 24 * 3600,
+        "uploads": 24 * 3600,
+        "assets": 24 * 3600,
+        "thumbnails": 24 * 3600,
+        "generations": 3600,  # keep within BRIA_RESULT_URL_TTL
+        "sessions": 24 * 3600,  # resumable session snapshots; as long as the uploads they point to
+    }
+    THUMBNAIL_SIZE = 768
+
+    # HTTP Job API (api_server.py)
+    API_PORT = int(os.getenv("API_PORT", "8502"))
+    # Comma-separated bearer tokens; each token is also the client id for fair queuing and usage
+    API_TOKENS = [t.strip() for t in os.getenv("API_TOKENS", "").split(",") if t.strip()]
+    API_JOB_TTL = 3600  # seconds finished jobs stay queryable
+    API_MAX_JOBS = 10_000  # jobs held per process, queued + finished
+    API_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+    API_SSE_KEEPALIVE = 15  # seconds between keep-alive comments on idle event streams
+
+    # Request Coalescing
+    # Set to a shared directory to also coalesce identical generations across worker processes
+    SINGLE_FLIGHT_LOCK_DIR = os.getenv("SINGLE_FLIGHT_LOCK_DIR")
+    SINGLE_FLIGHT_RESULT_TTL = 120  # seconds a finished result is shared across processes
     
     @classmethod
     def has_api_keys(cls) -> bool:
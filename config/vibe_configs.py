@@ -102,3 +102,11 @@ VIBE_CONFIGS: Dict[str, Dict[str, Any]] = {
         }
     }
 }
+
+# Camera angles offered for the marketplace vibe
+MARKETPLACE_CAMERA_ANGLES = [
+    {"label": "Eye Level", "image_path": "assets/angles/eye_level.jpg", "value": "eye_level"},
+    {"label": "Low Angle", "image_path": "assets/angles/low_angle.jpg", "value": "low_angle"},
+    {"label": "High Angle", "image_path": "assets/angles/high_angle.jpg", "value": "high_angle"},
+    {"label": "Bird's Eye", "image_path": "assets/angles/birds_eye.jpg", "value": "birds_eye"},
+]
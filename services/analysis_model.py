@@ -0,0 +1,140 @@
+from typing import Dict, Any, Optional, Tuple
+from pydantic import BaseModel, ConfigDict, PrivateAttr, field_validator
+
+
+def _as_text(value: Any) -> str:
+    return value if isinstance(value, str) else ("" if value is None else str(value))
+
+
+class AnalysisSubject(BaseModel):
+    """One analyzed subject; fields the prompts use are typed, the rest kept as-is"""
+
+    model_config = ConfigDict(frozen=True, extra="allow")
+
+    detailed_description: str = ""
+    primary_colors: Tuple[str, ...] = ()
+    material: Optional[str] = None
+
+    @field_validator("detailed_description", mode="before")
+    @classmethod
+    def _text(cls, value: Any) -> str:
+        return _as_text(value)
+
+    @field_validator("primary_colors", mode="before")
+    @classmethod
+    def _colors(cls, value: Any) -> Tuple[str, ...]:
+        if isinstance(value, str):
+            return (value,)
+        if not isinstance(value, (list, tuple)):
+            return ()
+        return tuple(_as_text(color) for color in value)
+
+    @field_validator("material", mode="before")
+    @classmethod
+    def _material(cls, value: Any) -> Optional[str]:
+        return None if value is None else _as_text(value)
+
+    def prompt_text(self) -> str:
+        text = self.detailed_description
+        if self.primary_colors:
+            text += f" Primary colors are {', '.join(self.primary_colors)}."
+        if self.material:
+            text += f" Made of {self.material}."
+        return text
+
+
+class Lighting(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="allow")
+
+    type: Optional[str] = None
+
+
+class ImageAnalysis(BaseModel):
+    """
+    An image analysis, validated once when it is parsed and then shared
+    read-only by sessions, caches and prompt building.
+
+    Fields read on hot paths are typed attributes; everything else Gemini
+    returns is kept as extra fields, so to_dict() gives back the full
+    analysis. The subject prompt and the normalized subject text used for
+    scenario matching are computed once, at parse time.
+    """
+
+    model_config = ConfigDict(frozen=True, extra="allow")
+
+    subjects: Tuple[AnalysisSubject, ...] = ()
+    global_description: str = ""
+    scene_type: Optional[str] = None
+    lighting: Lighting = Lighting()
+    metadata_confidence: Optional[float] = None
+    local_metrics: Optional[Dict[str, Any]] = None
+    analysis_source: Optional[str] = None
+    budget_downgraded: bool = False
+    near_duplicate_distance: Optional[int] = None
+    analysis_model: Optional[str] = None
+    model_tier: Optional[int] = None
+
+    _subject_prompt: str = PrivateAttr("the product")
+    _subject_text: str = PrivateAttr("")
+
+    @field_validator("subjects", mode="before")
+    @classmethod
+    def _subjects(cls, value: Any):
+        if not isinstance(value, (list, tuple)):
+            return ()
+        return tuple(subject for subject in value if isinstance(subject, (dict, AnalysisSubject)))
+
+    @field_validator("global_description", mode="before")
+    @classmethod
+    def _description(cls, value: Any) -> str:
+        return _as_text(value)
+
+    @field_validator("scene_type", mode="before")
+    @classmethod
+    def _scene_type(cls, value: Any) -> Optional[str]:
+        return None if value is None else _as_text(value)
+
+    @field_validator("lighting", mode="before")
+    @classmethod
+    def _lighting(cls, value: Any):
+        return value if isinstance(value, (dict, Lighting)) else {}
+
+    @field_validator("metadata_confidence", mode="before")
+    @classmethod
+    def _confidence(cls, value: Any) -> Optional[float]:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def model_post_init(self, context: Any):
+        if self.subjects:
+            self._subject_prompt = " ".join(subject.prompt_text() for subject in self.subjects)
+            self._subject_text = " ".join(self.subjects[0].detailed_description.lower().split())
+
+    @property
+    def subject_prompt(self) -> str:
+        """Subject description assembled from every analyzed subject"""
+        return self._subject_prompt
+
+    @property
+    def subject_text(self) -> str:
+        """First subject's description, lower-cased and whitespace-normalized, for keyword matching"""
+        return self._subject_text
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ImageAnalysis":
+        """Parse and validate a raw analysis (e.g. Gemini's JSON merged with local fields)"""
+        return cls.model_validate(data)
+
+    @classmethod
+    def from_json(cls, data: bytes) -> "ImageAnalysis":
+        return cls.model_validate_json(data)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain JSON-compatible form, e.g. for display or the HTTP API"""
+        return self.model_dump(mode="json", exclude_none=True)
+
+    def to_json(self) -> bytes:
+        """Compact JSON for caches and snapshots"""
+        return self.model_dump_json(exclude_none=True).encode()
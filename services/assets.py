@@ -0,0 +1,367 @@
+import io
+import json
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple, Union
+from PIL import Image
+import requests
+
+from config.settings import Settings
+from services.cache_backend import ASSETS, get_cache
+from services.image_service import ImageService
+from utils.cancellation import CancellationToken
+
+_MAGIC_MIME_TYPES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+)
+
+
+class GeneratedAsset:
+    """
+    Encoded image bytes exactly as served by the provider.
+
+    The bytes live in a spooled temp file (in memory up to
+    DOWNLOAD_SPOOL_MAX_BYTES, on disk beyond), so large outputs are never held
+    as one big Python bytes object while downloading. The raster is only
+    decoded when `.image` is first accessed; display and download use the
+    original encoded bytes directly.
+    """
+
+    def __init__(self, spool, mime_type: str, source_url: Optional[str] = None):
+        self._spool = spool
+        self._lock = threading.Lock()
+        self._image: Optional[Image.Image] = None
+        self.mime_type = mime_type
+        self.source_url = source_url
+        self.nbytes = spool.seek(0, io.SEEK_END)
+
+    @classmethod
+    def download(
+        cls, url: str, timeout: float = None, cancel_token: Optional[CancellationToken] = None
+    ) -> "GeneratedAsset":
+        """Stream `url` into a spooled temp file in fixed-size chunks, checking for cancellation between chunks"""
+        cancel_token = cancel_token or CancellationToken()
+        timeout = cancel_token.clamp(timeout or Settings.BRIA_DOWNLOAD_TIMEOUT)
+        spool = tempfile.SpooledTemporaryFile(max_size=Settings.DOWNLOAD_SPOOL_MAX_BYTES)
+        with requests.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=Settings.DOWNLOAD_CHUNK_SIZE):
+                if cancel_token.is_set():
+                    spool.close()
+                    cancel_token.raise_if_cancelled()
+                spool.write(chunk)
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+
+        spool.seek(0)
+        mime_type = cls._sniff_mime_type(spool.read(16)) or content_type or "application/octet-stream"
+        return cls(spool, mime_type, source_url=url)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, mime_type: Optional[str] = None) -> "GeneratedAsset":
+        spool = tempfile.SpooledTemporaryFile(max_size=Settings.DOWNLOAD_SPOOL_MAX_BYTES)
+        spool.write(data)
+        return cls(spool, mime_type or cls._sniff_mime_type(data[:16]) or "application/octet-stream")
+
+    @classmethod
+    def from_image(cls, image: Image.Image, format: str = "PNG") -> "GeneratedAsset":
+        """Wrap a locally rendered image (e.g. a mock preview)"""
+        spool = tempfile.SpooledTemporaryFile(max_size=Settings.DOWNLOAD_SPOOL_MAX_BYTES)
+        image.save(spool, format=format)
+        asset = cls(spool, Image.MIME.get(format.upper(), "image/png"))
+        asset._image = image
+        return asset
+
+    @classmethod
+    def from_mock(cls, vibe_name: str, product_image: Image.Image, resolution: Tuple[int, int]) -> "GeneratedAsset":
+        """Render a mock preview straight into the spool as a strip-encoded PNG"""
+        spool = tempfile.SpooledTemporaryFile(max_size=Settings.DOWNLOAD_SPOOL_MAX_BYTES)
+        ImageService.render_mock(vibe_name, product_image, spool, *resolution)
+        return cls(spool, "image/png")
+
+    @staticmethod
+    def _sniff_mime_type(header: bytes) -> Optional[str]:
+        for magic, mime_type in _MAGIC_MIME_TYPES:
+            if header.startswith(magic):
+                return mime_type
+        if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+            return "image/webp"
+        return None
+
+    @property
+    def extension(self) -> str:
+        return {"image/jpeg": "jpg", "image/webp": "webp", "image/gif": "gif"}.get(self.mime_type, "png")
+
+    def getvalue(self) -> bytes:
+        """The original encoded bytes, ready for st.image or a download button"""
+        with self._lock:
+            self._spool.seek(0)
+            return self._spool.read()
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """Pixel dimensions, read from the header without decoding the raster"""
+        if self._image is not None:
+            return self._image.size
+        with self._lock:
+            self._spool.seek(0)
+            with Image.open(self._spool) as header:
+                return header.size
+
+    @property
+    def image(self) -> Image.Image:
+        """Decoded PIL Image, decoded on first access and then kept"""
+        with self._lock:
+            if self._image is None:
+                self._spool.seek(0)
+                image = Image.open(self._spool)
+                image.load()
+                self._image = image
+            return self._image
+
+    def read_chunk(self, offset: int, size: int) -> bytes:
+        """Up to `size` encoded bytes from `offset`; the lock is held only for this read"""
+        with self._lock:
+            self._spool.seek(offset)
+            return self._spool.read(size)
+
+    @contextmanager
+    def reader(self):
+        """The encoded file positioned at its start, held exclusively while in use"""
+        with self._lock:
+            self._spool.seek(0)
+            yield self._spool
+
+    def close(self):
+        with self._lock:
+            self._image = None
+            self._spool.close()
+
+
+class ResultExpiredError(Exception):
+    """Raised when a remote result is accessed after its URL has expired"""
+
+
+class RemoteResult:
+    """
+    Handle to a generated image that still lives on the provider's CDN.
+
+    Holds the image URL, provider metadata and expiry. Previews come from a
+    provider thumbnail if one was returned, otherwise from a small JPEG made
+    when the result arrives (`fetch_preview()`); the browser never receives the
+    full file just to show it. The handle itself only loads the full-resolution
+    file on first access through `fetch()` - e.g. when the user asks to
+    download it.
+
+    A request for several renders (num_results > 1) yields a variant set:
+    one handle per render, all sharing the same `variants` list. Whichever
+    handle is kept is the selected one; serializing it keeps the whole set.
+    """
+
+    def __init__(
+        self,
+        image_url: Optional[str],
+        metadata: Optional[Dict[str, Any]] = None,
+        expires_at: Optional[float] = None,
+        preview_url: Optional[str] = None,
+    ):
+        self.image_url = image_url
+        self.metadata = metadata or {}
+        self.expires_at = expires_at
+        self.preview_url = preview_url
+        self.variants: List["RemoteResult"] = [self]
+        self._asset: Optional[GeneratedAsset] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def variant_set(handles: List["RemoteResult"]) -> "RemoteResult":
+        """Link the renders of one request into a variant set; returns the first"""
+        for handle in handles:
+            handle.variants = handles
+        return handles[0]
+
+    @classmethod
+    def from_asset(cls, asset: GeneratedAsset, metadata: Optional[Dict[str, Any]] = None) -> "RemoteResult":
+        """Wrap an already available asset (e.g. a local mock preview) in a resolved handle"""
+        handle = cls(asset.source_url, metadata)
+        handle._asset = asset
+        return handle
+
+    @property
+    def is_fetched(self) -> bool:
+        return self._asset is not None
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+    @property
+    def preview_source(self) -> Optional[Union[str, bytes]]:
+        """Something small st.image can render: a thumbnail URL or JPEG bytes (None if unavailable)"""
+        if self._asset is not None and not self.image_url:
+            return self._asset.getvalue()  # local mock, already small
+        if self.preview_url and self._asset is None:
+            return self.preview_url
+        # Never ship the full 8K file to the browser just to show it
+        try:
+            return self.fetch_preview()
+        except Exception as e:
+            print(f"No preview for {self.image_url}: {e}")
+            return None
+
+    def fetch_preview(self, cancel_token: Optional[CancellationToken] = None) -> bytes:
+        """
+        Small JPEG of this result, made once and shared through the cache.
+
+        Bria returns no thumbnail, so one is derived from the full file. That
+        download is kept in the shared asset cache, where a later `fetch()`
+        finds it, but not in this handle: it stays unfetched and light.
+        """
+        cached = ImageService.cached_thumbnail(self.image_url)
+        if cached is not None:
+            return cached
+        if self._asset is not None:
+            with self._asset.reader() as encoded:
+                return ImageService.thumbnail_bytes(self.image_url, encoded)
+
+        cache = get_cache()
+        data = cache.get(ASSETS, self.image_url)
+        if data is not None:
+            return ImageService.thumbnail_bytes(self.image_url, io.BytesIO(data))
+        if self.expired:
+            raise ResultExpiredError("The generated image link has expired; please regenerate it")
+        with _bandwidth.track(True):
+            asset = GeneratedAsset.download(self.image_url, cancel_token=cancel_token)
+        try:
+            with asset.reader() as encoded:
+                cache.set_stream(ASSETS, self.image_url, encoded)
+                encoded.seek(0)
+                return ImageService.thumbnail_bytes(self.image_url, encoded)
+        finally:
+            asset.close()
+
+    def fetch_variants(self, cancel_token: Optional[CancellationToken] = None) -> List[GeneratedAsset]:
+        """Download every variant of the set concurrently, so switching between them needs no further fetch"""
+        pending = [variant for variant in self.variants if not variant.is_fetched]
+        if len(pending) > 1:
+            with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="variant-fetch") as pool:
+                list(pool.map(lambda variant: variant.fetch(cancel_token=cancel_token), pending))
+        return [variant.fetch(cancel_token=cancel_token) for variant in self.variants]
+
+    def fetch(self, foreground: bool = True, cancel_token: Optional[CancellationToken] = None) -> GeneratedAsset:
+        """Download the full-resolution file on first access, then reuse it"""
+        with self._lock:
+            if self._asset is None:
+                # Another worker process may already have downloaded it
+                cache = get_cache()
+                cached = cache.get(ASSETS, self.image_url) if self.image_url else None
+                if cached is not None:
+                    self._asset = GeneratedAsset.from_bytes(cached)
+                    self._asset.source_url = self.image_url
+                    return self._asset
+
+                if self.expired:
+                    raise ResultExpiredError("The generated image link has expired; please regenerate it")
+                with _bandwidth.track(foreground):
+                    self._asset = GeneratedAsset.download(self.image_url, cancel_token=cancel_token)
+                with self._asset.reader() as encoded:
+                    cache.set_stream(ASSETS, self.image_url, encoded)
+            return self._asset
+
+    def _fields(self) -> Dict[str, Any]:
+        return {
+            "image_url": self.image_url,
+            "metadata": self.metadata,
+            "expires_at": self.expires_at,
+            "preview_url": self.preview_url,
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """URL + metadata, plus the other variants and which one this is when part of a set"""
+        data = self._fields()
+        if len(self.variants) > 1:
+            data["variants"] = [variant._fields() for variant in self.variants]
+            data["selected"] = self.variants.index(self)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RemoteResult":
+        if not data.get("variants"):
+            return cls(**{key: value for key, value in data.items() if key != "selected"})
+        handles = [cls(**fields) for fields in data["variants"]]
+        cls.variant_set(handles)
+        return handles[data.get("selected", 0)]
+
+    def to_bytes(self) -> bytes:
+        """Compact serialized form (URL + metadata), e.g. for cross-process sharing"""
+        return json.dumps(self.to_dict()).encode()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "RemoteResult":
+        return cls.from_dict(json.loads(data))
+
+
+class _BandwidthMonitor:
+    """Counts foreground downloads so background prefetch can yield to them"""
+
+    def __init__(self):
+        self._active = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def track(self, foreground: bool):
+        if not foreground:
+            yield
+            return
+        with self._cond:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def wait_until_idle(self):
+        with self._cond:
+            while self._active:
+                self._cond.wait()
+
+
+_bandwidth = _BandwidthMonitor()
+
+
+class ResultPrefetcher:
+    """Background worker that fetches full-resolution results while no foreground download runs"""
+
+    def __init__(self):
+        self._queue: "queue.Queue[RemoteResult]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, handle: RemoteResult):
+        if not Settings.PREFETCH_FULL_RESULTS or handle.is_fetched:
+            return
+        self._queue.put(handle)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="result-prefetch", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            handle = self._queue.get()
+            _bandwidth.wait_until_idle()
+            if not handle.is_fetched and not handle.expired:
+                try:
+                    handle.fetch(foreground=False)
+                except Exception as e:
+                    print(f"Prefetch failed for {handle.image_url}: {e}")
+
+
+prefetcher = ResultPrefetcher()
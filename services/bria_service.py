@@ -1,71 +1,144 @@
 import base64
-import io
 import time
-from typing import Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple
 from PIL import Image
 import requests
 from config.settings import Settings
-from config.vibe_configs import VIBE_CONFIGS
-from config.consumption_data import CONSUMPTION_SCENARIOS
+from services.rate_limiter import get_scheduler, PRIORITY_INTERACTIVE
+from services.single_flight import SingleFlight, payload_key
+from services.analysis_model import ImageAnalysis
+from services.image_service import ImageService
+from services.assets import GeneratedAsset, RemoteResult, prefetcher
+from services.phash_index import get_phash_index
+from services.cache_backend import GENERATIONS, get_cache
+from services.prompt_compiler import get_prompt_compiler
+from services.usage_ledger import UsageLedger, BudgetExceeded, RenderReservation, get_usage_ledger
+from services.resilience import CircuitBreaker, CircuitOpenError, LatencyTracker, hedged_call
+from utils.cancellation import CancellationToken, CancelledError, DeadlineExceeded
+
+# Shared by every session in this process so identical renders run only once
+_generation_flights = SingleFlight(Settings.SINGLE_FLIGHT_LOCK_DIR, Settings.SINGLE_FLIGHT_RESULT_TTL)
+
+# Process-wide view of Bria health, used for hedging and fail-fast decisions
+_latency = LatencyTracker()
+_breaker = CircuitBreaker(
+    error_rate=Settings.BREAKER_ERROR_RATE,
+    min_calls=Settings.BREAKER_MIN_CALLS,
+    window=Settings.BREAKER_WINDOW,
+    cooldown=Settings.BREAKER_COOLDOWN,
+)
+# Render times per resolution tier, used for campaign estimates
+_tier_latency = {"preview": LatencyTracker(), "full": LatencyTracker()}
+_hedge_executor = ThreadPoolExecutor(max_workers=Settings.BRIA_HEDGE_MAX_WORKERS, thread_name_prefix="bria-hedge")
 
 
 class BriaService:
     """Service for interacting with Bria FIBO API"""
 
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        session_id: Optional[str] = None,
+        priority: str = PRIORITY_INTERACTIVE,
+        user_id: Optional[str] = None,
+        batch_id: Optional[str] = None,
+    ):
         self.api_key = api_key
+        self.session_id = session_id
+        self.priority = priority
+        self.usage_scope = UsageLedger.scope(session_id, user_id, batch_id)
         self.headers = {"api_token": api_key, "Content-Type": "application/json"}
 
     def generate_image(
-        self, image: Image.Image, vibe_name: str, image_analysis: Dict[str, Any], specific_config: Optional[Dict[str, Any]] = None
-    ) -> Optional[Image.Image]:
+        self,
+        image: Image.Image,
+        vibe_name: str,
+        image_analysis: ImageAnalysis,
+        specific_config: Optional[Dict[str, Any]] = None,
+        resolution: Optional[Tuple[int, int]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        variants: int = 1,
+        image_digest: Optional[str] = None,
+    ) -> Optional[RemoteResult]:
         """
         Generate image using Bria FIBO API with analyzed context
+
+        Returns a RemoteResult handle; the full-resolution file is only fetched on first access.
+        `resolution` overrides the 8K output size, e.g. for previews.
+        `variants` > 1 asks for that many renders in the same call (up to MAX_VARIANTS);
+        they come back as the handle's variant set.
+        `cancel_token` stops queueing/polling early and bounds the job by its deadline
+        (GENERATION_DEADLINE when not given).
+        `image_digest` is the caller's ImageService.image_digest of `image`, if it already has one.
         """
+        cancel_token = cancel_token or CancellationToken(timeout=Settings.GENERATION_DEADLINE)
+        variants = max(1, min(variants, Settings.MAX_VARIANTS))
         try:
-            # Convert image to base64
-            img_base64 = self._image_to_base64(image)
-            
-            # UNPACK 3 VALUES NOW
-            prompt, structure_lock, negative_prompt = self._construct_payload_params(
-                vibe_name, image_analysis, specific_config
-            )
+            cancel_token.raise_if_cancelled()
 
-            # Build API payload
-            payload = {
-                "prompt": prompt,
-                "num_results": 1,
-                "width": 7680, # Keep 8K resolution
-                "height": 4320, # Keep 8K resolution
-                "structure_guidance_scale": structure_lock, 
-                "sync": True,
-                "negative_prompt": negative_prompt # <--- SEND IT HERE
-            }
-            
-            print("=== FINAL PAYLOAD BEING SENT TO BRIA ===")
-            print(payload)
-            print("=" * 50)
-
-            # Make API request
-            response = requests.post(
-                Settings.BRIA_API_ENDPOINT,
-                headers=self.headers,
-                json=payload,
-                timeout=120,
+            # Over-budget requests are rejected or downgraded to preview resolution
+            requested = resolution or (Settings.OUTPUT_WIDTH, Settings.OUTPUT_HEIGHT)
+            reservation = get_usage_ledger().admit_render(
+                self.usage_scope, requested, self.resolution_tier(*requested), variants
             )
 
-            response.raise_for_status()
-            result = response.json()
-
-            # Handle async response if needed
-            if result.get("status") == "IN_PROGRESS":
-                result = self._poll_for_completion(result)
-                if not result:
-                    return None
-
-            # Extract and download image
-            return self._extract_generated_image(result)
-
+            # Reuse and coalesced followers spend nothing: the reservation is released
+            try:
+                digest = image_digest or ImageService.image_digest(image)
+
+                # Build API payload
+                payload = self.build_payload(
+                    vibe_name, image_analysis, specific_config, reservation.resolution, num_results=variants
+                )
+
+                # The same payload already rendered for a near-duplicate upload
+                index, asset_key = get_phash_index(), payload_key(payload, "")
+                if Settings.PHASH_AUTO_REUSE:
+                    reused = index.find_asset(image, asset_key)
+                    if reused is not None:
+                        return reused
+
+                # Already rendered by any worker process on this host
+                generation_key = payload_key(payload, digest)
+                cached = get_cache().get(GENERATIONS, generation_key)
+                if cached is not None:
+                    handle = RemoteResult.from_bytes(cached)
+                    if not handle.expired:
+                        return handle
+
+                # Identical concurrent requests (any session) attach to the running job
+                result = _generation_flights.do(
+                    generation_key,
+                    lambda job_token: self._render(payload, job_token, reservation),
+                    serialize=lambda handle: handle.to_bytes(),
+                    deserialize=RemoteResult.from_bytes,
+                    cancel_token=cancel_token,
+                )
+                if result is not None:
+                    if reservation.downgraded:
+                        for variant in result.variants:
+                            variant.metadata["budget_downgraded"] = True
+                    index.record_asset(digest, asset_key, result)
+                    if result.image_url and result.expires_at:
+                        ttl = min(Settings.CACHE_TTLS[GENERATIONS], result.expires_at - time.time())
+                        if ttl > 0:
+                            get_cache().set(GENERATIONS, generation_key, result.to_bytes(), ttl=ttl)
+                return result
+            finally:
+                get_usage_ledger().release(reservation)
+
+        except (CancelledError, BudgetExceeded):
+            raise
+        except CircuitOpenError:
+            # Bria is unhealthy and nothing cached could serve this request
+            if not Settings.BRIA_BREAKER_FALLBACK_TO_MOCK:
+                raise
+            # Same size as the requested render; encoded strip by strip, so 8K stays cheap
+            mock = GeneratedAsset.from_mock(
+                vibe_name, image, resolution or (Settings.OUTPUT_WIDTH, Settings.OUTPUT_HEIGHT)
+            )
+            return RemoteResult.from_asset(mock, {"mock": True})
         except requests.exceptions.HTTPError as e:
             error_msg = f"Bria API HTTP Error: {e}"
             if hasattr(e, "response") and e.response is not None:
@@ -79,123 +152,166 @@ class BriaService:
             raise Exception(f"Bria Generation Error: {str(e)}")
 
 
+    def build_payload(
+        self,
+        vibe_name: str,
+        image_analysis: ImageAnalysis,
+        specific_config: Optional[Dict[str, Any]] = None,
+        resolution: Optional[Tuple[int, int]] = None,
+        num_results: int = 1,
+    ) -> Dict[str, Any]:
+        """Exact request body Bria receives for this vibe configuration"""
+        # UNPACK 3 VALUES NOW
+        prompt, structure_lock, negative_prompt = self._construct_payload_params(
+            vibe_name, image_analysis, specific_config
+        )
+        width, height = resolution or (Settings.OUTPUT_WIDTH, Settings.OUTPUT_HEIGHT)
+        return {
+            "prompt": prompt,
+            "num_results": num_results,
+            "width": width,
+            "height": height,
+            "structure_guidance_scale": structure_lock,
+            "sync": True,
+            "negative_prompt": negative_prompt # <--- SEND IT HERE
+        }
+
+    @staticmethod
+    def resolution_tier(width: int, height: int) -> str:
+        """"full" for the configured output size and above, "preview" for anything smaller"""
+        return "full" if width * height >= Settings.OUTPUT_WIDTH * Settings.OUTPUT_HEIGHT else "preview"
+
+    @staticmethod
+    def expected_latency(tier: str) -> float:
+        """Median observed render time for a resolution tier, or the configured default"""
+        observed = _tier_latency[tier].percentile(0.5)
+        return observed if observed is not None else Settings.BRIA_DEFAULT_RENDER_SECONDS[tier]
+
+    def _render(
+        self, payload: Dict[str, Any], cancel_token: CancellationToken, reservation: Optional[RenderReservation] = None
+    ) -> Optional[RemoteResult]:
+        """Submit the payload, then make the small previews the page shows in place of the full files"""
+        result = self._submit_guarded(payload, cancel_token, reservation)
+        if result is None:
+            return None
+        for variant in result.variants:
+            if not variant.image_url or variant.preview_url:
+                continue
+            try:
+                variant.fetch_preview(cancel_token)
+            except CancelledError:
+                raise
+            except Exception as e:
+                # The render itself succeeded; the page retries the preview when it shows it
+                print(f"Preview not prepared for {variant.image_url}: {e}")
+        return result
+
+    def _submit_guarded(
+        self, payload: Dict[str, Any], cancel_token: CancellationToken, reservation: Optional[RenderReservation] = None
+    ) -> Optional[RemoteResult]:
+        """Submit with optional hedging, feeding latency and outcomes to the breaker and usage ledger"""
+        # Fail fast while Bria is unhealthy; checked only right before a real call, so a
+        # half-open probe granted here always reports back below
+        if not _breaker.allow():
+            raise CircuitOpenError("Bria is failing repeatedly; circuit open, try again shortly")
+
+        hedge_after = None
+        if Settings.BRIA_HEDGE_ENABLED:
+            hedge_after = _latency.percentile(Settings.BRIA_HEDGE_PERCENTILE, Settings.BRIA_HEDGE_MIN_SAMPLES)
+
+        started = time.monotonic()
+        try:
+            result = hedged_call(
+                lambda attempt_token: self._submit(payload, attempt_token), hedge_after, _hedge_executor, cancel_token
+            )
+        except Exception as e:
+            if self._counts_as_failure(e):
+                _breaker.record_failure()
+            if reservation is not None:
+                outcome = "cancelled" if isinstance(e, CancelledError) else "error"
+                get_usage_ledger().settle_render(reservation, time.monotonic() - started, outcome)
+            raise
+        elapsed = time.monotonic() - started
+        _latency.record(elapsed)
+        _tier_latency[self.resolution_tier(payload["width"], payload["height"])].record(elapsed)
+        _breaker.record_success()
+        if reservation is not None:
+            get_usage_ledger().settle_render(reservation, elapsed, "ok" if result is not None else "error")
+        return result
+
+    @staticmethod
+    def _counts_as_failure(error: Exception) -> bool:
+        """Client-side 4xx errors (other than 429) and user cancellations say nothing about Bria health"""
+        if isinstance(error, CancelledError):
+            return isinstance(error, DeadlineExceeded)
+        if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+            status = error.response.status_code
+            return status == 429 or status >= 500
+        return True
+
+    def _submit(self, payload: Dict[str, Any], cancel_token: CancellationToken) -> Optional[RemoteResult]:
+        """Send the payload to Bria and wait for completion"""
+        # Make API request (queued behind the shared Bria rate limit)
+        with get_scheduler().acquire(
+            "bria", self.api_key, self.session_id, self.priority, cancel_token=cancel_token
+        ):
+            response = requests.post(
+                Settings.BRIA_API_ENDPOINT,
+                headers=self.headers,
+                json=payload,
+                timeout=cancel_token.clamp(Settings.BRIA_REQUEST_TIMEOUT),
+            )
+
+        if response.status_code == 429:
+            get_scheduler().report_throttled("bria", self.api_key, self._retry_after(response))
+        response.raise_for_status()
+        result = response.json()
+
+        # Handle async response if needed
+        if result.get("status") == "IN_PROGRESS":
+            result = self._poll_for_completion(result, cancel_token)
+            if not result:
+                return None
+
+        # Cancelled (or a hedged duplicate already won) while the call was in flight
+        cancel_token.raise_if_cancelled()
+
+        # Extract a lazy handle to the generated image
+        return self._extract_generated_image(result)
+
     def _construct_payload_params(
         self,
         vibe_name: str,
-        image_analysis: Dict[str, Any],
+        image_analysis: ImageAnalysis,
         specific_config: Optional[Dict[str, Any]]
     ):
         """
         Builds the prompt, determines structure lock, AND SANITIZES TEXT.
-        """
 
-        # --- A. SUBJECT EXTRACTION ---
-        try:
-            # Use a more robust subject extraction
-            subjects = image_analysis.get("subjects", [])
-            if subjects:
-                all_subject_details = []
-                for subject in subjects:
-                    desc = subject.get('detailed_description', '')
-                    colors = subject.get('primary_colors')
-                    if colors:
-                        desc += f" Primary colors are {', '.join(colors)}."
-                    material = subject.get('material')
-                    if material:
-                        desc += f" Made of {material}."
-                    all_subject_details.append(desc)
-                subject_prompt = " ".join(all_subject_details)
-            else:
-                subject_prompt = "the product"
-        except Exception:
-            subject_prompt = "the product"
-
-        # --- B. CONFIG LOADING ---
-        base_payload = VIBE_CONFIGS.get(vibe_name, {}).get("payload", {})
-        structure_lock = base_payload.get("structure_lock", 0.9)
-        camera_instruction = ""
-        prompt_modifier = ""
-        negative_prompt = base_payload.get("negative_prompt", "")  # Get base negative
-
-        # --- C. SCENARIO & CONFIG APPLICATION (THE FIX) ---
-        scenario_id = ""
-        if specific_config:
-            # Correctly get scenario_id from the specific_config dictionary
-            scenario_id = specific_config.get("scenario_id", "").lower()
-
-            # If we have a scenario, find its data in CONSUMPTION_SCENARIOS
-            if scenario_id:
-                found_scenario = False
-                for category, scenarios in CONSUMPTION_SCENARIOS.items():
-                    if isinstance(scenarios, list):
-                        for scenario in scenarios:
-                            if scenario.get("id") == scenario_id:
-                                # Apply scenario-specific prompt and negative prompt
-                                if "prompt_modifier" in scenario:
-                                    prompt_modifier = scenario["prompt_modifier"]
-                                if "negative_prompt" in scenario:
-                                    negative_prompt += ", " + scenario["negative_prompt"]
-                                
-                                found_scenario = True
-                                break # Exit inner loop once scenario is found
-                    if found_scenario:
-                        break # Exit outer loop as well
-                
-            # Apply Camera Instruction (if any)
-            if "camera_prompt" in specific_config:
-                camera_instruction = specific_config["camera_prompt"]
-            elif "camera_angle" in specific_config: # Fallback for old key
-                 camera_instruction = f"Use a {specific_config['camera_angle'].replace('_', ' ')} camera angle."
-
-
-            # Apply Structure Lock Override (if any)
-            if "structure_lock" in specific_config:
-                structure_lock = specific_config["structure_lock"]
-
-        # --- D. SANITIZATION (Cap Stripper) ---
-        if scenario_id and ("drinking" in scenario_id or "open" in scenario_id or "pouring" in scenario_id):
-            # Force Open State
-            subject_prompt = subject_prompt.replace("sealed", "opened")
-            subject_prompt = subject_prompt.replace("closed", "opened")
-            subject_prompt = subject_prompt.replace("cap", "")
-            subject_prompt = subject_prompt.replace("lid", "")
-            subject_prompt = subject_prompt.replace("cork", "")
-            # Prepend the "opened" state for clarity
-            if "bottle" in subject_prompt.lower():
-                subject_prompt = "opened bottle of " + subject_prompt
-            elif "can" in subject_prompt.lower():
-                subject_prompt = "opened can of " + subject_prompt
-            else:
-                subject_prompt = "opened " + subject_prompt
-            
-            subject_prompt += ", opened neck, liquid visible at rim"
-
-        # --- E. PROMPT ASSEMBLY ---
-        bg_prompt = base_payload.get("background_prompt", "clean background")
-        atmosphere = base_payload.get("atmosphere", "")
-        quality_booster = "ultra-realistic, 8k resolution, cinematic lighting, professional marketing photograph."
-
-        # Assemble the full prompt from all pieces
-        full_prompt = f"{subject_prompt}. {prompt_modifier} {camera_instruction} {bg_prompt}. {atmosphere} {quality_booster}"
-        # Clean up extra spaces
-        full_prompt = " ".join(full_prompt.split())
-
-        return full_prompt, structure_lock, negative_prompt    
+        Templates are precompiled per vibe x scenario x camera angle and the
+        subject text is memoized, so this is a lookup plus one concatenation.
+        """
+        return get_prompt_compiler().build(vibe_name, image_analysis, specific_config)
 
    
    
 
-    def _poll_for_completion(self, initial_result: Dict) -> Optional[Dict]:
-        """Poll Bria API until image generation is complete"""
+    def _poll_for_completion(
+        self, initial_result: Dict, cancel_token: Optional[CancellationToken] = None
+    ) -> Optional[Dict]:
+        """Poll Bria API until image generation is complete (or the attempt is cancelled)"""
         request_id = initial_result.get("request_id")
         if not request_id:
             return None
+        cancel_token = cancel_token or CancellationToken()
         for _ in range(Settings.MAX_POLL_ATTEMPTS):
-            time.sleep(Settings.POLL_INTERVAL)
+            if cancel_token.wait(Settings.POLL_INTERVAL):
+                cancel_token.raise_if_cancelled()
 
             response = requests.get(
                 f"{Settings.BRIA_API_ENDPOINT.rsplit('/', 2)[0]}/status/{request_id}",
                 headers=self.headers,
+                timeout=cancel_token.clamp(Settings.BRIA_STATUS_TIMEOUT),
             )
             status_data = response.json()
             if status_data.get("status") == "COMPLETED":
@@ -206,35 +322,47 @@ class BriaService:
 
         raise Exception("Generation timeout: max polling attempts reached")
 
-    def _extract_generated_image(self, result: Dict) -> Optional[Image.Image]:
-        """Extract and download generated image from API result"""
+    def _extract_generated_image(self, result: Dict) -> Optional[RemoteResult]:
+        """Extract lazy handles to the generated images from the API result (a variant set when several)"""
         if "result" not in result:
             raise Exception("Unexpected response format: no 'result' field")
 
         # Handle different result formats
         result_data = result["result"]
-        image_url = None
-
-        if isinstance(result_data, dict) and "image_url" in result_data:
-            image_url = result_data["image_url"]
-        elif isinstance(result_data, list) and len(result_data) > 0:
-            image_url = result_data[0].get("image_url")
-
-        if not image_url:
+        renders = result_data if isinstance(result_data, list) else [result_data]
+        renders = [r for r in renders if isinstance(r, dict) and r.get("image_url")]
+        if not renders:
             raise Exception("Could not find image URL in response")
 
-        # Download image
-        img_response = requests.get(image_url)
-        img_response.raise_for_status()
+        # Nothing is downloaded here; the full files are fetched on first access
+        expires_at = time.time() + Settings.BRIA_RESULT_URL_TTL
+        handles = []
+        for render in renders:
+            metadata = {k: v for k, v in render.items() if k not in ("image_url", "thumbnail_url")}
+            if result.get("request_id"):
+                metadata["request_id"] = result["request_id"]
+            handle = RemoteResult(
+                render["image_url"],
+                metadata=metadata,
+                expires_at=expires_at,
+                preview_url=render.get("thumbnail_url"),
+            )
+            prefetcher.enqueue(handle)
+            handles.append(handle)
+        return RemoteResult.variant_set(handles)
 
-        return Image.open(io.BytesIO(img_response.content))
+    @staticmethod
+    def _retry_after(response: requests.Response, default: float = 5.0) -> float:
+        """Seconds to back off after a 429, from the Retry-After header if numeric"""
+        try:
+            return float(response.headers.get("Retry-After", default))
+        except (TypeError, ValueError):
+            return default
 
     @staticmethod
-    def _image_to_base64(image: Image.Image) -> str:
+    def _image_to_base64(image: Image.Image, digest: Optional[str] = None) -> str:
         """Convert PIL Image to base64 string"""
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode()
+        return base64.b64encode(ImageService.encode_image(image, "PNG", digest)).decode()
 
     def _apply_user_camera_angle(
         self, vibe_name: str, theme_payload: Dict[str, Any], user_angle: str
@@ -245,18 +373,18 @@ class BriaService:
             payload["camera_angle"] = user_angle
             return payload
         return theme_payload
-    def _extract_product_only(self, image_analysis: Dict[str, Any]) -> str:
+    def _extract_product_only(self, image_analysis: ImageAnalysis) -> str:
         """Extract ONLY product details for low structure_lock scenarios"""
-        subjects = image_analysis.get("subjects", [])
+        subjects = image_analysis.subjects
         if subjects:
         # Extract just the can description, not the scene
-            subject_desc = subjects[0].get('detailed_description', '')
+            subject_desc = subjects[0].detailed_description
         # Clean up to remove scene context
             if "on a" in subject_desc:
              subject_desc = subject_desc.split("on a")[0] + "."
             return f"Product: {subject_desc} "
         return ""
 
-    def _extract_scene_with_details(self, image_analysis: Dict[str, Any]) -> str:
+    def _extract_scene_with_details(self, image_analysis: ImageAnalysis) -> str:
      """Extract scene details for high structure_lock"""
-     return f"Original scene: {image_analysis.get('global_description', '')}. "
+     return f"Original scene: {image_analysis.global_description}. "
@@ -0,0 +1,376 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Any, BinaryIO, Callable, Optional
+
+from config.settings import Settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: evictions are serialized by SQLite alone
+    fcntl = None
+
+# Namespaces shared by the services; each has its own TTL in Settings.CACHE_TTLS
+ANALYSES = "analyses"
+UPLOADS = "uploads"
+ASSETS = "assets"
+THUMBNAILS = "thumbnails"
+GENERATIONS = "generations"
+SESSIONS = "sessions"
+
+
+class CacheBackend:
+    """
+    Byte-oriented cache shared by GeminiService, BriaService and ImageService.
+
+    Values are opaque bytes grouped by namespace; callers serialize their own
+    objects. Implementations must be safe to use from many threads, and the
+    shared ones from many processes.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    def set_stream(self, namespace: str, key: str, stream: BinaryIO, ttl: Optional[float] = None):
+        """Store the rest of a file-like object; backends may copy it without loading it whole"""
+        self.set(namespace, key, stream.read(), ttl)
+
+    def delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": type(self).__name__, "hits": self.hits, "misses": self.misses}
+
+    def _count(self, value: Optional[bytes]) -> Optional[bytes]:
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    @staticmethod
+    def default_ttl(namespace: str) -> Optional[float]:
+        return Settings.CACHE_TTLS.get(namespace)
+
+
+class MemoryCache(CacheBackend):
+    """Per-process LRU, for single-process deployments and as a fallback"""
+
+    def __init__(self, max_bytes: int):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is not None and entry[1] is not None and entry[1] <= time.time():
+                self._drop((namespace, key))
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end((namespace, key))
+            return self._count(entry[0] if entry else None)
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None):
+        ttl = self.default_ttl(namespace) if ttl is None else ttl
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._drop((namespace, key))
+            self._entries[(namespace, key)] = (value, time.time() + ttl if ttl else None)
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def delete(self, namespace: str, key: str):
+        with self._lock:
+            self._drop((namespace, key))
+
+    def _drop(self, entry_key: tuple):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**super().stats(), "entries": len(self._entries), "bytes": self._bytes}
+
+
+class SQLiteCache(CacheBackend):
+    """
+    Multi-process cache: an SQLite index plus one file per large value.
+
+    Writes go to a temp file that is fsynced and atomically renamed into
+    place under a name unique to that write, then recorded in the index
+    inside an IMMEDIATE transaction; readers therefore never observe a
+    partial file. Values up to CACHE_INLINE_MAX_BYTES live in the index
+    itself. Last-access times in the index give every process one shared LRU
+    order; whichever process takes the eviction lock (fcntl, where available)
+    trims the cache back to CACHE_MAX_BYTES, oldest first.
+    """
+
+    _ACCESS_RESOLUTION = 30.0  # seconds; skips index writes on hot keys
+
+    def __init__(self, directory: str, max_bytes: int):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._blob_dir = os.path.join(directory, "blobs")
+        os.makedirs(self._blob_dir, exist_ok=True)
+        self._db_path = os.path.join(directory, "index.sqlite3")
+        self._lock_path = os.path.join(directory, "evict.lock")
+        self._local = threading.local()
+
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, path TEXT, value BLOB,"
+                " size INTEGER NOT NULL, last_access REAL NOT NULL, expires_at REAL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access)")
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread; sqlite3 connections must not be shared"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _blob_path(self, namespace: str, key: str) -> str:
+        digest = hashlib.sha256(f"{namespace}\0{key}".encode()).hexdigest()
+        return os.path.join(self._blob_dir, digest[:2], f"{digest}-{uuid.uuid4().hex[:8]}")
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT path, value, last_access, expires_at FROM entries WHERE namespace = ? AND key = ?",
+            (namespace, key),
+        ).fetchone()
+        if row is None:
+            return self._count(None)
+
+        path, value, last_access, expires_at = row
+        now = time.time()
+        if expires_at is not None and expires_at <= now:
+            self.delete(namespace, key)
+            return self._count(None)
+
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    value = f.read()
+            except FileNotFoundError:
+                # Evicted by another process between the lookup and the read
+                return self._count(None)
+
+        if now - last_access > self._ACCESS_RESOLUTION:
+            conn.execute(
+                "UPDATE entries SET last_access = ? WHERE namespace = ? AND key = ?", (now, namespace, key)
+            )
+        return self._count(value)
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None):
+        if len(value) > self.max_bytes:
+            return
+        if len(value) > Settings.CACHE_INLINE_MAX_BYTES:
+            path = self._write_blob(namespace, key, lambda f: f.write(value))
+            self._record(namespace, key, path, None, len(value), ttl)
+        else:
+            self._record(namespace, key, None, value, len(value), ttl)
+
+    def set_stream(self, namespace: str, key: str, stream: BinaryIO, ttl: Optional[float] = None):
+        path = self._write_blob(namespace, key, lambda f: shutil.copyfileobj(stream, f, Settings.DOWNLOAD_CHUNK_SIZE))
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            self._unlink(path)
+            return
+        self._record(namespace, key, path, None, size, ttl)
+
+    def _record(self, namespace: str, key: str, path: Optional[str], inline: Optional[bytes], size: int, ttl):
+        """Point the index at a fully written value, replacing any previous one"""
+        ttl = self.default_ttl(namespace) if ttl is None else ttl
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old = conn.execute(
+                "SELECT path FROM entries WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (namespace, key, path, value, size, last_access, expires_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (namespace, key, path, inline, size, now, now + ttl if ttl else None),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            self._unlink(path)
+            raise
+        if old is not None:
+            self._unlink(old[0])
+        self._maybe_evict()
+
+    def _write_blob(self, namespace: str, key: str, write: Callable[[BinaryIO], Any]) -> str:
+        """Write to a temp file, fsync, then atomically rename to a name unique to this write"""
+        path = self._blob_path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._unlink(tmp_path)
+            raise
+        return path
+
+    @staticmethod
+    def _unlink(path: Optional[str]):
+        if path:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def delete(self, namespace: str, key: str):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT path FROM entries WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if row is not None:
+            self._unlink(row[0])
+
+    def _maybe_evict(self):
+        """Trim expired entries, then least recently used ones, if over budget"""
+        conn = self._connection()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        if fcntl is None:
+            # No advisory lock: concurrent evictions queue on the IMMEDIATE
+            # transaction, and each re-reads the total before trimming
+            self._evict(conn)
+            return
+
+        with open(self._lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # another process is already evicting
+            try:
+                self._evict(conn)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _evict(self, conn: sqlite3.Connection):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            victims = conn.execute(
+                "SELECT namespace, key, path, size FROM entries"
+                " ORDER BY (expires_at IS NOT NULL AND expires_at <= ?) DESC, last_access ASC",
+                (time.time(),),
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            doomed = []
+            for namespace, key, path, size in victims.fetchall():
+                if total <= self.max_bytes * 0.9:  # headroom so every write does not evict
+                    break
+                doomed.append((namespace, key, path))
+                total -= size
+            conn.executemany(
+                "DELETE FROM entries WHERE namespace = ? AND key = ?", [(n, k) for n, k, _ in doomed]
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        for _, _, path in doomed:
+            self._unlink(path)
+
+    def stats(self) -> Dict[str, Any]:
+        count, size = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        return {**super().stats(), "entries": count, "bytes": size, "max_bytes": self.max_bytes}
+
+
+class RedisCache(CacheBackend):
+    """
+    Cache on a Redis-compatible server (Redis, Valkey, KeyDB, ...).
+
+    Expiry uses native TTLs; LRU eviction is left to the server's
+    maxmemory-policy (configure allkeys-lru).
+    """
+
+    def __init__(self, url: str, prefix: str = "context-chameleon"):
+        super().__init__()
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("CACHE_BACKEND=redis requires the 'redis' package (pip install redis)") from e
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self._prefix}:{namespace}:{key}"
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        return self._count(self._client.get(self._key(namespace, key)))
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None):
+        ttl = self.default_ttl(namespace) if ttl is None else ttl
+        self._client.set(self._key(namespace, key), value, ex=int(ttl) if ttl else None)
+
+    def delete(self, namespace: str, key: str):
+        self._client.delete(self._key(namespace, key))
+
+
+_cache: Optional[CacheBackend] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> CacheBackend:
+    """Process-wide cache backend selected by Settings.CACHE_BACKEND"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            backend = Settings.CACHE_BACKEND
+            try:
+                if backend == "sqlite":
+                    _cache = SQLiteCache(Settings.CACHE_DIR, Settings.CACHE_MAX_BYTES)
+                elif backend == "redis":
+                    _cache = RedisCache(Settings.REDIS_URL)
+                elif backend != "memory":
+                    raise ValueError(f"Unknown cache backend: {backend}")
+            except (OSError, sqlite3.Error, ImportError) as e:
+                print(f"Shared cache unavailable ({e}); falling back to an in-process cache")
+            if _cache is None:
+                _cache = MemoryCache(Settings.CACHE_MEMORY_MAX_BYTES)
+        return _cache
@@ -0,0 +1,236 @@
+import itertools
+import threading
+from concurrent.futures import Future
+from typing import Dict, Any, List, Optional, Tuple
+from PIL import Image
+
+from config.settings import Settings
+from services.analysis_model import ImageAnalysis
+from services.bria_service import BriaService
+from services.single_flight import payload_key
+from services.worker_pool import get_worker_pool
+from utils.cancellation import CancellationToken
+
+
+class CampaignSpec:
+    """
+    A vibe x camera angle x scenario matrix.
+
+    An empty axis leaves that setting out of the configuration, so a spec with
+    only vibes reproduces today's one-configuration-per-vibe campaign.
+    """
+
+    def __init__(
+        self,
+        vibes: List[str],
+        camera_angles: Optional[List[str]] = None,
+        scenario_ids: Optional[List[str]] = None,
+        previews: bool = True,
+    ):
+        self.vibes = list(vibes)
+        self.camera_angles = list(camera_angles or [])
+        self.scenario_ids = list(scenario_ids or [])
+        self.previews = previews
+
+    def expand(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Every (vibe, specific_config) cell of the matrix"""
+        cells = []
+        for vibe_name, angle, scenario_id in itertools.product(
+            self.vibes, self.camera_angles or [None], self.scenario_ids or [None]
+        ):
+            specific_config = {}
+            if angle:
+                specific_config["camera_angle"] = angle
+            if scenario_id:
+                specific_config["scenario_id"] = scenario_id
+            cells.append((vibe_name, specific_config))
+        return cells
+
+
+class PlannedJob:
+    """One unique Bria render, plus every matrix cell that maps to the same payload"""
+
+    def __init__(self, vibe_name: str, specific_config: Dict[str, Any], payload: Dict[str, Any], tier: str):
+        self.vibe_name = vibe_name
+        self.specific_config = specific_config
+        self.payload = payload
+        self.tier = tier
+        self.resolution = (payload["width"], payload["height"])
+        self.cells: List[Tuple[str, Dict[str, Any]]] = [(vibe_name, specific_config)]
+        self.estimated_seconds = BriaService.expected_latency(tier)
+        self.estimated_cost = Settings.BRIA_RENDER_COST[tier]
+
+    @property
+    def label(self) -> str:
+        parts = [self.vibe_name]
+        for key in ("camera_angle", "scenario_id"):
+            if self.specific_config.get(key):
+                parts.append(self.specific_config[key].replace("_", " "))
+        if self.tier == "preview":
+            parts.append("preview")
+        return " · ".join(parts)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "label": self.label,
+            "vibe_name": self.vibe_name,
+            "specific_config": self.specific_config,
+            "tier": self.tier,
+            "resolution": list(self.resolution),
+            "cells": [{"vibe_name": v, "specific_config": c} for v, c in self.cells],
+            "estimated_seconds": round(self.estimated_seconds, 1),
+            "estimated_cost": round(self.estimated_cost, 4),
+        }
+
+
+class CampaignPlan:
+    """Deduplicated, ordered render jobs with pre-launch estimates"""
+
+    def __init__(self, jobs: List[PlannedJob], matrix_cells: int):
+        self.jobs = jobs
+        self.matrix_cells = matrix_cells
+
+    @property
+    def estimated_cost(self) -> float:
+        return sum(job.estimated_cost for job in self.jobs)
+
+    @property
+    def estimated_seconds(self) -> float:
+        """
+        Wall-clock estimate: render time spread over the worker pool, but never
+        faster than the Bria token bucket lets requests out.
+        """
+        if not self.jobs:
+            return 0.0
+        limits = Settings.RATE_LIMITS.get("bria", {"rate": 1.0, "burst": 1})
+        compute_bound = sum(job.estimated_seconds for job in self.jobs) / max(1, Settings.WORKER_POOL_SIZE)
+        rate_bound = max(0, len(self.jobs) - limits["burst"]) / limits["rate"] + self.jobs[-1].estimated_seconds
+        return max(compute_bound, rate_bound, max(job.estimated_seconds for job in self.jobs))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "matrix_cells": self.matrix_cells,
+            "unique_renders": len(self.jobs),
+            "collapsed": self.matrix_cells - len([job for job in self.jobs if job.tier == "full"]),
+            "estimated_seconds": round(self.estimated_seconds, 1),
+            "estimated_cost": round(self.estimated_cost, 4),
+            "jobs": [job.to_dict() for job in self.jobs],
+        }
+
+
+class CampaignPlanner:
+    """Expands campaign matrices into the smallest set of Bria renders and schedules them"""
+
+    @staticmethod
+    def plan(spec: CampaignSpec, image_analysis: ImageAnalysis, bria_service: BriaService) -> CampaignPlan:
+        """
+        Build payloads for every matrix cell and collapse identical ones.
+
+        Payloads come from BriaService.build_payload, so two cells are merged
+        exactly when Bria would receive the same request body. With previews
+        enabled each unique render gets a preview job; previews run first,
+        cheapest first, then the full-resolution renders.
+        """
+        cells = spec.expand()
+        tiers = [("full", None)]
+        if spec.previews:
+            tiers.insert(0, ("preview", (Settings.PREVIEW_WIDTH, Settings.PREVIEW_HEIGHT)))
+
+        jobs: Dict[str, PlannedJob] = {}
+        for tier, resolution in tiers:
+            for vibe_name, specific_config in cells:
+                payload = bria_service.build_payload(vibe_name, image_analysis, specific_config, resolution)
+                key = payload_key(payload, "")
+                if key in jobs:
+                    jobs[key].cells.append((vibe_name, specific_config))
+                    continue
+                jobs[key] = PlannedJob(vibe_name, specific_config, payload, tier)
+                if len(jobs) > Settings.CAMPAIGN_MAX_JOBS:
+                    raise ValueError(
+                        f"Campaign expands to more than {Settings.CAMPAIGN_MAX_JOBS} renders; narrow the matrix"
+                    )
+
+        # Stable sort keeps matrix order among equally priced jobs
+        ordered = sorted(
+            jobs.values(), key=lambda job: (job.tier != "preview", job.estimated_cost, job.estimated_seconds)
+        )
+        return CampaignPlan(ordered, len(cells))
+
+    @staticmethod
+    def submit(
+        plan: CampaignPlan,
+        image: Image.Image,
+        image_analysis: ImageAnalysis,
+        bria_service: BriaService,
+        cancel_token: CancellationToken,
+        image_digest: Optional[str] = None,
+    ) -> List[Tuple[PlannedJob, CancellationToken, Future]]:
+        """
+        Feed the jobs to the shared worker pool in plan order, a few at a time.
+
+        Only CAMPAIGN_MAX_IN_FLIGHT jobs of a campaign occupy pool threads at
+        once; each finished job starts the next, so one large matrix cannot
+        crowd other sessions' generations out of the pool. Every job gets its
+        future up front, resolved once the job has run. Each job's
+        GENERATION_DEADLINE starts when a worker picks it up, not at submission.
+        """
+        submitted = [(job, cancel_token.child(), Future()) for job in plan.jobs]
+        pending = iter(submitted)
+        pending_lock = threading.Lock()
+
+        def launch_next(_finished: Optional[Future] = None):
+            while True:
+                with pending_lock:
+                    entry = next(pending, None)
+                if entry is None:
+                    return
+                job, job_token, outer = entry
+                if not outer.set_running_or_notify_cancel():
+                    continue
+                if job_token.is_set():
+                    # Cancelled while queued: fail it without taking a pool thread
+                    try:
+                        job_token.raise_if_cancelled()
+                    except BaseException as e:
+                        outer.set_exception(e)
+                    continue
+                inner = get_worker_pool().submit(
+                    CampaignPlanner._run_job, job, image, image_analysis, bria_service, job_token, image_digest
+                )
+                inner.add_done_callback(lambda done, outer=outer: CampaignPlanner._relay(done, outer))
+                inner.add_done_callback(launch_next)
+                return
+
+        for _ in range(Settings.CAMPAIGN_MAX_IN_FLIGHT):
+            launch_next()
+        return submitted
+
+    @staticmethod
+    def _relay(done: Future, outer: Future):
+        error = done.exception()
+        if error is not None:
+            outer.set_exception(error)
+        else:
+            outer.set_result(done.result())
+
+    @staticmethod
+    def _run_job(
+        job: PlannedJob,
+        image: Image.Image,
+        image_analysis: ImageAnalysis,
+        bria_service: BriaService,
+        job_token: CancellationToken,
+        image_digest: Optional[str] = None,
+    ):
+        result = bria_service.generate_image(
+            image,
+            job.vibe_name,
+            image_analysis,
+            specific_config=job.specific_config,
+            resolution=job.resolution,
+            cancel_token=job_token.child(timeout=Settings.GENERATION_DEADLINE),
+            image_digest=image_digest,
+        )
+        if result is not None:
+            result.metadata.update({"vibe_name": job.vibe_name, "campaign_tier": job.tier})
+        return result
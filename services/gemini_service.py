@@ -1,43 +1,513 @@
 
+import functools
 import json
-import io
-from typing import Dict, Any, Optional
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List, Optional
 from PIL import Image
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 
 from config.settings import Settings
-from config.prompts import GEMINI_ANALYSIS_PROMPT
+from config.prompts import GEMINI_ANALYSIS_PROMPT, GEMINI_SEMANTIC_PROMPT, GEMINI_BATCH_PROMPT
+from services.rate_limiter import get_scheduler, PRIORITY_INTERACTIVE
+from services.analysis_model import ImageAnalysis
+from services.local_analyzer import LocalImageAnalyzer
+from services.image_service import ImageService
+from services.phash_index import get_phash_index
+from services.cache_backend import ANALYSES, get_cache
+from services.usage_ledger import UsageLedger, BudgetExceeded, get_usage_ledger
+from utils.cancellation import CancellationToken, CancelledError
+from utils.partial_json import IncrementalJSONParser
+
+_TILE_TOKENS = 258  # Gemini bills a small image, or each 768x768 tile of a larger one, at this many tokens
+
+
+def _image_tokens(size: int) -> int:
+    """Input tokens of a square image with `size` pixels per side"""
+    if size <= 384:
+        return _TILE_TOKENS
+    return math.ceil(size / 768) ** 2 * _TILE_TOKENS
+
+
+def _template_schema(value: Any) -> Dict[str, Any]:
+    """Response schema with the shape of an example JSON value"""
+    if isinstance(value, dict):
+        return {"type": "object", "properties": {key: _template_schema(item) for key, item in value.items()}}
+    if isinstance(value, list):
+        return {"type": "array", "items": _template_schema(value[0] if value else "")}
+    if isinstance(value, bool):
+        return {"type": "boolean"}
+    if isinstance(value, int):
+        return {"type": "integer"}
+    if isinstance(value, float):
+        return {"type": "number"}
+    return {"type": "string"}
+
+
+@functools.lru_cache(maxsize=None)
+def _batch_schema(prompt: str) -> Optional[Dict[str, Any]]:
+    """Schema of a batched reply: one {image, analysis} object per image, analysis shaped like the prompt's template"""
+    try:
+        template = prompt[prompt.index("JSON FORMAT REQUIREMENTS:"):]
+        template = json.loads(template[template.index("{"):template.rindex("}") + 1])
+    except ValueError:
+        return None
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {"image": {"type": "integer"}, "analysis": _template_schema(template)},
+            "required": ["image", "analysis"],
+        },
+    }
+
+
+class _AnalysisRequest:
+    """One image on its way through analyze_image(s)"""
+
+    def __init__(self, image: Image.Image, mode: str, digest: str, local: Optional[Dict[str, Any]]):
+        self.image = image
+        self.mode = mode
+        self.digest = digest
+        self.local = local  # local measurements; None in "gemini" mode, where Gemini reports everything
+        self.prompt = GEMINI_SEMANTIC_PROMPT if mode == "hybrid" else GEMINI_ANALYSIS_PROMPT
+        self.cache_key = f"{digest}:{mode}:{Settings.GEMINI_MODEL}"
+        self.gemini_analysis: Optional[Dict[str, Any]] = None  # raw reply, before merging local fields
+        self.analysis: Optional[ImageAnalysis] = None  # final result
 
 
 class GeminiService:
     """Service for interacting with Google Gemini API"""
+
+    # Gemini analyses of SKUs seen by this process, keyed by image digest
+    _known_skus: "OrderedDict[str, ImageAnalysis]" = OrderedDict()
+    _known_skus_lock = threading.Lock()
+
+    # Observed output tokens per image of batched replies, by analysis mode; sizes later batches
+    _output_tokens_per_image: Dict[str, float] = {}
+    _output_tokens_lock = threading.Lock()
     
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        session_id: Optional[str] = None,
+        priority: str = PRIORITY_INTERACTIVE,
+        user_id: Optional[str] = None,
+        batch_id: Optional[str] = None,
+    ):
         self.api_key = api_key
+        self.session_id = session_id
+        self.priority = priority
+        self.usage_scope = UsageLedger.scope(session_id, user_id, batch_id)
         genai.configure(api_key=api_key)
         self.model = genai.GenerativeModel(Settings.GEMINI_MODEL)
+        self._models: Dict[str, Any] = {Settings.GEMINI_MODEL: self.model}
+
+    @staticmethod
+    def model_tiers() -> List[str]:
+        """Models tried in order: GEMINI_MODEL, then each escalation model"""
+        return [Settings.GEMINI_MODEL] + [m for m in Settings.GEMINI_ESCALATION_MODELS if m != Settings.GEMINI_MODEL]
+
+    def _model(self, model_name: str):
+        if model_name not in self._models:
+            self._models[model_name] = genai.GenerativeModel(model_name)
+        return self._models[model_name]
     
-    def analyze_image(self, image: Image.Image) -> Optional[Dict[str, Any]]:
+    def analyze_image(
+        self,
+        image: Image.Image,
+        mode: Optional[str] = None,
+        on_partial: Optional[Callable[[ImageAnalysis], None]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> Optional[ImageAnalysis]:
         """
-        Analyze image using Gemini and return structured JSON description
+        Analyze image and return structured JSON description
         
         Args:
             image: PIL Image object to analyze
+            mode: "gemini", "hybrid" or "local_only" (defaults to Settings.ANALYSIS_MODE)
+            on_partial: if given, Gemini's reply is streamed and this is called with
+                the analysis fields complete so far (local fields merged in) as they arrive
+            cancel_token: stops queueing, streaming and escalation early (raises CancelledError)
             
         Returns:
-            Dictionary containing structured image analysis or None on error
+            The validated analysis, or None on error
+        """
+        request = self._prepare(image, self._check_mode(mode))
+        if request.analysis is None:
+            if request.gemini_analysis is None:
+                if on_partial is not None:
+                    def publish(partial: Dict[str, Any]):
+                        try:
+                            on_partial(ImageAnalysis.from_dict(self._with_local(partial, request.local)))
+                        except ValueError:
+                            pass  # fields that do not validate yet; the next chunk may fix them
+                else:
+                    publish = None
+                self._store(request, self._analyze_with_gemini(
+                    image, request.prompt, request.digest, publish, cancel_token=cancel_token
+                ))
+            self._complete(request)
+        return request.analysis
+
+    def analyze_images(self, images: List[Image.Image], mode: Optional[str] = None) -> List[Optional[ImageAnalysis]]:
+        """
+        Analyze a catalog of images, packing several images into each Gemini request
+
+        Images are downscaled to GEMINI_BATCH_IMAGE_SIZE and sent together with
+        one copy of the prompt; the batch size follows the token budget. Images
+        missing from a batch reply are retried with single-image calls.
+
+        Returns:
+            One analysis per image, in input order; None where analysis failed
+        """
+        mode = self._check_mode(mode)
+        requests: List[Optional[_AnalysisRequest]] = []
+        for image in images:
+            try:
+                requests.append(self._prepare(image, mode))
+            except BudgetExceeded as e:
+                print(f"Batched analysis skipped an image: {e}")
+                requests.append(None)
+
+        # Identical images in one catalog are analyzed once
+        pending: "OrderedDict[str, List[_AnalysisRequest]]" = OrderedDict()
+        for request in requests:
+            if request is not None and request.analysis is None and request.gemini_analysis is None:
+                pending.setdefault(request.cache_key, []).append(request)
+        queue = [group[0] for group in pending.values()]
+        while queue:
+            size = self._batch_size(queue[0])
+            self._analyze_batch(queue[:size])
+            queue = queue[size:]
+        for group in pending.values():
+            for request in group[1:]:
+                request.gemini_analysis = group[0].gemini_analysis
+
+        for request in requests:
+            if request is not None and request.analysis is None and request.gemini_analysis is not None:
+                self._complete(request)
+        return [request.analysis if request is not None else None for request in requests]
+
+    @staticmethod
+    def _check_mode(mode: Optional[str]) -> str:
+        mode = mode or Settings.ANALYSIS_MODE
+        if mode not in Settings.ANALYSIS_MODES:
+            raise ValueError(f"Unknown analysis mode: {mode}")
+        return mode
+
+    def _prepare(self, image: Image.Image, mode: str) -> _AnalysisRequest:
+        """Resolve everything that needs no Gemini call: budget, local-only, near-duplicates, cache"""
+        digest = ImageService.image_digest(image)
+
+        budget_downgraded = False
+        if mode != "local_only":
+            try:
+                get_usage_ledger().admit_analysis(self.usage_scope)
+            except BudgetExceeded:
+                if Settings.BUDGET_EXCEEDED_ACTION != "downgrade":
+                    raise
+                mode, budget_downgraded = "local_only", True
+
+        # The k-means tier only feeds the modes that use it
+        local = LocalImageAnalyzer.analyze(image) if mode != "gemini" else None
+        request = _AnalysisRequest(image, mode, digest, local)
+        if mode == "local_only":
+            # Known SKU: reuse its semantic analysis; otherwise local fields only
+            known = self._known_sku(digest)
+            base = known.to_dict() if known else {"subjects": [{"detailed_description": "the product"}]}
+            analysis = LocalImageAnalyzer.merge(base, local)
+            analysis["analysis_source"] = "local+cached" if known else "local"
+            if budget_downgraded:
+                analysis["budget_downgraded"] = True
+            request.analysis = ImageAnalysis.from_dict(analysis)
+            return request
+
+        if Settings.PHASH_AUTO_REUSE:
+            index = get_phash_index()
+            match = index.nearest(image)
+            if match:
+                request.analysis = self.reuse_analysis(match[0].analysis, local, match[1])
+                index.add(image, digest, request.analysis)
+                return request
+
+        cached = get_cache().get(ANALYSES, request.cache_key)
+        if cached is not None:
+            request.gemini_analysis = json.loads(cached)
+        return request
+
+    @staticmethod
+    def _store(request: _AnalysisRequest, gemini_analysis: Dict[str, Any]):
+        request.gemini_analysis = gemini_analysis
+        get_cache().set(ANALYSES, request.cache_key, json.dumps(gemini_analysis).encode())
+
+    def _complete(self, request: _AnalysisRequest):
+        """Merge the local measurements into Gemini's reply and make the SKU known"""
+        merged = self._with_local(request.gemini_analysis, request.local)
+        merged["analysis_source"] = request.mode
+        analysis = ImageAnalysis.from_dict(merged)  # validated once, shared read-only from here on
+        self._remember_sku(request.digest, analysis)
+        get_phash_index().add(request.image, request.digest, analysis)
+        request.analysis = analysis
+
+    @staticmethod
+    def _with_local(analysis: Dict[str, Any], local: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Gemini's reply with the local measurements filled in, when this mode has any"""
+        return LocalImageAnalyzer.merge(analysis, local) if local is not None else dict(analysis)
+
+    @staticmethod
+    def reuse_analysis(prior: ImageAnalysis, local: Optional[Dict[str, Any]], distance: int) -> ImageAnalysis:
+        """Adopt a near-duplicate's analysis, keeping this image's own local measurements if any"""
+        update = {"analysis_source": "near_duplicate", "near_duplicate_distance": distance}
+        if local is not None:
+            update["local_metrics"] = local["local_metrics"]
+        return prior.model_copy(update=update)
+
+    @classmethod
+    def _remember_sku(cls, digest: str, analysis: ImageAnalysis):
+        with cls._known_skus_lock:
+            cls._known_skus[digest] = analysis
+            cls._known_skus.move_to_end(digest)
+            while len(cls._known_skus) > Settings.KNOWN_SKU_CACHE_SIZE:
+                cls._known_skus.popitem(last=False)
+        # Make the SKU known to the other worker processes too
+        get_cache().set(ANALYSES, f"{digest}:known", analysis.to_json())
+
+    @classmethod
+    def _known_sku(cls, digest: str) -> Optional[ImageAnalysis]:
+        with cls._known_skus_lock:
+            known = cls._known_skus.get(digest)
+        if known is None:
+            cached = get_cache().get(ANALYSES, f"{digest}:known")
+            known = ImageAnalysis.from_json(cached) if cached is not None else None
+        return known
+
+    @classmethod
+    def _batch_size(cls, request: _AnalysisRequest) -> int:
+        """Images per request that fit both the input and the expected output token budget"""
+        prompt_tokens = (len(GEMINI_BATCH_PROMPT) + len(request.prompt)) // 4
+        per_image_input = _image_tokens(Settings.GEMINI_BATCH_IMAGE_SIZE) + 10  # plus its "Image n:" label
+        by_input = (Settings.GEMINI_BATCH_MAX_INPUT_TOKENS - prompt_tokens) // per_image_input
+        with cls._output_tokens_lock:
+            per_image_output = cls._output_tokens_per_image.get(
+                request.mode, Settings.GEMINI_BATCH_OUTPUT_TOKENS_PER_IMAGE
+            )
+        # Headroom: a reply cut off at the output limit loses the whole batch
+        by_output = int(Settings.GEMINI_BATCH_MAX_OUTPUT_TOKENS * 0.8 / per_image_output)
+        return max(1, min(Settings.GEMINI_BATCH_MAX_IMAGES, by_input, by_output))
+
+    @classmethod
+    def _observe_output_tokens(cls, mode: str, usage_metadata: Any, images: int):
+        output_tokens = getattr(usage_metadata, "candidates_token_count", 0) or 0
+        if not output_tokens:
+            return
+        observed = output_tokens / max(images, 1)
+        with cls._output_tokens_lock:
+            previous = cls._output_tokens_per_image.get(mode)
+            cls._output_tokens_per_image[mode] = observed if previous is None else 0.7 * previous + 0.3 * observed
+
+    def _analyze_batch(self, batch: List[_AnalysisRequest]):
+        """Store Gemini's analysis on each request of `batch`; failures leave gemini_analysis unset"""
+        analyses: Dict[int, Dict[str, Any]] = {}
+        if len(batch) > 1:
+            try:
+                analyses = self._analyze_batch_with_gemini(batch)
+            except Exception as e:
+                print(f"Batched analysis of {len(batch)} images failed, retrying one by one: {e}")
+
+        for position, request in enumerate(batch, 1):
+            analysis, first_tier = analyses.get(position), 0
+            if analysis is not None:
+                reason = self._escalation_reason(analysis)
+                if reason is None or len(self.model_tiers()) == 1:
+                    analysis = self._tag_tier(analysis, 0)
+                else:
+                    # Weak batch answer: retry this image alone on the stronger tiers
+                    print(f"Escalating image {request.digest[:8]} from the batch reply: {reason}")
+                    weak, analysis, first_tier = analysis, None, 1
+            if analysis is None:
+                try:
+                    analysis = self._analyze_with_gemini(request.image, request.prompt, request.digest, first_tier=first_tier)
+                except Exception as e:
+                    print(f"Analysis of image {request.digest[:8]} failed: {e}")
+                    if not first_tier:
+                        continue
+                    analysis = self._tag_tier(weak, 0)
+            self._store(request, analysis)
+
+    @staticmethod
+    def _batch_image_bytes(image: Image.Image) -> bytes:
+        size = Settings.GEMINI_BATCH_IMAGE_SIZE
+        if max(image.size) > size:
+            image = image.copy()
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        return ImageService.image_to_bytes(image, format="PNG")
+
+    def _analyze_batch_with_gemini(self, batch: List[_AnalysisRequest]) -> Dict[int, Dict[str, Any]]:
+        """One Gemini call for several images; analyses by 1-based position in `batch`"""
+        prompt = batch[0].prompt
+        contents: List[Any] = [GEMINI_BATCH_PROMPT.format(count=len(batch)) + prompt]
+        for position, request in enumerate(batch, 1):
+            contents.append(f"Image {position}:")
+            contents.append({"mime_type": "image/png", "data": self._batch_image_bytes(request.image)})
+        generation_config = {
+            "response_mime_type": "application/json",
+            "max_output_tokens": Settings.GEMINI_BATCH_MAX_OUTPUT_TOKENS,
+        }
+        schema = _batch_schema(prompt)
+        if schema is not None:
+            generation_config["response_schema"] = schema
+
+        try:
+            # One rate-limit slot and one copy of the prompt for the whole batch
+            with get_scheduler().acquire("gemini", self.api_key, self.session_id, self.priority):
+                started = time.monotonic()
+                response = self.model.generate_content(contents, generation_config=generation_config)
+        except google_exceptions.ResourceExhausted:
+            get_scheduler().report_throttled("gemini", self.api_key)
+            raise
+        usage_metadata = getattr(response, "usage_metadata", None)
+        get_usage_ledger().record_gemini(
+            self.usage_scope, Settings.GEMINI_MODEL, usage_metadata, time.monotonic() - started,
+        )
+
+        try:
+            analyses = self._parse_batch(response.text, len(batch))
+        except ValueError:
+            # Most likely cut off at the output limit: count it all against one image so batches shrink
+            self._observe_output_tokens(batch[0].mode, usage_metadata, 1)
+            raise
+        self._observe_output_tokens(batch[0].mode, usage_metadata, len(analyses))
+        return analyses
+
+    @classmethod
+    def _parse_batch(cls, text: str, count: int) -> Dict[int, Dict[str, Any]]:
+        """Analyses by image number from a batched reply; malformed or out-of-range entries are dropped"""
+        items = json.loads(cls._clean_json_response(text.strip()))
+        if not isinstance(items, list):
+            raise ValueError("batched reply is not a JSON array")
+        analyses: Dict[int, Dict[str, Any]] = {}
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get("analysis"), dict):
+                continue
+            position = item.get("image")
+            if isinstance(position, int) and 1 <= position <= count:
+                analyses.setdefault(position, item["analysis"])
+        return analyses
+
+    @staticmethod
+    def _escalation_reason(analysis: Any) -> Optional[str]:
+        """Why a reply is too weak to keep (a stronger model should retry), or None when it is good enough"""
+        if not isinstance(analysis, dict):
+            return "reply is not a JSON object"
+        missing = [field for field in Settings.GEMINI_REQUIRED_FIELDS if analysis.get(field) in (None, "", [], {})]
+        if missing:
+            return f"missing {', '.join(missing)}"
+        confidence = analysis.get("metadata_confidence")
+        if confidence is not None:
+            try:
+                confidence = float(confidence)
+            except (TypeError, ValueError):
+                return "metadata_confidence is not a number"
+            if confidence < Settings.GEMINI_ESCALATION_CONFIDENCE:
+                return f"metadata_confidence {confidence:.2f} below {Settings.GEMINI_ESCALATION_CONFIDENCE}"
+        return None
+
+    def _tag_tier(self, analysis: Dict[str, Any], tier: int) -> Dict[str, Any]:
+        """Record on the reply which model tier produced it"""
+        analysis["analysis_model"] = self.model_tiers()[tier]
+        analysis["model_tier"] = tier
+        return analysis
+
+    def _analyze_with_gemini(
+        self,
+        image: Image.Image,
+        prompt: str,
+        digest: Optional[str] = None,
+        on_partial: Optional[Callable[[Dict[str, Any]], None]] = None,
+        first_tier: int = 0,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> Dict[str, Any]:
+        """
+        Send the image to Gemini with `prompt` and parse the JSON reply
+
+        The cheapest model (GEMINI_MODEL) answers first. A stronger model from
+        GEMINI_ESCALATION_MODELS retries only when the reply does not parse,
+        lacks a required field or reports a low metadata_confidence, so most
+        images cost one fast call. The reply records the model and tier used.
+
+        With `on_partial`, the reply is streamed and parsed as it arrives;
+        `on_partial` is called with the fields complete so far each time more
+        of them have arrived.
         """
+        tiers = self.model_tiers()
+        weakest: Optional[Dict[str, Any]] = None  # best reply so far, kept should every stronger tier fail
+        for tier in range(first_tier, len(tiers)):
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()  # no escalation for a caller that has gone
+            try:
+                analysis = self._call_gemini(tiers[tier], image, prompt, digest, on_partial, cancel_token)
+            except ValueError as e:
+                if tier < len(tiers) - 1:
+                    print(f"Escalating analysis: {tiers[tier]} reply did not parse ({e})")
+                    continue
+                if weakest is not None:
+                    return weakest
+                raise Exception(f"Gemini Analysis Error: {str(e)}")
+
+            reason = self._escalation_reason(analysis)
+            if reason is None or tier == len(tiers) - 1:
+                return self._tag_tier(analysis, tier)
+            print(f"Escalating analysis from {tiers[tier]}: {reason}")
+            if weakest is None:
+                weakest = self._tag_tier(analysis, tier)
+        raise Exception("Gemini Analysis Error: no model tier left to try")
+
+    def _call_gemini(
+        self,
+        model_name: str,
+        image: Image.Image,
+        prompt: str,
+        digest: Optional[str] = None,
+        on_partial: Optional[Callable[[Dict[str, Any]], None]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> Any:
+        """One call to `model_name`; raises ValueError when the reply is not valid JSON"""
         try:
-            # Convert image to bytes
-            buffered = io.BytesIO()
-            image.save(buffered, format="PNG")
-            buffered.seek(0)
+            # Convert image to bytes (encoded once per host, shared through the cache)
+            image_bytes = ImageService.encode_image(image, "PNG", digest)
             
-            # Send to Gemini
-            response = self.model.generate_content([
-                GEMINI_ANALYSIS_PROMPT,
-                image
-            ])
+            # Send to Gemini (queued behind the shared Gemini rate limit)
+            with get_scheduler().acquire(
+                "gemini", self.api_key, self.session_id, self.priority, cancel_token=cancel_token
+            ):
+                started = time.monotonic()
+                response = self._model(model_name).generate_content([
+                    prompt,
+                    {"mime_type": "image/png", "data": image_bytes}
+                ], stream=on_partial is not None)
+
+            if on_partial is not None:
+                parser = IncrementalJSONParser()
+                for chunk in response:
+                    if cancel_token is not None:
+                        cancel_token.raise_if_cancelled()
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        continue  # e.g. a final chunk carrying only the finish reason
+                    partial = parser.feed(text)
+                    if isinstance(partial, dict):
+                        on_partial(partial)
+            get_usage_ledger().record_gemini(
+                self.usage_scope, model_name, getattr(response, "usage_metadata", None),
+                time.monotonic() - started,
+            )
+            if on_partial is not None:
+                return parser.result()
             
             # Parse JSON response
             response_text = response.text.strip()
@@ -48,6 +518,11 @@ class GeminiService:
             analysis = json.loads(response_text)
             return analysis
             
+        except google_exceptions.ResourceExhausted as e:
+            get_scheduler().report_throttled("gemini", self.api_key)
+            raise Exception(f"Gemini Analysis Error (rate limited): {str(e)}")
+        except (ValueError, CancelledError):
+            raise  # unusable reply (the caller may escalate), or the caller gave up
         except Exception as e:
             raise Exception(f"Gemini Analysis Error: {str(e)}")
     
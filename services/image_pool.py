@@ -0,0 +1,119 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Callable, Optional, Tuple, Union
+from PIL import Image
+
+from config.settings import Settings
+
+# Raster modes that round-trip through raw bytes (palette images would lose their palette)
+_SHAREABLE_MODES = ("L", "LA", "RGB", "RGBA")
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_in_worker = False
+
+
+def _init_worker():
+    global _in_worker
+    _in_worker = True  # jobs already running in a worker never offload again
+
+
+def get_image_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    Process-wide pool for CPU-bound image jobs (encode, decode, resize, mock compositing).
+
+    Pillow and the pure-Python drawing loops hold the GIL long enough to stall
+    other sessions' script reruns; in worker processes they cannot. None when
+    IMAGE_POOL_SIZE is 0, or inside a worker.
+    """
+    global _pool
+    if _in_worker or Settings.IMAGE_POOL_SIZE <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a threaded server process is unsafe
+            _pool = ProcessPoolExecutor(
+                max_workers=Settings.IMAGE_POOL_SIZE,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return _pool
+
+
+def _discard(pool: ProcessPoolExecutor):
+    """Drop a broken pool so the next job starts a fresh one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def offloads(pixels: int, mode: Optional[str] = None) -> bool:
+    """Whether a job over `pixels` (of a raster in `mode`, if one is handed over) runs in the pool"""
+    if pixels < Settings.IMAGE_POOL_MIN_PIXELS or (mode is not None and mode not in _SHAREABLE_MODES):
+        return False
+    return get_image_pool() is not None
+
+
+def _share(data: Union[bytes, Image.Image]) -> Tuple[shared_memory.SharedMemory, Tuple[Any, ...]]:
+    """Copy `data` into a new shared memory segment; returns it with what a worker needs to read it back"""
+    raw = data.tobytes() if isinstance(data, Image.Image) else data
+    segment = shared_memory.SharedMemory(create=True, size=max(len(raw), 1))
+    segment.buf[:len(raw)] = raw
+    if isinstance(data, Image.Image):
+        return segment, ("image", data.mode, data.size)
+    return segment, ("bytes", len(raw))
+
+
+def _attach(name: str, layout: Tuple[Any, ...]) -> Union[bytes, Image.Image]:
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        if layout[0] == "image":
+            return Image.frombytes(layout[1], layout[2], segment.buf)
+        return bytes(segment.buf[:layout[1]])
+    finally:
+        segment.close()
+
+
+def _run_task(task: Callable[..., bytes], name: str, layout: Tuple[Any, ...], args: Tuple[Any, ...]) -> Tuple[str, int]:
+    """Worker side: read the input from shared memory, run `task`, leave the result in a new segment"""
+    result = task(_attach(name, layout), *args)
+    segment = shared_memory.SharedMemory(create=True, size=max(len(result), 1))
+    segment.buf[:len(result)] = result
+    segment.close()
+    return segment.name, len(result)
+
+
+def run(task: Callable[..., bytes], data: Union[bytes, Image.Image], *args) -> bytes:
+    """
+    Run `task(data, *args)` in the image pool and return the bytes it produces.
+
+    `data` (encoded bytes or a raster) reaches the worker through shared
+    memory and the result comes back the same way, so neither is pickled
+    through the pool's pipe. `task` must be a module-level function. Falls
+    back to running in this process if the pool is unavailable.
+    """
+    pool = get_image_pool()
+    if pool is None:
+        return task(data, *args)
+    segment, layout = _share(data)
+    try:
+        name, size = pool.submit(_run_task, task, segment.name, layout, args).result()
+    except BrokenProcessPool as e:
+        print(f"Image pool broke, processing in-process: {e}")
+        _discard(pool)
+        return task(data, *args)
+    finally:
+        segment.close()
+        segment.unlink()
+
+    result = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(result.buf[:size])
+    finally:
+        result.close()
+        result.unlink()
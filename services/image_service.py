@@ -1,9 +1,13 @@
+import hashlib
 import io
-from typing import Tuple
+from typing import BinaryIO, Iterator, Optional, Tuple
 from PIL import Image, ImageDraw, ImageFont
 
 from config.settings import Settings
-from config.vibe_configs import VIBE_CONFIGS
+from services import image_pool
+from services.cache_backend import UPLOADS, THUMBNAILS, get_cache
+from services.tiled_output import MemmapCanvas, PNGStripWriter
+from services.vibe_registry import get_registry
 
 
 class ImageService:
@@ -37,7 +41,8 @@ class ImageService:
         vibe_name: str,
         product_image: Image.Image,
         width: int = None,
-        height: int = None
+        height: int = None,
+        tiled: Optional[bool] = None
     ) -> Image.Image:
         """
         Generate a mock marketing image by compositing product onto styled background
@@ -47,45 +52,95 @@ class ImageService:
             product_image: Source product image
             width: Output width (defaults to Settings.DEFAULT_IMAGE_WIDTH)
             height: Output height (defaults to Settings.DEFAULT_IMAGE_HEIGHT)
+            tiled: Render strip by strip into a memory-mapped canvas
+                (defaults to on above Settings.MOCK_TILED_MIN_PIXELS)
             
         Returns:
-            Composite PIL Image
+            Composite PIL Image (RGBA and file-backed when tiled)
         """
         width = width or Settings.DEFAULT_IMAGE_WIDTH
         height = height or Settings.DEFAULT_IMAGE_HEIGHT
-        
-        # Create styled background
-        background = ImageService._create_styled_background(vibe_name, width, height)
-        
-        # Prepare and composite product
-        product = ImageService._prepare_product_image(product_image, width, height)
-        product_x = (width - product.width) // 2
-        product_y = (height - product.height) // 2
-        background.paste(product, (product_x, product_y), 
-                        product if product.mode == 'RGBA' else None)
-        # Add decorative labels
-        ImageService._add_labels(background, vibe_name, width, height)
-        return background
+        if tiled is None:
+            tiled = width * height > Settings.MOCK_TILED_MIN_PIXELS
+
+        if not tiled:
+            # A single strip covering the whole canvas
+            (_, image), = ImageService.iter_mock_strips(vibe_name, product_image, width, height, tile_height=height)
+            return image
+
+        canvas = MemmapCanvas(width, height)
+        for _, strip in ImageService.iter_mock_strips(vibe_name, product_image, width, height):
+            canvas.write_strip(strip)
+        return canvas.image()
+
+    @staticmethod
+    def render_mock(
+        vibe_name: str,
+        product_image: Image.Image,
+        stream: BinaryIO,
+        width: int = None,
+        height: int = None
+    ):
+        """Encode a mock straight into `stream` as PNG, one strip at a time (large mocks in the image pool)"""
+        width = width or Settings.DEFAULT_IMAGE_WIDTH
+        height = height or Settings.DEFAULT_IMAGE_HEIGHT
+        if image_pool.offloads(width * height):
+            product = product_image if product_image.mode == 'RGBA' else product_image.convert('RGBA')
+            stream.write(image_pool.run(_render_mock_task, product, vibe_name, width, height))
+            return
+        writer = PNGStripWriter(stream, width, height)
+        for _, strip in ImageService.iter_mock_strips(vibe_name, product_image, width, height):
+            writer.write_strip(strip)
+        writer.close()
+
     @staticmethod
-    def _create_styled_background(
+    def iter_mock_strips(
         vibe_name: str,
+        product_image: Image.Image,
         width: int,
-        height: int
-    ) -> Image.Image:
-        """Create a gradient background with decorative elements"""
+        height: int,
+        tile_height: int = None
+    ) -> Iterator[Tuple[int, Image.Image]]:
+        """
+        Yield (top, strip) pairs covering the mock from top to bottom.
+
+        Each strip draws its own gradient rows, decorations, slice of the
+        product and labels, so peak memory is one strip plus the product,
+        whatever the canvas size. The product is scaled once, up front, exactly
+        as the untiled mock always scaled it.
+        """
+        tile_height = tile_height or Settings.MOCK_TILE_HEIGHT
         scheme = ImageService.COLOR_SCHEMES.get(vibe_name, 
                                                 ImageService.COLOR_SCHEMES["Midnight Luxury"])
-        
-        # Create base with gradient
-        img = Image.new('RGB', (width, height), scheme["gradient"][0])
-        draw = ImageDraw.Draw(img)
-        
-        # Apply gradient
+        product = ImageService._prepare_product_image(product_image, width, height)
+        placement = ((width - product.width) // 2, (height - product.height) // 2)
+        fonts = ImageService._label_fonts()
+
+        for top in range(0, height, tile_height):
+            bottom = min(top + tile_height, height)
+            strip = Image.new('RGB', (width, bottom - top), scheme["gradient"][0])
+            draw = ImageDraw.Draw(strip)
+            ImageService._draw_gradient(draw, scheme, width, height, top, bottom)
+            ImageService._add_decorative_elements(draw, scheme, width, height, top)
+            ImageService._paste_product_rows(strip, product, placement, top, bottom)
+            ImageService._add_labels(strip, vibe_name, width, height, top, fonts)
+            yield top, strip
+
+    @staticmethod
+    def _draw_gradient(
+        draw: ImageDraw.Draw,
+        scheme: dict,
+        width: int,
+        height: int,
+        top: int,
+        bottom: int
+    ):
+        """Draw canvas rows [top, bottom) of the vertical gradient"""
         gradient_colors = scheme["gradient"]
         num_colors = len(gradient_colors)
         section_height = height // num_colors
         
-        for i in range(height):
+        for i in range(top, bottom):
             section = min(i // section_height, num_colors - 2)
             progress = (i % section_height) / section_height
             
@@ -97,37 +152,33 @@ class ImageService:
                 for j in range(3)
             )
             
-            draw.line([(0, i), (width, i)], fill=blended)
-        
-        # Add decorative elements
-        ImageService._add_decorative_elements(draw, scheme, width, height)
-        
-        return img
+            draw.line([(0, i - top), (width, i - top)], fill=blended)
     
     @staticmethod
     def _add_decorative_elements(
         draw: ImageDraw.Draw,
         scheme: dict,
         width: int,
-        height: int
+        height: int,
+        top: int = 0
     ):
-        """Add decorative elements based on vibe style"""
+        """Add decorative elements based on vibe style (drawn into a strip starting at canvas row `top`)"""
         if scheme["elements"] == "sun":
             for radius in [100, 80, 60]:
                 draw.ellipse(
-                    [width - 250 - radius, 120 - radius, 
-                     width - 250 + radius, 120 + radius],
+                    [width - 250 - radius, 120 - radius - top, 
+                     width - 250 + radius, 120 + radius - top],
                     fill=scheme["accent_color"]
                 )
         elif scheme["elements"] == "neon":
             for i in range(6):
-                y = height // 2 + i * 40 - 100
+                y = height // 2 + i * 40 - 100 - top
                 draw.rectangle([80, y, width - 80, y + 4], 
                              fill=scheme["accent_color"])
         elif scheme["elements"] == "spotlight":
             # Add a circular spotlight effect
             draw.ellipse(
-                [(width - 300) // 2, (height - 300) // 2, (width + 300) // 2, (height + 300) // 2],
+                [(width - 300) // 2, (height - 300) // 2 - top, (width + 300) // 2, (height + 300) // 2 - top],
                 fill=scheme["accent_color"] + (50,) # semi-transparent
             )
         elif scheme["elements"] == "tech":
@@ -135,11 +186,11 @@ class ImageService:
             # Ensure proper alpha for lines
             line_color = scheme["accent_color"] + (50,) 
             for i in range(0, width, 50):
-                draw.line([(i, 0), (i - height, height)], fill=line_color, width=2)
+                draw.line([(i, -top), (i - height, height - top)], fill=line_color, width=2)
             for i in range(0, height, 50):
-                draw.line([(0, i), (width, i)], fill=line_color, width=2)
+                draw.line([(0, i - top), (width, i - top)], fill=line_color, width=2)
         else:  # minimal
-            draw.rectangle([width - 300, height - 300, width - 80, height - 80],
+            draw.rectangle([width - 300, height - 300 - top, width - 80, height - 80 - top],
                          outline=scheme["accent_color"], width=4)
     
     @staticmethod
@@ -159,29 +210,51 @@ class ImageService:
         
         return product
     
+    @staticmethod
+    def _paste_product_rows(
+        strip: Image.Image,
+        product: Image.Image,
+        placement: Tuple[int, int],
+        top: int,
+        bottom: int
+    ):
+        """Composite the rows of the (already scaled) product that fall inside the strip"""
+        product_x, product_y = placement
+        first = max(top, product_y)
+        last = min(bottom, product_y + product.height)
+        if first >= last:
+            return
+        
+        rows = product.crop((0, first - product_y, product.width, last - product_y))
+        strip.paste(rows, (product_x, first - top), rows)
+    
+    @staticmethod
+    def _label_fonts():
+        """Title and badge fonts, falling back to Pillow's default"""
+        try:
+            return ImageFont.truetype("arial.ttf", 48), ImageFont.truetype("arial.ttf", 24)
+        except:
+            return ImageFont.load_default(), ImageFont.load_default()
+    
     @staticmethod
     def _add_labels(
         image: Image.Image,
         vibe_name: str,
         width: int,
-        height: int
+        height: int,
+        top: int = 0,
+        fonts=None
     ):
-        """Add title and mock preview labels to image"""
+        """Add title and mock preview labels to image (a strip starting at canvas row `top`)"""
         draw = ImageDraw.Draw(image)
-        
-        try:
-            font_title = ImageFont.truetype("arial.ttf", 48)
-            font_badge = ImageFont.truetype("arial.ttf", 24)
-        except:
-            font_title = ImageFont.load_default()
-            font_badge = ImageFont.load_default()
+        font_title, font_badge = fonts or ImageService._label_fonts()
         
         # Determine text colors
         text_color = (255, 255, 255) if vibe_name == "Midnight Luxury" else (0, 0, 0)
         shadow_color = (0, 0, 0) if vibe_name != "Midnight Luxury" else (255, 255, 255)
         
         # Draw title
-        emoji = VIBE_CONFIGS[vibe_name]["emoji"]
+        emoji = get_registry().vibes[vibe_name]["emoji"]
         title_text = f"{emoji} {vibe_name}"
         
         title_bbox = draw.textbbox((0, 0), title_text, font=font_title)
@@ -189,8 +262,9 @@ class ImageService:
         title_x = (width - title_width) // 2
         title_y = 40
         
-        draw.text((title_x + 2, title_y + 2), title_text, fill=shadow_color, font=font_title)
-        draw.text((title_x, title_y), title_text, fill=text_color, font=font_title)
+        if title_y + title_bbox[3] + 2 > top and title_y < top + image.height:
+            draw.text((title_x + 2, title_y + 2 - top), title_text, fill=shadow_color, font=font_title)
+            draw.text((title_x, title_y - top), title_text, fill=text_color, font=font_title)
         
         # Draw mock preview badge
         badge_text = "🎨 MOCK PREVIEW - Bria FIBO Simulation"
@@ -200,16 +274,89 @@ class ImageService:
         badge_y = height - 60
         
         padding = 15
-        badge_bg = [badge_x - padding, badge_y - 8, 
-                   badge_x + badge_width + padding, badge_y + 28]
+        badge_bg = [badge_x - padding, badge_y - 8 - top, 
+                   badge_x + badge_width + padding, badge_y + 28 - top]
+        if badge_bg[3] < 0 or badge_bg[1] >= image.height:
+            return
         draw.rectangle(badge_bg, fill=(0, 0, 0, 180))
         draw.rectangle(badge_bg, outline=(255, 255, 255), width=2)
         
-        draw.text((badge_x, badge_y), badge_text, fill=(255, 255, 255), font=font_badge)
+        draw.text((badge_x, badge_y - top), badge_text, fill=(255, 255, 255), font=font_badge)
     
     @staticmethod
     def image_to_bytes(image: Image.Image, format: str = "PNG") -> bytes:
-        """Convert PIL Image to bytes"""
+        """Convert PIL Image to bytes (large images are encoded in the image pool)"""
+        if image_pool.offloads(image.width * image.height, image.mode):
+            return image_pool.run(_encode_task, image, format, dict(image.info))
         buffered = io.BytesIO()
         image.save(buffered, format=format)
-        return buffered.getvalue()
\ No newline at end of file
+        return buffered.getvalue()
+
+    @staticmethod
+    def encode_image(image: Image.Image, format: str = "PNG", digest: Optional[str] = None) -> bytes:
+        """Encoded upload bytes, shared through the cache so each image is encoded once per host"""
+        key = f"{digest or ImageService.image_digest(image)}.{format.lower()}"
+        cache = get_cache()
+        data = cache.get(UPLOADS, key)
+        if data is None:
+            data = ImageService.image_to_bytes(image, format=format)
+            cache.set(UPLOADS, key, data)
+        return data
+
+    @staticmethod
+    def thumbnail_bytes(key: str, source, size: int = None) -> bytes:
+        """
+        Small JPEG of a generated asset for on-page display.
+
+        `source` is a file-like object with the encoded image; it is only
+        decoded on a cache miss.
+        """
+        size = size or Settings.THUMBNAIL_SIZE
+        data = ImageService.cached_thumbnail(key, size)
+        if data is None:
+            start = source.tell()
+            with Image.open(source) as image:
+                # Only the header is read so far; large files are decoded in the image pool
+                if not image_pool.offloads(image.width * image.height):
+                    data = ImageService._thumbnail(image, size)
+            if data is None:
+                source.seek(start)
+                data = image_pool.run(_thumbnail_task, source.read(), size)
+            get_cache().set(THUMBNAILS, f"{key}@{size}", data)
+        return data
+
+    @staticmethod
+    def cached_thumbnail(key: str, size: int = None) -> Optional[bytes]:
+        """A thumbnail made earlier by thumbnail_bytes (in any process), or None"""
+        return get_cache().get(THUMBNAILS, f"{key}@{size or Settings.THUMBNAIL_SIZE}")
+
+    @staticmethod
+    def _thumbnail(image: Image.Image, size: int) -> bytes:
+        image.draft("RGB", (size, size))  # cheap downscale while decoding JPEGs
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        return ImageService.image_to_bytes(image.convert("RGB"), format="JPEG")
+
+    @staticmethod
+    def image_digest(image: Image.Image) -> str:
+        """Content digest of a PIL Image (mode, size and raw pixels)"""
+        digest = hashlib.sha256(f"{image.mode}:{image.size}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+
+# Image pool jobs (module level so worker processes can unpickle them)
+
+def _encode_task(image: Image.Image, format: str, info: dict) -> bytes:
+    image.info.update(info)  # e.g. an ICC profile the encoder writes out
+    return ImageService.image_to_bytes(image, format)
+
+
+def _thumbnail_task(encoded: bytes, size: int) -> bytes:
+    with Image.open(io.BytesIO(encoded)) as image:
+        return ImageService._thumbnail(image, size)
+
+
+def _render_mock_task(product: Image.Image, vibe_name: str, width: int, height: int) -> bytes:
+    stream = io.BytesIO()
+    ImageService.render_mock(vibe_name, product, stream, width, height)
+    return stream.getvalue()
@@ -0,0 +1,158 @@
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Any, Callable, List, Optional
+
+from config.settings import Settings
+from utils.cancellation import CancellationToken
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+_FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class Job:
+    """
+    One submitted analysis or generation request.
+
+    Progress is an append-only event log (status changes and per-item
+    results), so any number of readers can follow it and resume from a
+    sequence number. Listeners are called from worker threads.
+    """
+
+    def __init__(self, kind: str, client_id: str):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.client_id = client_id
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.token = CancellationToken()
+        self.result: Optional[Any] = None
+        self.error: Optional[str] = None
+        self.items: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.inputs: Dict[str, Any] = {}  # e.g. the upload, kept for follow-up generations
+        self.events: List[Dict[str, Any]] = []
+        self._seq = itertools.count(1)
+        self._listeners: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in _FINISHED
+
+    def subscribe(self, listener: Callable[[], None]) -> Callable[[], None]:
+        """Call `listener` after every new event; returns an unsubscribe function"""
+        with self._lock:
+            self._listeners.append(listener)
+
+        def unsubscribe():
+            with self._lock:
+                if listener in self._listeners:
+                    self._listeners.remove(listener)
+        return unsubscribe
+
+    def events_after(self, seq: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [event for event in self.events if event["id"] > seq]
+
+    def _publish(self, event_type: str, data: Dict[str, Any]):
+        with self._lock:
+            self.updated_at = time.time()
+            self.events.append({"id": next(self._seq), "event": event_type, "data": data})
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener()
+            except Exception as e:
+                print(f"Job listener failed: {e}")
+
+    def set_status(self, status: str, error: Optional[str] = None):
+        with self._lock:
+            if self.finished:
+                return  # the first terminal state wins (e.g. cancel vs. late success)
+            self.status = status
+            self.error = error
+        self._publish("status", {"status": status, "error": error})
+
+    def add_item(self, label: str, **fields):
+        with self._lock:
+            self.items[label] = {"label": label, "status": QUEUED, **fields}
+
+    def update_item(self, label: str, status: str, **fields):
+        with self._lock:
+            self.items[label].update(status=status, **fields)
+            item = dict(self.items[label])
+        self._publish("item", item)
+
+    def pending_items(self) -> int:
+        with self._lock:
+            return sum(1 for item in self.items.values() if item["status"] not in _FINISHED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "kind": self.kind,
+                "status": self.status,
+                "error": self.error,
+                "created_at": self.created_at,
+                "updated_at": self.updated_at,
+                "result": self.result if self.kind == "analysis" else None,
+                "items": list(self.items.values()),
+            }
+
+
+class JobStore:
+    """Process-wide registry of jobs; finished jobs expire after API_JOB_TTL"""
+
+    def __init__(self, max_jobs: int, ttl: float):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, kind: str, client_id: str) -> Job:
+        job = Job(kind, client_id)
+        with self._lock:
+            self._evict()
+            if len(self._jobs) >= self.max_jobs:
+                raise RuntimeError("Too many jobs in flight; retry later")
+            self._jobs[job.job_id] = job
+        return job
+
+    def get(self, job_id: str, client_id: Optional[str] = None) -> Optional[Job]:
+        """The job, if it exists and belongs to `client_id` (when given)"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or (client_id is not None and job.client_id != client_id):
+            return None
+        return job
+
+    def active_count(self) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.finished)
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [j for j, job in self._jobs.items() if job.finished and job.updated_at < cutoff]:
+            del self._jobs[job_id]
+
+
+_store: Optional[JobStore] = None
+_store_lock = threading.Lock()
+
+
+def get_job_store() -> JobStore:
+    """Process-wide job store shared by every API request"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = JobStore(Settings.API_MAX_JOBS, Settings.API_JOB_TTL)
+        return _store
@@ -0,0 +1,189 @@
+import colorsys
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+# Work on a small copy: palette and layout statistics barely change with size
+_ANALYSIS_SIZE = 128
+_PALETTE_SIZE = 5
+_KMEANS_ITERATIONS = 8
+_BACKGROUND_DISTANCE = 40.0  # RGB distance from the border color that counts as foreground
+# Hue (degrees) up to which each color name applies; reds wrap around past 345
+_HUE_NAMES = ((15, "red"), (40, "orange"), (65, "yellow"), (160, "green"), (195, "teal"),
+              (255, "blue"), (290, "purple"), (345, "pink"), (360, "red"))
+
+
+class LocalImageAnalyzer:
+    """
+    Millisecond-scale image statistics computed with NumPy.
+
+    Produces the non-semantic parts of an analysis - dominant palette, primary
+    subject colors, brightness/contrast, background uniformity and the subject
+    bounding box - so Gemini is only needed for descriptions and materials.
+    """
+
+    @staticmethod
+    def analyze(image: Image.Image) -> Dict[str, Any]:
+        """
+        Analyze image locally
+
+        Returns:
+            Partial analysis dict using the same keys as the Gemini analysis,
+            plus a "local_metrics" block with the raw measurements
+        """
+        small = image.copy()
+        small.thumbnail((_ANALYSIS_SIZE, _ANALYSIS_SIZE), Image.Resampling.BILINEAR)
+        rgba = np.asarray(small.convert("RGBA"), dtype=np.float32)
+        rgb, alpha = rgba[..., :3], rgba[..., 3]
+
+        mask, background_uniformity = LocalImageAnalyzer._foreground_mask(rgb, alpha)
+        bbox = LocalImageAnalyzer._bounding_box(mask)
+
+        luminance = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+        brightness = float(luminance.mean() / 255.0)
+        contrast = float(luminance.std() / 255.0)
+
+        subject_pixels = rgb[mask] if mask.any() else rgb.reshape(-1, 3)
+        palette = [LocalImageAnalyzer._hex(c) for c in LocalImageAnalyzer._palette(rgb.reshape(-1, 3), _PALETTE_SIZE)]
+        # Subject colors end up in the generation prompt, which wants words rather than hex codes
+        primary_colors = []
+        for center in LocalImageAnalyzer._palette(subject_pixels, 3):
+            name = LocalImageAnalyzer._color_name(center)
+            if name not in primary_colors:
+                primary_colors.append(name)
+
+        return {
+            "color_palette": {
+                "dominant_colors": palette,
+                "overall_tone": LocalImageAnalyzer._overall_tone(rgb, contrast),
+            },
+            "lighting": {"intensity": "low" if brightness < 0.35 else "high" if brightness > 0.7 else "medium"},
+            "subjects": [{
+                "primary_colors": primary_colors,
+                "position_in_frame": LocalImageAnalyzer._position(bbox),
+            }],
+            "local_metrics": {
+                "brightness": round(brightness, 3),
+                "contrast": round(contrast, 3),
+                "background_uniformity": round(background_uniformity, 3),
+                "subject_bbox": bbox,
+                "has_alpha": bool((alpha < 250).any()),
+            },
+        }
+
+    @staticmethod
+    def _foreground_mask(rgb: np.ndarray, alpha: np.ndarray) -> Tuple[np.ndarray, float]:
+        """Subject mask from alpha (transparent PNGs) or distance to the border color"""
+        border = np.concatenate([rgb[0], rgb[-1], rgb[:, 0], rgb[:, -1]])
+        background_uniformity = float(max(0.0, 1.0 - border.std(axis=0).mean() / 64.0))
+
+        if (alpha < 250).any():
+            return alpha > 127, 1.0
+
+        background = np.median(border, axis=0)
+        distance = np.sqrt(((rgb - background) ** 2).sum(axis=-1))
+        return distance > _BACKGROUND_DISTANCE, background_uniformity
+
+    @staticmethod
+    def _bounding_box(mask: np.ndarray) -> Optional[List[float]]:
+        """Normalized [x0, y0, x1, y1] of the foreground, or None if empty"""
+        rows, cols = np.any(mask, axis=1), np.any(mask, axis=0)
+        if not rows.any():
+            return None
+        y0, y1 = np.where(rows)[0][[0, -1]]
+        x0, x1 = np.where(cols)[0][[0, -1]]
+        h, w = mask.shape
+        return [round(x0 / w, 3), round(y0 / h, 3), round((x1 + 1) / w, 3), round((y1 + 1) / h, 3)]
+
+    @staticmethod
+    def _palette(pixels: np.ndarray, k: int) -> List[Tuple[int, int, int]]:
+        """RGB centers of a k-means palette, largest cluster first"""
+        if len(pixels) == 0:
+            return []
+        k = min(k, len(pixels))
+
+        # Deterministic init: evenly spaced pixels along the luminance order
+        order = np.argsort(pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32))
+        centers = pixels[order[np.linspace(0, len(pixels) - 1, k).astype(int)]].copy()
+
+        for _ in range(_KMEANS_ITERATIONS):
+            labels = ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(axis=-1).argmin(axis=1)
+            for i in range(k):
+                members = pixels[labels == i]
+                if len(members):
+                    centers[i] = members.mean(axis=0)
+
+        counts = np.bincount(labels, minlength=k)
+        colors = []
+        for i in np.argsort(-counts):
+            if counts[i] == 0:
+                continue
+            color = tuple(int(round(c)) for c in centers[i])
+            if color not in colors:
+                colors.append(color)
+        return colors
+
+    @staticmethod
+    def _hex(color: Tuple[int, int, int]) -> str:
+        return "#{:02x}{:02x}{:02x}".format(*color)
+
+    @staticmethod
+    def _color_name(color: Tuple[int, int, int]) -> str:
+        """Plain color word for an RGB value, such as dark blue or light gray"""
+        hue, saturation, value = colorsys.rgb_to_hsv(*(c / 255.0 for c in color))
+        if value < 0.15:
+            return "black"
+        if saturation < 0.15:
+            if value > 0.9:
+                return "white"
+            return "light gray" if value > 0.65 else "dark gray" if value < 0.35 else "gray"
+        degrees = hue * 360
+        name = next(name for limit, name in _HUE_NAMES if degrees <= limit)
+        if name in ("orange", "yellow") and value < 0.6:
+            return "brown"
+        if name == "orange" and saturation < 0.45 and value > 0.7:
+            return "beige"
+        if value < 0.45:
+            return f"dark {name}"
+        if saturation < 0.4 and value > 0.8:
+            return f"light {name}"
+        return name
+
+    @staticmethod
+    def _overall_tone(rgb: np.ndarray, contrast: float) -> str:
+        maxc, minc = rgb.max(axis=-1), rgb.min(axis=-1)
+        saturation = float(np.where(maxc > 0, (maxc - minc) / np.maximum(maxc, 1), 0).mean())
+        if saturation < 0.08:
+            return "monochromatic"
+        if contrast > 0.3:
+            return "high-contrast"
+        if saturation > 0.45:
+            return "vibrant"
+        return "muted"
+
+    @staticmethod
+    def _position(bbox: Optional[List[float]]) -> str:
+        if not bbox:
+            return "center"
+        center_x = (bbox[0] + bbox[2]) / 2
+        if center_x < 0.4:
+            return "left"
+        if center_x > 0.6:
+            return "right"
+        return "center"
+
+    @staticmethod
+    def merge(analysis: Optional[Dict[str, Any]], local: Dict[str, Any]) -> Dict[str, Any]:
+        """Fill local measurements into an analysis without overriding Gemini's fields"""
+        merged = dict(analysis or {})
+        for key, value in local.items():
+            if key == "subjects":
+                subjects = [dict(s) for s in merged.get("subjects") or [{}]]
+                for field, field_value in value[0].items():
+                    subjects[0].setdefault(field, field_value)
+                merged["subjects"] = subjects
+            elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+                merged[key] = {**value, **merged[key]}
+            else:
+                merged.setdefault(key, value)
+        return merged
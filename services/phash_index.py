@@ -0,0 +1,197 @@
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+from config.settings import Settings
+from services.analysis_model import ImageAnalysis
+
+_HASH_BITS = 64
+_CHUNKS = 4
+_CHUNK_BITS = _HASH_BITS // _CHUNKS
+_CHUNK_MASK = (1 << _CHUNK_BITS) - 1
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def phash(image: Image.Image) -> int:
+    """64-bit DCT perceptual hash: robust to recompression, resizing and small crops"""
+    gray = image.convert("L").resize((32, 32), Image.Resampling.LANCZOS)
+    pixels = np.asarray(gray, dtype=np.float64)
+    low = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8]
+    return _bits_to_int(low > np.median(low))
+
+
+def dhash(image: Image.Image) -> int:
+    """64-bit gradient hash: cheaper than pHash, used as a tie-breaker"""
+    gray = image.convert("L").resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class PerceptualEntry:
+    """One analyzed upload: its hashes, analysis and any generated assets"""
+
+    __slots__ = ("entry_id", "phash", "dhash", "digest", "analysis", "assets")
+
+    def __init__(self, entry_id: int, p_hash: int, d_hash: int, digest: str, analysis: ImageAnalysis):
+        self.entry_id = entry_id
+        self.phash = p_hash
+        self.dhash = d_hash
+        self.digest = digest
+        self.analysis = analysis
+        self.assets: Dict[str, Any] = {}
+
+
+class PerceptualIndex:
+    """
+    Near-duplicate index over perceptual hashes using multi-index hashing.
+
+    The 64-bit pHash is split into four 16-bit chunks, each with its own hash
+    table. Two hashes within Hamming distance d agree to within d // 4 bits on
+    at least one chunk (pigeonhole), so a query only probes the chunk values
+    within that radius - a few hundred dict lookups - and verifies the
+    candidates. This keeps lookups well under a millisecond at 100k entries.
+    """
+
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, PerceptualEntry]" = OrderedDict()
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in range(_CHUNKS)]
+        self._by_digest: Dict[str, int] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._probe_masks = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _chunks(value: int) -> List[int]:
+        return [(value >> (i * _CHUNK_BITS)) & _CHUNK_MASK for i in range(_CHUNKS)]
+
+    def _masks(self, radius: int) -> List[int]:
+        """All 16-bit masks with at most `radius` bits set"""
+        if radius not in self._probe_masks:
+            masks = [0]
+            for r in range(1, radius + 1):
+                for bits in itertools.combinations(range(_CHUNK_BITS), r):
+                    masks.append(sum(1 << b for b in bits))
+            self._probe_masks[radius] = masks
+        return self._probe_masks[radius]
+
+    def add(self, image: Image.Image, digest: str, analysis: ImageAnalysis) -> PerceptualEntry:
+        """Index an analyzed upload (re-adding the same digest refreshes its analysis)"""
+        p_hash, d_hash = phash(image), dhash(image)
+        with self._lock:
+            existing = self._by_digest.get(digest)
+            if existing is not None:
+                entry = self._entries[existing]
+                entry.analysis = analysis
+                self._entries.move_to_end(existing)
+                return entry
+
+            entry = PerceptualEntry(next(self._ids), p_hash, d_hash, digest, analysis)
+            self._entries[entry.entry_id] = entry
+            self._by_digest[digest] = entry.entry_id
+            for table, chunk in zip(self._tables, self._chunks(p_hash)):
+                table.setdefault(chunk, []).append(entry.entry_id)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            return entry
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        self._by_digest.pop(entry.digest, None)
+        for table, chunk in zip(self._tables, self._chunks(entry.phash)):
+            bucket = table.get(chunk, [])
+            if entry_id in bucket:
+                bucket.remove(entry_id)
+            if not bucket:
+                table.pop(chunk, None)
+
+    def nearest(
+        self, image: Image.Image, max_distance: Optional[int] = None
+    ) -> Optional[Tuple[PerceptualEntry, int]]:
+        """Closest indexed upload within `max_distance` bits, as (entry, distance)"""
+        max_distance = Settings.PHASH_MAX_DISTANCE if max_distance is None else max_distance
+        return self.nearest_hash(phash(image), dhash(image), max_distance)
+
+    def nearest_hash(self, p_hash: int, d_hash: int, max_distance: int) -> Optional[Tuple[PerceptualEntry, int]]:
+        matches = self._matches(p_hash, d_hash, max_distance)
+        if not matches:
+            return None
+        distance, _, entry = matches[0]
+        return entry, distance
+
+    def _matches(self, p_hash: int, d_hash: int, max_distance: int) -> List[Tuple[int, int, PerceptualEntry]]:
+        """Entries within `max_distance`, closest first (pHash distance, then dHash)"""
+        masks = self._masks(max_distance // _CHUNKS)
+        with self._lock:
+            candidates = set()
+            for table, chunk in zip(self._tables, self._chunks(p_hash)):
+                for mask in masks:
+                    bucket = table.get(chunk ^ mask)
+                    if bucket:
+                        candidates.update(bucket)
+
+            matches = []
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                distance = hamming(p_hash, entry.phash)
+                if distance <= max_distance:
+                    matches.append((distance, hamming(d_hash, entry.dhash), entry))
+        matches.sort(key=lambda match: match[:2])
+        return matches
+
+    def record_asset(self, digest: str, asset_key: str, asset: Any):
+        """Attach a generated asset to the indexed upload with this digest"""
+        with self._lock:
+            entry_id = self._by_digest.get(digest)
+            if entry_id is not None:
+                self._entries[entry_id].assets[asset_key] = asset
+
+    def find_asset(self, image: Image.Image, asset_key: str, max_distance: Optional[int] = None) -> Optional[Any]:
+        """Asset generated for `asset_key` from the closest near-duplicate that has one"""
+        max_distance = Settings.PHASH_MAX_DISTANCE if max_distance is None else max_distance
+        for _, _, entry in self._matches(phash(image), dhash(image), max_distance):
+            asset = entry.assets.get(asset_key)
+            if asset is not None and not getattr(asset, "expired", False):
+                return asset
+        return None
+
+
+_index: Optional[PerceptualIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_phash_index() -> PerceptualIndex:
+    """Process-wide near-duplicate index shared by every session"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = PerceptualIndex(Settings.PHASH_INDEX_MAX_ENTRIES)
+        return _index
@@ -0,0 +1,158 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from services.analysis_model import ImageAnalysis
+
+QUALITY_BOOSTER = "ultra-realistic, 8k resolution, cinematic lighting, professional marketing photograph."
+_SANITIZE_MARKERS = ("drinking", "open", "pouring")
+_SUBJECT_CACHE_SIZE = 1024
+
+
+class CompiledTemplate(NamedTuple):
+    """Everything in a prompt that does not depend on the image analysis"""
+    tail: str  # whitespace-normalized text that follows the subject
+    structure_lock: float
+    negative_prompt: str
+    sanitize: bool  # whether the cap-stripper applies to the subject
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def camera_instruction_for(specific_config: Optional[Dict[str, Any]]) -> str:
+    if not specific_config:
+        return ""
+    if "camera_prompt" in specific_config:
+        return specific_config["camera_prompt"]
+    if "camera_angle" in specific_config:  # Fallback for old key
+        return f"Use a {specific_config['camera_angle'].replace('_', ' ')} camera angle."
+    return ""
+
+
+def sanitize_subject(subject_prompt: str) -> str:
+    """Cap stripper: force an opened container for drinking/opening/pouring scenarios"""
+    subject_prompt = subject_prompt.replace("sealed", "opened")
+    subject_prompt = subject_prompt.replace("closed", "opened")
+    subject_prompt = subject_prompt.replace("cap", "")
+    subject_prompt = subject_prompt.replace("lid", "")
+    subject_prompt = subject_prompt.replace("cork", "")
+    # Prepend the "opened" state for clarity
+    if "bottle" in subject_prompt.lower():
+        subject_prompt = "opened bottle of " + subject_prompt
+    elif "can" in subject_prompt.lower():
+        subject_prompt = "opened can of " + subject_prompt
+    else:
+        subject_prompt = "opened " + subject_prompt
+    return subject_prompt + ", opened neck, liquid visible at rim"
+
+
+class PromptCompiler:
+    """
+    Builds Bria prompts from precompiled templates.
+
+    Every vibe x scenario x camera-angle combination is compiled once into a
+    CompiledTemplate whose tail is already whitespace-normalized. Because
+    " ".join(s.split()) of "<subject>. <tail>" equals the normalized
+    "<subject>." followed by " <normalized tail>", the per-request work is one
+    memoized subject lookup and one concatenation - with output byte-identical
+    to assembling and normalizing the full prompt every time.
+
+    Built by each registry snapshot (services.vibe_registry).
+    """
+
+    def __init__(
+        self,
+        vibe_configs: Mapping[str, Mapping[str, Any]],
+        scenarios: Mapping[str, Sequence[Mapping[str, Any]]],
+        camera_angles: Iterable[str],
+    ):
+        self._vibe_configs = vibe_configs
+        # First match wins, exactly like the category-by-category scan it replaces
+        self._scenarios_by_id: Dict[str, Mapping[str, Any]] = {}
+        for category_scenarios in scenarios.values():
+            if isinstance(category_scenarios, (list, tuple)):
+                for scenario in category_scenarios:
+                    self._scenarios_by_id.setdefault(scenario.get("id"), scenario)
+
+        self._lock = threading.Lock()
+        self._templates: Dict[Tuple[str, str, str], CompiledTemplate] = {}
+        self._subjects: "OrderedDict[tuple, str]" = OrderedDict()
+
+        camera_instructions = [""] + [camera_instruction_for({"camera_angle": a}) for a in camera_angles]
+        for vibe_name in vibe_configs:
+            for scenario_id in [""] + list(self._scenarios_by_id):
+                for camera_instruction in camera_instructions:
+                    key = (vibe_name, scenario_id, camera_instruction)
+                    self._templates[key] = self._compile(*key)
+
+    def _compile(self, vibe_name: str, scenario_id: str, camera_instruction: str) -> CompiledTemplate:
+        base_payload = self._vibe_configs.get(vibe_name, {}).get("payload", {})
+        prompt_modifier = ""
+        negative_prompt = base_payload.get("negative_prompt", "")
+
+        scenario = self._scenarios_by_id.get(scenario_id) if scenario_id else None
+        if scenario is not None:
+            if "prompt_modifier" in scenario:
+                prompt_modifier = scenario["prompt_modifier"]
+            if "negative_prompt" in scenario:
+                negative_prompt += ", " + scenario["negative_prompt"]
+
+        bg_prompt = base_payload.get("background_prompt", "clean background")
+        atmosphere = base_payload.get("atmosphere", "")
+        return CompiledTemplate(
+            tail=_normalize(f"{prompt_modifier} {camera_instruction} {bg_prompt}. {atmosphere} {QUALITY_BOOSTER}"),
+            structure_lock=base_payload.get("structure_lock", 0.9),
+            negative_prompt=negative_prompt,
+            sanitize=bool(scenario_id) and any(marker in scenario_id for marker in _SANITIZE_MARKERS),
+        )
+
+    def template(self, vibe_name: str, scenario_id: str, camera_instruction: str) -> CompiledTemplate:
+        key = (vibe_name, scenario_id, camera_instruction)
+        compiled = self._templates.get(key)
+        if compiled is None:
+            # Free-form camera prompts or unknown ids: compile once, reuse after
+            compiled = self._compile(*key)
+            with self._lock:
+                self._templates[key] = compiled
+        return compiled
+
+    def subject_head(self, image_analysis: ImageAnalysis, sanitize: bool) -> str:
+        """Normalized "<subject>." prefix, memoized per subject prompt"""
+        key = (image_analysis.subject_prompt, sanitize)
+        with self._lock:
+            head = self._subjects.get(key)
+            if head is not None:
+                self._subjects.move_to_end(key)
+                return head
+
+        subject_prompt = image_analysis.subject_prompt
+        head = _normalize((sanitize_subject(subject_prompt) if sanitize else subject_prompt) + ".")
+
+        with self._lock:
+            self._subjects[key] = head
+            while len(self._subjects) > _SUBJECT_CACHE_SIZE:
+                self._subjects.popitem(last=False)
+        return head
+
+    def build(
+        self, vibe_name: str, image_analysis: ImageAnalysis, specific_config: Optional[Dict[str, Any]]
+    ) -> Tuple[str, float, str]:
+        """(prompt, structure_lock, negative_prompt) for one vibe configuration"""
+        scenario_id = specific_config.get("scenario_id", "").lower() if specific_config else ""
+        compiled = self.template(vibe_name, scenario_id, camera_instruction_for(specific_config))
+
+        structure_lock = compiled.structure_lock
+        if specific_config and "structure_lock" in specific_config:
+            structure_lock = specific_config["structure_lock"]
+
+        head = self.subject_head(image_analysis, compiled.sanitize)
+        return f"{head} {compiled.tail}", structure_lock, compiled.negative_prompt
+
+
+def get_prompt_compiler() -> PromptCompiler:
+    """Compiler of the live registry snapshot; replaced whenever the registry reloads"""
+    from services.vibe_registry import get_registry  # the registry builds compilers, so import lazily
+
+    return get_registry().compiler
@@ -0,0 +1,250 @@
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+from config.settings import Settings
+from utils.cancellation import CancellationToken
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+
+_PRIORITY_RANK = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1}
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a call waited longer than allowed for a rate-limit slot"""
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `rate` tokens per second"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        elapsed = max(0.0, now - self.updated_at)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def try_consume(self, reserve: float = 0.0) -> float:
+        """
+        Take one token if available while keeping `reserve` tokens untouched.
+
+        Returns:
+            0.0 when a token was consumed, otherwise seconds until one may be
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        needed = 1.0 + reserve
+        if self.tokens >= needed:
+            self.tokens -= 1.0
+            return 0.0
+        return (needed - self.tokens) / self.rate if self.rate > 0 else 1.0
+
+    def drain(self, retry_after: float):
+        """Empty the bucket and block it, e.g. after the provider answered 429"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+
+
+class _Ticket:
+    __slots__ = ("sort_key", "session_id", "priority", "enqueued_at")
+
+    def __init__(self, sort_key, session_id: str, priority: str):
+        self.sort_key = sort_key
+        self.session_id = session_id
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other: "_Ticket") -> bool:
+        return self.sort_key < other.sort_key
+
+
+class _Lane:
+    """Queue of waiting calls sharing one token bucket (one provider + API key)"""
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.waiters = []
+        self.virtual_time = 0.0
+        self.session_finish: Dict[str, float] = {}
+        self.granted = 0
+        self.throttled = 0
+        self.wait_times = {p: deque(maxlen=500) for p in _PRIORITY_RANK}
+
+    def enqueue(self, session_id: str, priority: str, seq: int) -> _Ticket:
+        # Start-time fair queuing: each session advances its own virtual clock,
+        # so a session with many queued calls cannot crowd out a newcomer.
+        start = max(self.virtual_time, self.session_finish.get(session_id, 0.0))
+        self.session_finish[session_id] = start + 1.0
+        ticket = _Ticket((_PRIORITY_RANK[priority], start, seq), session_id, priority)
+        heapq.heappush(self.waiters, ticket)
+        return ticket
+
+    def head(self) -> Optional[_Ticket]:
+        return self.waiters[0] if self.waiters else None
+
+    def remove(self, ticket: _Ticket):
+        if ticket in self.waiters:
+            self.waiters.remove(ticket)
+            heapq.heapify(self.waiters)
+            self._prune()
+
+    def grant(self, ticket: _Ticket):
+        heapq.heappop(self.waiters)
+        self.virtual_time = max(self.virtual_time, ticket.sort_key[1])
+        self._prune()
+        self.granted += 1
+        self.wait_times[ticket.priority].append(time.monotonic() - ticket.enqueued_at)
+
+    def _prune(self):
+        """Forget finish times that can no longer affect ordering, so the map stays bounded"""
+        if not self.waiters:
+            # Idle lane: the backlog is over, every session starts level again
+            self.virtual_time = max(self.session_finish.values(), default=self.virtual_time)
+            self.session_finish.clear()
+        elif len(self.session_finish) > 2 * len(self.waiters):
+            self.session_finish = {
+                s: finish for s, finish in self.session_finish.items() if finish > self.virtual_time
+            }
+
+
+class OutboundScheduler:
+    """
+    Fair-share scheduler in front of outbound provider calls.
+
+    Every (provider, API key) pair gets its own token bucket. Waiting calls are
+    served interactive-first, then in per-session fair order. Batch calls may
+    only spend tokens above BATCH_RESERVE_FRACTION of the bucket, so interactive
+    requests keep finding capacity while batch jobs soak up the rest.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._lanes: Dict[tuple, _Lane] = {}
+        self._seq = itertools.count()
+
+    @staticmethod
+    def _key_id(api_key: Optional[str]) -> str:
+        return hashlib.sha256((api_key or "").encode()).hexdigest()[:12]
+
+    def _lane(self, provider: str, api_key: Optional[str]) -> _Lane:
+        lane_key = (provider, self._key_id(api_key))
+        lane = self._lanes.get(lane_key)
+        if lane is None:
+            limits = Settings.RATE_LIMITS_PER_KEY.get(api_key) or Settings.RATE_LIMITS.get(
+                provider, {"rate": 1.0, "burst": 1}
+            )
+            lane = _Lane(TokenBucket(limits["rate"], limits["burst"]))
+            self._lanes[lane_key] = lane
+        return lane
+
+    @contextmanager
+    def acquire(
+        self,
+        provider: str,
+        api_key: Optional[str],
+        session_id: Optional[str] = None,
+        priority: str = PRIORITY_INTERACTIVE,
+        timeout: Optional[float] = None,
+        cancel_token: Optional[CancellationToken] = None,
+    ):
+        """Block until the call may proceed, then run the body of the `with` block"""
+        if priority not in _PRIORITY_RANK:
+            raise ValueError(f"Unknown priority class: {priority}")
+        timeout = Settings.RATE_LIMIT_MAX_WAIT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        # Wake up regularly so a cancelled caller leaves the queue promptly
+        wake_interval = 0.25 if cancel_token is not None else None
+
+        with self._cond:
+            lane = self._lane(provider, api_key)
+            ticket = lane.enqueue(session_id or "anonymous", priority, next(self._seq))
+            reserve = 0.0
+            if priority == PRIORITY_BATCH:
+                reserve = lane.bucket.capacity * Settings.BATCH_RESERVE_FRACTION
+            try:
+                while True:
+                    if cancel_token is not None:
+                        cancel_token.raise_if_cancelled()
+                    wait = None
+                    if lane.head() is ticket:
+                        wait = lane.bucket.try_consume(reserve=reserve)
+                        if wait == 0.0:
+                            lane.grant(ticket)
+                            self._cond.notify_all()
+                            break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RateLimitTimeout(
+                            f"Waited more than {timeout:.0f}s for a {provider} rate-limit slot"
+                        )
+                    self._cond.wait(timeout=min(x for x in (wait, remaining, wake_interval) if x))
+            except BaseException:
+                lane.remove(ticket)
+                self._cond.notify_all()
+                raise
+
+        yield
+
+    def report_throttled(self, provider: str, api_key: Optional[str], retry_after: float = 5.0):
+        """Tell the scheduler the provider rejected a call with HTTP 429"""
+        with self._cond:
+            lane = self._lane(provider, api_key)
+            lane.throttled += 1
+            lane.bucket.drain(retry_after)
+            self._cond.notify_all()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Queue depth and wait-time statistics per provider/key lane"""
+        with self._cond:
+            snapshot = {}
+            for (provider, key_id), lane in self._lanes.items():
+                queued = {p: 0 for p in _PRIORITY_RANK}
+                for ticket in lane.waiters:
+                    queued[ticket.priority] += 1
+                waits = {}
+                for priority, samples in lane.wait_times.items():
+                    ordered = sorted(samples)
+                    waits[priority] = {
+                        "count": len(ordered),
+                        "mean_s": round(sum(ordered) / len(ordered), 3) if ordered else 0.0,
+                        "p95_s": round(ordered[int(0.95 * (len(ordered) - 1))], 3) if ordered else 0.0,
+                        "max_s": round(ordered[-1], 3) if ordered else 0.0,
+                    }
+                snapshot[f"{provider}:{key_id}"] = {
+                    "queue_depth": queued,
+                    "tokens_available": round(lane.bucket.tokens, 2),
+                    "granted": lane.granted,
+                    "throttled": lane.throttled,
+                    "wait_times": waits,
+                }
+            return snapshot
+
+
+_scheduler: Optional[OutboundScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> OutboundScheduler:
+    """Process-wide scheduler shared by every Streamlit session"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = OutboundScheduler()
+        return _scheduler
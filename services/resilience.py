@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Optional
+
+from utils.cancellation import CancellationToken
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is refused because the circuit breaker is open"""
+
+
+class LatencyTracker:
+    """Rolling window of observed call latencies"""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, p: float, min_samples: int = 1) -> Optional[float]:
+        """Latency at quantile `p` (0-1), or None until enough samples exist"""
+        with self._lock:
+            if len(self._samples) < max(1, min_samples):
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(p * (len(ordered) - 1) + 0.5))]
+
+
+class CircuitBreaker:
+    """
+    Error-rate circuit breaker.
+
+    CLOSED: calls pass, outcomes are recorded over a sliding time window.
+    OPEN: once the error rate crosses the threshold, calls fail fast for `cooldown` seconds.
+    HALF_OPEN: a single probe call is let through; success closes, failure re-opens.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, error_rate: float = 0.5, min_calls: int = 5, window: float = 60.0, cooldown: float = 30.0):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self._outcomes = deque()
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            return self._state
+
+    def _maybe_half_open(self, now: float):
+        if self._state == self.OPEN and now - self._opened_at >= self.cooldown:
+            self._state = self.HALF_OPEN
+            self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """Whether a call may proceed right now"""
+        with self._lock:
+            now = time.monotonic()
+            self._maybe_half_open(now)
+            if self._state == self.CLOSED:
+                return True
+            # A probe that never reported back must not wedge the breaker half-open
+            probe_stale = now - self._probe_started >= self.cooldown
+            if self._state == self.HALF_OPEN and (not self._probe_in_flight or probe_stale):
+                self._probe_in_flight = True
+                self._probe_started = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._record(True)
+            if self._state == self.HALF_OPEN:
+                self._state = self.CLOSED
+                self._outcomes.clear()
+
+    def record_failure(self):
+        with self._lock:
+            now = self._record(False)
+            if self._state == self.HALF_OPEN:
+                self._open(now)
+                return
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.error_rate:
+                self._open(now)
+
+    def _record(self, ok: bool) -> float:
+        now = time.monotonic()
+        self._outcomes.append((now, ok))
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._outcomes.popleft()
+        return now
+
+    def _open(self, now: float):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._probe_in_flight = False
+
+
+def hedged_call(
+    fn: Callable[[CancellationToken], Any],
+    hedge_after: Optional[float],
+    executor: ThreadPoolExecutor,
+    cancel_token: Optional[CancellationToken] = None,
+) -> Any:
+    """
+    Run `fn`, and if it has not finished after `hedge_after` seconds start a
+    duplicate. The first successful result wins; the loser's token is
+    cancelled so it stops polling/downloading at its next checkpoint.
+
+    Each attempt receives a child of `cancel_token`, so cancelling the caller
+    stops both. With `hedge_after=None` the call is made once, inline.
+    """
+    cancel_token = cancel_token or CancellationToken()
+    if hedge_after is None:
+        return fn(cancel_token)
+
+    attempts = {}
+    primary_token = cancel_token.child()
+    attempts[executor.submit(fn, primary_token)] = primary_token
+
+    done, _ = wait(attempts, timeout=hedge_after)
+    if not done and not cancel_token.is_set():
+        hedge_token = cancel_token.child()
+        attempts[executor.submit(fn, hedge_token)] = hedge_token
+
+    pending = set(attempts)
+    last_error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            error = future.exception()
+            if error is None:
+                for loser in pending:
+                    attempts[loser].cancel("hedge lost")
+                    loser.cancel()
+                return future.result()
+            last_error = error
+
+    raise last_error
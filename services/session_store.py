@@ -0,0 +1,116 @@
+import io
+import json
+import re
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+from PIL import Image
+
+from services.analysis_model import ImageAnalysis
+from services.assets import RemoteResult
+from services.cache_backend import SESSIONS, UPLOADS, get_cache
+
+_TOKEN_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+_SNAPSHOT_VERSION = 1
+
+
+class SessionSnapshot:
+    """
+    Compact, resumable copy of one session: digests, analysis JSON, result
+    handles and the vibe selection - never image bytes.
+    """
+
+    def __init__(
+        self,
+        upload_digest: Optional[str] = None,
+        analysis: Optional[ImageAnalysis] = None,
+        results: Optional[Dict[str, Dict[str, Any]]] = None,
+        selected_vibes: Optional[List[str]] = None,
+        vibe_configs: Optional[Dict[str, Any]] = None,
+    ):
+        self.upload_digest = upload_digest
+        self.analysis = analysis
+        self.results: "OrderedDict[str, Dict[str, Any]]" = OrderedDict(results or {})
+        self.selected_vibes = list(selected_vibes or [])
+        self.vibe_configs = dict(vibe_configs or {})
+
+    @staticmethod
+    def result_handle(result: RemoteResult) -> Optional[Dict[str, Any]]:
+        """Serializable handle, or None for results that only exist locally (e.g. mocks)"""
+        if not result.image_url:
+            return None
+        try:
+            return json.loads(result.to_bytes())
+        except (TypeError, ValueError):
+            return None
+
+    def generated_images(self) -> "OrderedDict[str, RemoteResult]":
+        """Result handles as RemoteResults; nothing is downloaded until fetched"""
+        return OrderedDict((label, RemoteResult.from_dict(handle)) for label, handle in self.results.items())
+
+    def to_bytes(self) -> bytes:
+        return json.dumps({
+            "version": _SNAPSHOT_VERSION,
+            "upload_digest": self.upload_digest,
+            "analysis": self.analysis.to_dict() if self.analysis is not None else None,
+            "results": self.results,
+            "selected_vibes": self.selected_vibes,
+            "vibe_configs": self.vibe_configs,
+        }, sort_keys=True, default=str).encode()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Optional["SessionSnapshot"]:
+        try:
+            raw = json.loads(data)
+        except ValueError:
+            return None
+        if raw.get("version") != _SNAPSHOT_VERSION:
+            return None
+        try:
+            analysis = ImageAnalysis.from_dict(raw["analysis"]) if raw.get("analysis") else None
+        except ValueError:
+            return None
+        return cls(
+            raw.get("upload_digest"),
+            analysis,
+            raw.get("results"),
+            raw.get("selected_vibes"),
+            raw.get("vibe_configs"),
+        )
+
+
+class SessionStore:
+    """Session snapshots in the shared cache, keyed by the session's resume token"""
+
+    @staticmethod
+    def valid_token(token: Optional[str]) -> bool:
+        return bool(token) and bool(_TOKEN_PATTERN.match(token))
+
+    @staticmethod
+    def load(token: str) -> Optional[SessionSnapshot]:
+        data = get_cache().get(SESSIONS, token)
+        if data is None:
+            return None
+        snapshot = SessionSnapshot.from_bytes(data)
+        if snapshot is None:
+            print(f"Discarding unreadable session snapshot {token[:8]}")
+        return snapshot
+
+    @staticmethod
+    def save(token: str, data: bytes):
+        """Store an encoded snapshot (SessionSnapshot.to_bytes)"""
+        try:
+            get_cache().set(SESSIONS, token, data)
+        except Exception as e:
+            print(f"Session snapshot not saved: {e}")
+
+    @staticmethod
+    def delete(token: str):
+        get_cache().delete(SESSIONS, token)
+
+    @staticmethod
+    def load_upload(digest: str) -> Optional[Image.Image]:
+        """The upload as stored by ImageService.encode_image; decoded lazily by Pillow"""
+        data = get_cache().get(UPLOADS, f"{digest}.png")
+        if data is None:
+            return None
+        return Image.open(io.BytesIO(data))
@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from utils.cancellation import CancellationToken
+
+try:
+    import fcntl
+except ImportError:  # Windows: cross-process coalescing is unavailable
+    fcntl = None
+
+
+def payload_key(payload: Dict[str, Any], image_digest: str) -> str:
+    """Stable key for a generation request: final API payload plus source image digest"""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{image_digest}:{canonical}".encode()).hexdigest()
+
+
+class _Call:
+    __slots__ = ("event", "result", "error", "attached", "job_token")
+
+    def __init__(self, job_token: CancellationToken):
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.attached = 0
+        self.job_token = job_token
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls into one execution.
+
+    The first caller for a key (the leader) runs the function; callers arriving
+    while it is in flight wait and receive the same result or exception. When
+    `lock_dir` is set, leaders in different worker processes also serialize on
+    a lock file and share the serialized result for `result_ttl` seconds.
+
+    The job runs on its own thread under its own cancellation token, which is
+    cancelled only once every attached caller has cancelled - one session
+    leaving does not stop a render another session is still waiting for. Every
+    caller, the leader included, returns as soon as its own token fires.
+    """
+
+    LOCK_POLL_INTERVAL = 0.1  # seconds between attempts on another process's lock
+
+    def __init__(self, lock_dir: Optional[str] = None, result_ttl: float = 120.0):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    def in_flight(self) -> int:
+        """Number of distinct keys currently executing in this process"""
+        with self._lock:
+            return len(self._calls)
+
+    def do(
+        self,
+        key: str,
+        fn: Callable[[CancellationToken], Any],
+        serialize: Optional[Callable[[Any], bytes]] = None,
+        deserialize: Optional[Callable[[bytes], Any]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> Any:
+        """Run `fn(job_token)` once per in-flight `key` and return its result to every caller"""
+        cancel_token = cancel_token or CancellationToken()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                # The leader's deadline bounds the shared job
+                call = _Call(CancellationToken(timeout=cancel_token.remaining()))
+                self._calls[key] = call
+            call.attached += 1
+        detach = self._detacher(call)
+        cancel_token.add_callback(detach)
+
+        if leader:
+            # Not run on this thread, so the leader can leave while followers still wait
+            threading.Thread(
+                target=self._run, args=(key, call, fn, serialize, deserialize), name="single-flight", daemon=True
+            ).start()
+        while not call.event.wait(0.25):
+            if cancel_token.is_set():
+                detach()
+                cancel_token.raise_if_cancelled()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _run(
+        self,
+        key: str,
+        call: _Call,
+        fn: Callable[[CancellationToken], Any],
+        serialize: Optional[Callable[[Any], bytes]],
+        deserialize: Optional[Callable[[bytes], Any]],
+    ):
+        """Execute the shared job and hand its result or exception to every attached caller"""
+        try:
+            if self.lock_dir and serialize and deserialize:
+                call.result = self._run_across_processes(key, fn, serialize, deserialize, call.job_token)
+            else:
+                call.result = fn(call.job_token)
+        except BaseException as e:
+            call.error = e
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def _detacher(self, call: _Call) -> Callable[[], None]:
+        """Per-caller, idempotent detach; the job is cancelled once nobody is left"""
+        detached = threading.Event()
+
+        def detach():
+            with self._lock:
+                if detached.is_set() or call.event.is_set():
+                    return
+                detached.set()
+                call.attached -= 1
+                orphaned = call.attached == 0
+            if orphaned:
+                call.job_token.cancel("all callers cancelled")
+
+        return detach
+
+    def _run_across_processes(
+        self,
+        key: str,
+        fn: Callable[[CancellationToken], Any],
+        serialize: Callable[[Any], bytes],
+        deserialize: Callable[[bytes], Any],
+        job_token: CancellationToken,
+    ) -> Any:
+        lock_path = os.path.join(self.lock_dir, f"{key}.lock")
+        result_path = os.path.join(self.lock_dir, f"{key}.result")
+
+        with self._acquire(lock_path, job_token) as lock_file:
+            try:
+                try:
+                    if time.time() - os.path.getmtime(result_path) < self.result_ttl:
+                        with open(result_path, "rb") as f:
+                            return deserialize(f.read())
+                except FileNotFoundError:
+                    pass
+
+                result = fn(job_token)
+                if result is None:
+                    return None
+
+                fd, tmp_path = tempfile.mkstemp(dir=self.lock_dir, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(serialize(result))
+                os.replace(tmp_path, result_path)
+                self._sweep_expired()
+                return result
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _acquire(self, lock_path: str, job_token: CancellationToken):
+        """
+        Open `lock_path` and take its exclusive lock, polling so a wait behind
+        another process's leader still honours the job's cancellation and deadline
+        """
+        while True:
+            lock_file = open(lock_path, "a+b")
+            try:
+                while not self._try_lock(lock_file):
+                    job_token.raise_if_cancelled()
+                    job_token.wait(self.LOCK_POLL_INTERVAL)
+                # The sweep may have unlinked the file while we waited; a lock on
+                # the orphaned inode excludes nobody, so start over on the new one
+                if self._same_file(lock_file, lock_path):
+                    return lock_file
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    @staticmethod
+    def _try_lock(lock_file) -> bool:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    @staticmethod
+    def _same_file(lock_file, path: str) -> bool:
+        try:
+            return os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path))
+        except FileNotFoundError:
+            return False
+
+    def _sweep_expired(self):
+        """Drop shared results and idle lock files older than the TTL so the lock dir does not grow"""
+        cutoff = time.time() - self.result_ttl
+        for name in os.listdir(self.lock_dir):
+            path = os.path.join(self.lock_dir, name)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                if name.endswith(".result"):
+                    os.remove(path)
+                elif name.endswith(".lock"):
+                    self._remove_idle_lock(path)
+            except OSError:
+                pass
+
+    def _remove_idle_lock(self, path: str):
+        """Unlink a lock file only while holding it, so no leader is running on it"""
+        with open(path, "a+b") as lock_file:
+            if not self._try_lock(lock_file):
+                return
+            try:
+                if self._same_file(lock_file, path):
+                    os.remove(path)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import weakref
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+from PIL import Image
+
+from config.settings import Settings
+from services.bria_service import BriaService
+from services.analysis_model import ImageAnalysis
+from services.assets import RemoteResult
+from services.rate_limiter import PRIORITY_BATCH
+from services.vibe_registry import get_registry
+from utils.cancellation import CancellationToken
+
+_executor = ThreadPoolExecutor(max_workers=Settings.SPECULATION_MAX_WORKERS, thread_name_prefix="speculate")
+
+# Used until a category has enough history of its own
+_DEFAULT_PRIORS = [
+    ("Marketplace Clean", {"camera_angle": "eye_level"}),
+    ("Consumption/Active", None),  # filled with the top suggested scenario
+]
+
+
+def match_scenario_category(image_analysis: Optional[ImageAnalysis]) -> str:
+    """Scenario category for an analysis, by first keyword match in the subject description"""
+    if image_analysis is None or not image_analysis.subject_text:
+        return "default"
+
+    return get_registry().match_category(image_analysis.subject_text)
+
+
+def config_key(vibe_name: str, specific_config: Optional[Dict[str, Any]]) -> str:
+    """Canonical identity of a vibe configuration"""
+    return f"{vibe_name}|{json.dumps(specific_config or {}, sort_keys=True)}"
+
+
+class SelectionHistory:
+    """Process-wide counts of which configurations users pick per product category"""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Counter] = {}
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                raw = json.load(f)
+            self._counts = {category: Counter(counts) for category, counts in raw.items()}
+        except (OSError, ValueError):
+            self._counts = {}
+
+    def _save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._counts, f)
+        os.replace(tmp_path, self.path)
+
+    def record(self, category: str, vibe_name: str, specific_config: Optional[Dict[str, Any]]):
+        with self._lock:
+            self._counts.setdefault(category, Counter())[config_key(vibe_name, specific_config)] += 1
+            try:
+                self._save()
+            except OSError as e:
+                print(f"Could not persist selection history: {e}")
+
+    def top(self, category: str, n: int) -> List[Tuple[str, Dict[str, Any]]]:
+        """Most frequently picked (vibe, config) pairs for the category"""
+        with self._lock:
+            ranked = self._counts.get(category, Counter()).most_common(n)
+        top = []
+        for key, _ in ranked:
+            vibe_name, raw_config = key.split("|", 1)
+            top.append((vibe_name, json.loads(raw_config)))
+        return top
+
+
+history = SelectionHistory(Settings.SPECULATION_HISTORY_PATH)
+
+
+class SpeculativeSession:
+    """
+    Per-session speculative preview renders.
+
+    Right after analysis, the likeliest vibe configurations for the product
+    category are rendered at preview resolution on the batch priority class.
+    A render the user then selects is promoted as-is; the rest are cancelled
+    or evicted. At most SPECULATION_MAX_RENDERS_PER_SESSION renders are ever
+    started for one session.
+    """
+
+    def __init__(self):
+        self._futures: Dict[str, Future] = {}
+        self._session_token = CancellationToken()
+        self._token = self._session_token.child()
+        self.spent = 0
+        # Session teardown drops this object; stop its renders with it
+        weakref.finalize(self, self._session_token.cancel, "session closed")
+
+    def start(
+        self,
+        image: Image.Image,
+        image_analysis: ImageAnalysis,
+        scenarios: List[Dict[str, str]],
+        bria_key: str,
+        session_id: Optional[str] = None,
+        image_digest: Optional[str] = None,
+    ):
+        """Kick off background preview renders for the most likely configurations"""
+        self.cancel_all()
+        budget = Settings.SPECULATION_MAX_RENDERS_PER_SESSION - self.spent
+        if budget <= 0:
+            return
+
+        self._token = self._session_token.child()
+        bria_service = BriaService(bria_key, session_id=session_id, priority=PRIORITY_BATCH)
+        for vibe_name, specific_config in self.predict(image_analysis, scenarios, budget):
+            key = config_key(vibe_name, specific_config)
+            self._futures[key] = _executor.submit(
+                bria_service.generate_image,
+                image,
+                vibe_name,
+                image_analysis,
+                specific_config=specific_config,
+                resolution=(Settings.PREVIEW_WIDTH, Settings.PREVIEW_HEIGHT),
+                cancel_token=self._token,
+                image_digest=image_digest,
+            )
+            self.spent += 1
+
+    @staticmethod
+    def predict(
+        image_analysis: ImageAnalysis, scenarios: List[Dict[str, str]], n: int
+    ) -> List[Tuple[str, Dict[str, Any]]]:
+        """Likeliest configurations: category history first, then default priors"""
+        valid_scenarios = {s["id"] for s in scenarios}
+        candidates = []
+        for vibe_name, specific_config in history.top(match_scenario_category(image_analysis), n * 2):
+            # A scenario the user can no longer pick is not worth rendering
+            if specific_config.get("scenario_id") and specific_config["scenario_id"] not in valid_scenarios:
+                continue
+            candidates.append((vibe_name, specific_config))
+
+        for vibe_name, specific_config in _DEFAULT_PRIORS:
+            if vibe_name == "Consumption/Active":
+                if not scenarios:
+                    continue
+                specific_config = {"scenario_id": scenarios[0]["id"]}
+            candidates.append((vibe_name, specific_config))
+
+        unique, seen = [], set()
+        for vibe_name, specific_config in candidates:
+            key = config_key(vibe_name, specific_config)
+            if key not in seen:
+                seen.add(key)
+                unique.append((vibe_name, specific_config))
+        return unique[:n]
+
+    def take(self, vibe_name: str, specific_config: Optional[Dict[str, Any]]) -> Optional[RemoteResult]:
+        """Promote a finished speculative render matching the user's selection"""
+        future = self._futures.get(config_key(vibe_name, specific_config))
+        if future is None or not future.done() or future.cancelled() or future.exception() is not None:
+            return None
+        del self._futures[config_key(vibe_name, specific_config)]
+        return future.result()
+
+    def cancel_all(self):
+        """Cancel queued and running renders and evict finished ones"""
+        self._token.cancel("speculation evicted")
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
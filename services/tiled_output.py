@@ -0,0 +1,105 @@
+import mmap
+import struct
+import tempfile
+import zlib
+from typing import BinaryIO, Optional
+
+from PIL import Image
+
+from config.settings import Settings
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_COLOR_TYPES = {"RGB": (2, 3), "RGBA": (6, 4)}  # mode -> (color type, bytes per pixel)
+_IDAT_CHUNK_BYTES = 256 * 1024
+
+
+class PNGStripWriter:
+    """
+    Streaming PNG encoder fed one horizontal strip at a time.
+
+    Rows are deflated as they arrive and flushed as IDAT chunks, so neither
+    the raster nor the encoded file is ever held whole in memory.
+    """
+
+    def __init__(self, stream: BinaryIO, width: int, height: int, mode: str = "RGB", compress_level: int = None):
+        if mode not in _PNG_COLOR_TYPES:
+            raise ValueError(f"Unsupported strip mode: {mode}")
+        self.stream = stream
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.rows_written = 0
+        color_type, self._bpp = _PNG_COLOR_TYPES[mode]
+        level = Settings.MOCK_PNG_COMPRESS_LEVEL if compress_level is None else compress_level
+        self._deflate = zlib.compressobj(level)
+        self._pending = bytearray()
+
+        stream.write(_PNG_SIGNATURE)
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self.stream.write(struct.pack(">I", len(data)))
+        self.stream.write(kind)
+        self.stream.write(data)
+        self.stream.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)) & 0xFFFFFFFF))
+
+    def _flush_idat(self, final: bool = False):
+        while len(self._pending) >= _IDAT_CHUNK_BYTES or (final and self._pending):
+            self._chunk(b"IDAT", bytes(self._pending[:_IDAT_CHUNK_BYTES]))
+            del self._pending[:_IDAT_CHUNK_BYTES]
+
+    def write_strip(self, strip: Image.Image):
+        """Append the next `strip.height` rows of the image"""
+        if strip.width != self.width or self.rows_written + strip.height > self.height:
+            raise ValueError("Strip does not fit the remaining canvas")
+        raw = strip.convert(self.mode).tobytes() if strip.mode != self.mode else strip.tobytes()
+        stride = self.width * self._bpp
+        # Filter type 0 (None) on every row: a zero byte in front of each scanline
+        rows = bytearray(len(raw) + strip.height)
+        for row in range(strip.height):
+            start = row * (stride + 1)
+            rows[start + 1:start + 1 + stride] = raw[row * stride:(row + 1) * stride]
+        self._pending += self._deflate.compress(bytes(rows))
+        self.rows_written += strip.height
+        self._flush_idat()
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+        self._pending += self._deflate.flush()
+        self._flush_idat(final=True)
+        self._chunk(b"IEND", b"")
+
+
+class MemmapCanvas:
+    """
+    Raster backed by a memory-mapped temp file, filled one strip at a time.
+
+    The finished image maps the file without copying, so its pages are
+    file-backed and can be reclaimed under memory pressure. The raster is
+    RGBA (opaque) because Pillow can only map 4-byte pixel layouts.
+    """
+
+    def __init__(self, width: int, height: int, directory: Optional[str] = None):
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._stride = width * 4
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._file.truncate(self._stride * height)
+        self._map = mmap.mmap(self._file.fileno(), self._stride * height)
+        self._file.close()  # the mapping keeps the (already unlinked) file alive
+
+    def write_strip(self, strip: Image.Image):
+        """Copy the next `strip.height` rows into the mapped buffer"""
+        if strip.width != self.width or self.rows_written + strip.height > self.height:
+            raise ValueError("Strip does not fit the remaining canvas")
+        offset = self.rows_written * self._stride
+        self._map[offset:offset + strip.height * self._stride] = strip.convert("RGBA").tobytes()
+        self.rows_written += strip.height
+
+    def image(self) -> Image.Image:
+        """The finished canvas; read-only, sharing memory with the mapping"""
+        if self.rows_written != self.height:
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+        return Image.frombuffer("RGBA", (self.width, self.height), self._map, "raw", "RGBA", 0, 1)
@@ -0,0 +1,273 @@
+import csv
+import io
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from typing import Dict, Any, List, Optional, Tuple
+
+from config.settings import Settings
+
+SCOPES = ("session", "user", "batch")
+
+
+class BudgetExceeded(Exception):
+    """Raised when a request would exceed a configured usage budget"""
+
+
+class UsageRecord:
+    """One billable provider call"""
+
+    __slots__ = (
+        "timestamp", "provider", "session_id", "user_id", "batch_id", "model", "tier",
+        "width", "height", "renders", "input_tokens", "output_tokens", "seconds", "cost", "outcome",
+    )
+
+    FIELDS = __slots__
+
+    def __init__(self, provider: str, scope: Dict[str, Optional[str]], **fields):
+        self.timestamp = time.time()
+        self.provider = provider
+        self.session_id = scope.get("session")
+        self.user_id = scope.get("user")
+        self.batch_id = scope.get("batch")
+        for name in ("model", "tier", "outcome"):
+            setattr(self, name, fields.get(name, ""))
+        for name in ("width", "height", "renders", "input_tokens", "output_tokens"):
+            setattr(self, name, int(fields.get(name) or 0))
+        self.seconds = float(fields.get("seconds") or 0.0)
+        self.cost = float(fields.get("cost") or 0.0)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class _Totals:
+    __slots__ = ("cost", "full_renders", "preview_renders", "gemini_tokens", "seconds", "calls")
+
+    def __init__(self):
+        self.cost = 0.0
+        self.full_renders = 0
+        self.preview_renders = 0
+        self.gemini_tokens = 0
+        self.seconds = 0.0
+        self.calls = 0
+
+    def add(self, record: UsageRecord):
+        self.cost += record.cost
+        if record.tier == "full":
+            self.full_renders += record.renders
+        elif record.tier == "preview":
+            self.preview_renders += record.renders
+        self.gemini_tokens += record.input_tokens + record.output_tokens
+        self.seconds += record.seconds
+        self.calls += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "cost": round(self.cost, 4),
+            "full_renders": self.full_renders,
+            "preview_renders": self.preview_renders,
+            "gemini_tokens": self.gemini_tokens,
+            "seconds": round(self.seconds, 1),
+            "calls": self.calls,
+        }
+
+
+class RenderReservation:
+    """Budget held for a Bria render from admission until it is settled"""
+
+    __slots__ = ("reservation_id", "scope", "tier", "resolution", "renders", "cost", "downgraded")
+
+    def __init__(
+        self, reservation_id: int, scope: Dict[str, Optional[str]], tier: str, resolution: Tuple[int, int], renders: int = 1
+    ):
+        self.reservation_id = reservation_id
+        self.scope = scope
+        self.tier = tier
+        self.resolution = resolution
+        self.renders = renders
+        self.cost = Settings.BRIA_RENDER_COST[tier] * renders
+        self.downgraded = False
+
+
+class UsageLedger:
+    """
+    Process-wide accounting of provider usage per session, user and batch job.
+
+    Gemini calls are recorded with the token counts from the response's
+    usage_metadata; Bria renders by resolution tier with their wall time.
+    Renders are admitted against USAGE_BUDGETS before they start and hold a
+    reservation until settled, so concurrent jobs cannot overshoot a budget.
+    """
+
+    def __init__(self, max_records: int = 50_000):
+        self._records = deque(maxlen=max_records)
+        self._totals: Dict[Tuple[str, str], _Totals] = {}
+        self._pending: Dict[int, RenderReservation] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def scope(session_id: Optional[str], user_id: Optional[str] = None, batch_id: Optional[str] = None):
+        return {"session": session_id, "user": user_id, "batch": batch_id}
+
+    # ----- recording -----
+
+    def record(self, record: UsageRecord):
+        with self._lock:
+            self._records.append(record)
+            for kind in SCOPES:
+                scope_id = getattr(record, f"{kind}_id")
+                if scope_id:
+                    self._totals.setdefault((kind, scope_id), _Totals()).add(record)
+
+    def record_gemini(self, scope: Dict[str, Optional[str]], model: str, usage_metadata: Any, seconds: float, outcome: str = "ok"):
+        """Record a Gemini call from the response's usage_metadata"""
+        input_tokens = getattr(usage_metadata, "prompt_token_count", 0) or 0
+        output_tokens = getattr(usage_metadata, "candidates_token_count", 0) or 0
+        prices = Settings.GEMINI_TOKEN_COST
+        self.record(UsageRecord(
+            "gemini",
+            scope,
+            model=model,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            seconds=seconds,
+            cost=input_tokens * prices["input"] / 1e6 + output_tokens * prices["output"] / 1e6,
+            outcome=outcome,
+        ))
+
+    # ----- budgets -----
+
+    def _projected(self, kind: str, scope_id: str) -> Dict[str, float]:
+        """Committed totals plus renders admitted but not yet settled"""
+        totals = self._totals.get((kind, scope_id)) or _Totals()
+        projected = {"cost": totals.cost, "full_renders": totals.full_renders, "gemini_tokens": totals.gemini_tokens}
+        for reservation in self._pending.values():
+            if reservation.scope.get(kind) == scope_id:
+                projected["cost"] += reservation.cost
+                projected["full_renders"] += reservation.renders if reservation.tier == "full" else 0
+        return projected
+
+    def _violation(self, scope: Dict[str, Optional[str]], extra: Dict[str, float]) -> Optional[str]:
+        """First budget that `extra` more usage would exceed, as a message"""
+        for kind in SCOPES:
+            scope_id, limits = scope.get(kind), Settings.USAGE_BUDGETS.get(kind) or {}
+            if not scope_id or not limits:
+                continue
+            projected = self._projected(kind, scope_id)
+            for metric, limit in limits.items():
+                if limit is not None and projected.get(metric, 0) + extra.get(metric, 0) > limit:
+                    return f"{kind} budget for {metric} ({limit}) reached"
+        return None
+
+    def admit_render(
+        self, scope: Dict[str, Optional[str]], resolution: Tuple[int, int], tier: str, renders: int = 1
+    ) -> RenderReservation:
+        """
+        Reserve budget for one Bria call producing `renders` images (num_results).
+
+        When the requested tier would exceed a budget and BUDGET_EXCEEDED_ACTION
+        is "downgrade", a preview-resolution render is admitted instead.
+        """
+        with self._lock:
+            violation = self._violation(
+                scope, {"cost": Settings.BRIA_RENDER_COST[tier] * renders, "full_renders": renders if tier == "full" else 0}
+            )
+            downgraded = False
+            if violation and tier == "full" and Settings.BUDGET_EXCEEDED_ACTION == "downgrade":
+                if not self._violation(scope, {"cost": Settings.BRIA_RENDER_COST["preview"] * renders}):
+                    tier, resolution, downgraded = "preview", (Settings.PREVIEW_WIDTH, Settings.PREVIEW_HEIGHT), True
+                    violation = None
+            if violation:
+                raise BudgetExceeded(f"Render rejected: {violation}")
+
+            reservation = RenderReservation(next(self._ids), scope, tier, resolution, renders)
+            reservation.downgraded = downgraded
+            self._pending[reservation.reservation_id] = reservation
+            return reservation
+
+    def settle_render(self, reservation: RenderReservation, seconds: float, outcome: str = "ok"):
+        """Record the render Bria produced (or failed to) for this reservation"""
+        self.release(reservation)
+        width, height = reservation.resolution
+        self.record(UsageRecord(
+            "bria",
+            reservation.scope,
+            model="fibo",
+            tier=reservation.tier,
+            width=width,
+            height=height,
+            renders=reservation.renders if outcome == "ok" else 0,
+            seconds=seconds,
+            cost=reservation.cost if outcome == "ok" else 0.0,
+            outcome="downgraded" if reservation.downgraded and outcome == "ok" else outcome,
+        ))
+
+    def release(self, reservation: RenderReservation):
+        """Drop a reservation; cache hits and coalesced requests cost nothing"""
+        with self._lock:
+            self._pending.pop(reservation.reservation_id, None)
+
+    def admit_analysis(self, scope: Dict[str, Optional[str]]):
+        """Raise BudgetExceeded if a Gemini call is no longer allowed for this scope"""
+        with self._lock:
+            violation = self._violation(scope, {"gemini_tokens": 1})
+        if violation:
+            raise BudgetExceeded(f"Analysis rejected: {violation}")
+
+    # ----- reporting -----
+
+    def totals(self, kind: str, scope_id: Optional[str]) -> Dict[str, Any]:
+        with self._lock:
+            totals = self._totals.get((kind, scope_id)) or _Totals()
+            return totals.to_dict()
+
+    def summary(self, kind: str = "session") -> List[Dict[str, Any]]:
+        """Totals for every session, user or batch seen so far"""
+        with self._lock:
+            return [
+                {kind: scope_id, **totals.to_dict()}
+                for (scope_kind, scope_id), totals in self._totals.items()
+                if scope_kind == kind
+            ]
+
+    def records(self, kind: Optional[str] = None, scope_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Recorded calls, or only those of one session, user or batch"""
+        with self._lock:
+            if kind is None:
+                return [record.to_dict() for record in self._records]
+            return [record.to_dict() for record in self._records if getattr(record, f"{kind}_id") == scope_id]
+
+    def export_json(self, kind: Optional[str] = None, scope_id: Optional[str] = None) -> str:
+        """Records plus per-scope totals; limited to one scope's calls when `kind` is given"""
+        records = self.records(kind, scope_id)
+        summaries = {}
+        for summary_kind in SCOPES:
+            seen = {record[f"{summary_kind}_id"] for record in records}
+            summaries[summary_kind] = [
+                row for row in self.summary(summary_kind) if kind is None or row[summary_kind] in seen
+            ]
+        return json.dumps({"records": records, **summaries}, indent=2)
+
+    def export_csv(self, kind: Optional[str] = None, scope_id: Optional[str] = None) -> str:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=list(UsageRecord.FIELDS))
+        writer.writeheader()
+        writer.writerows(self.records(kind, scope_id))
+        return buffer.getvalue()
+
+
+_ledger: Optional[UsageLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger() -> UsageLedger:
+    """Process-wide ledger shared by every session"""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger(Settings.USAGE_LEDGER_MAX_RECORDS)
+        return _ledger
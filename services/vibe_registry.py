@@ -0,0 +1,336 @@
+"""
+File-backed registry of vibes, camera angles, consumption scenarios and
+subject keywords.
+
+The registry file (JSON, or TOML on Python 3.11+) has the same shape as the
+built-in literals in config/vibe_configs.py and config/consumption_data.py:
+
+    {
+      "vibes": {"<name>": {"emoji": "...", "description": "...", "payload": {...}}},
+      "camera_angles": [{"label": "...", "value": "...", "image_path": "..."}],
+      "scenarios": {"<category>": [{"id": "...", "label": "...", "prompt_modifier": "...", ...}]},
+      "keywords": {"<keyword>": "<category>"}
+    }
+
+It is validated and compiled once into a read-only Registry snapshot
+(scenario-by-id index, keyword matcher, prompt templates). A watcher thread
+reloads it when the file changes and swaps the snapshot in one assignment;
+an invalid file is reported and the previous snapshot stays live. Without a
+file the built-in literals are used.
+
+    python -m services.vibe_registry --export config/registry.json
+    python -m services.vibe_registry --check config/registry.json
+"""
+import argparse
+import copy
+import json
+import os
+import re
+import sys
+import threading
+import time
+from types import MappingProxyType
+from typing import Dict, Any, List, Mapping, Optional, Tuple
+
+from config.settings import Settings
+from config.vibe_configs import VIBE_CONFIGS, MARKETPLACE_CAMERA_ANGLES
+from config.consumption_data import CONSUMPTION_SCENARIOS, SUBJECT_TO_SCENARIO_MAP
+from services.prompt_compiler import PromptCompiler
+
+BUILTIN = "built-in"
+
+
+class RegistryError(ValueError):
+    """Raised when a registry file is unreadable or fails validation"""
+
+
+def _freeze(value):
+    """Deep read-only copy: dicts become mapping proxies, lists become tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def builtin_registry_data() -> Dict[str, Any]:
+    """The registry as defined by the Python literals shipped with the app"""
+    return copy.deepcopy({
+        "vibes": VIBE_CONFIGS,
+        "camera_angles": MARKETPLACE_CAMERA_ANGLES,
+        "scenarios": CONSUMPTION_SCENARIOS,
+        "keywords": SUBJECT_TO_SCENARIO_MAP,
+    })
+
+
+def _check_optional(problems: List[str], where: str, entry: Mapping, key: str, types, label: str):
+    if key in entry and not isinstance(entry[key], types):
+        problems.append(f"{where}.{key} must be {label}")
+
+
+def validate_registry(data: Any):
+    """Raise RegistryError listing every problem found in `data`"""
+    problems: List[str] = []
+    if not isinstance(data, dict):
+        raise RegistryError("registry must be an object")
+
+    vibes = data.get("vibes")
+    if not isinstance(vibes, dict) or not vibes:
+        problems.append("vibes must be a non-empty object")
+        vibes = {}
+    for name, vibe in vibes.items():
+        where = f"vibes[{name!r}]"
+        if not isinstance(vibe, dict):
+            problems.append(f"{where} must be an object")
+            continue
+        for key in ("emoji", "description"):
+            if not isinstance(vibe.get(key), str):
+                problems.append(f"{where}.{key} must be a string")
+        payload = vibe.get("payload")
+        if not isinstance(payload, dict):
+            problems.append(f"{where}.payload must be an object")
+            continue
+        for key in ("background_prompt", "atmosphere", "negative_prompt"):
+            _check_optional(problems, f"{where}.payload", payload, key, str, "a string")
+        lock = payload.get("structure_lock", 0.9)
+        if isinstance(lock, bool) or not isinstance(lock, (int, float)) or not 0 <= lock <= 1:
+            problems.append(f"{where}.payload.structure_lock must be a number between 0 and 1")
+
+    angles = data.get("camera_angles", [])
+    seen_values = set()
+    if not isinstance(angles, list):
+        problems.append("camera_angles must be a list")
+        angles = []
+    for index, angle in enumerate(angles):
+        where = f"camera_angles[{index}]"
+        if not isinstance(angle, dict) or not isinstance(angle.get("value"), str) or not angle.get("value"):
+            problems.append(f"{where} needs a non-empty string value")
+            continue
+        if angle["value"] in seen_values:
+            problems.append(f"{where}.value {angle['value']!r} is duplicated")
+        seen_values.add(angle["value"])
+        for key in ("label", "image_path"):
+            if not isinstance(angle.get(key), str):
+                problems.append(f"{where}.{key} must be a string")
+
+    scenarios = data.get("scenarios", {})
+    seen_ids = set()
+    if not isinstance(scenarios, dict):
+        problems.append("scenarios must be an object of category -> list")
+        scenarios = {}
+    for category, entries in scenarios.items():
+        if not isinstance(entries, list):
+            problems.append(f"scenarios[{category!r}] must be a list")
+            continue
+        for index, scenario in enumerate(entries):
+            where = f"scenarios[{category!r}][{index}]"
+            if not isinstance(scenario, dict):
+                problems.append(f"{where} must be an object")
+                continue
+            scenario_id = scenario.get("id")
+            if not isinstance(scenario_id, str) or not scenario_id:
+                problems.append(f"{where}.id must be a non-empty string")
+            elif scenario_id in seen_ids:
+                problems.append(f"{where}.id {scenario_id!r} is duplicated")
+            else:
+                seen_ids.add(scenario_id)
+            if not isinstance(scenario.get("label"), str):
+                problems.append(f"{where}.label must be a string")
+            for key in ("image_path", "prompt_modifier", "negative_prompt"):
+                _check_optional(problems, where, scenario, key, str, "a string")
+            _check_optional(problems, where, scenario, "guidance_scale", (int, float), "a number")
+
+    keywords = data.get("keywords", {})
+    if not isinstance(keywords, dict):
+        problems.append("keywords must be an object of keyword -> category")
+        keywords = {}
+    for keyword, category in keywords.items():
+        if not keyword.strip():
+            problems.append("keywords must not contain an empty keyword")
+        if not isinstance(category, str) or not category:
+            problems.append(f"keywords[{keyword!r}] must name a category")
+        # A category without scenarios of its own falls back to "default"
+
+    if problems:
+        raise RegistryError("; ".join(problems))
+
+
+class Registry:
+    """
+    One validated, compiled, read-only registry snapshot.
+
+    Readers grab the current snapshot once per request and use it
+    throughout, so a reload mid-request never mixes two versions.
+    """
+
+    def __init__(self, data: Dict[str, Any], source: str = BUILTIN, version: Optional[Tuple[int, int]] = None):
+        validate_registry(data)
+        self.source = source
+        self.version = version
+        self.loaded_at = time.time()
+        self.vibes: Mapping[str, Mapping[str, Any]] = _freeze(data["vibes"])
+        self.camera_angles: Tuple[Mapping[str, Any], ...] = _freeze(data.get("camera_angles", []))
+        self.scenarios: Mapping[str, Tuple[Mapping[str, Any], ...]] = _freeze(data.get("scenarios", {}))
+        self.keywords: Mapping[str, str] = _freeze(
+            {keyword.lower(): category for keyword, category in data.get("keywords", {}).items()}
+        )
+
+        self.scenario_by_id: Mapping[str, Mapping[str, Any]] = MappingProxyType({
+            scenario["id"]: scenario for entries in self.scenarios.values() for scenario in entries
+        })
+
+        # Keywords keep their file order as priority. The lookahead finds a keyword at
+        # every position, always the highest-priority one starting there, so the best
+        # priority among all hits is the first keyword (in file order) in the text.
+        self._keyword_rank = {keyword: rank for rank, keyword in enumerate(self.keywords)}
+        self._keyword_pattern = re.compile(
+            "(?=(" + "|".join(re.escape(keyword) for keyword in self.keywords) + "))"
+        ) if self.keywords else None
+
+        self.compiler = PromptCompiler(
+            self.vibes, self.scenarios, tuple(angle["value"] for angle in self.camera_angles)
+        )
+
+    def emoji(self, vibe_name: str, default: str = "✨") -> str:
+        return self.vibes.get(vibe_name, {}).get("emoji", default)
+
+    def match_category(self, description: str) -> str:
+        """Scenario category of the first keyword (in registry order) found in `description`"""
+        if self._keyword_pattern is None:
+            return "default"
+        hits = self._keyword_pattern.findall(description.lower())
+        if not hits:
+            return "default"
+        return self.keywords[min(hits, key=self._keyword_rank.__getitem__)]
+
+    def scenarios_for(self, category: str) -> Tuple[Mapping[str, Any], ...]:
+        return self.scenarios.get(category, self.scenarios.get("default", ()))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "source": self.source,
+            "loaded_at": self.loaded_at,
+            "vibes": len(self.vibes),
+            "scenarios": len(self.scenario_by_id),
+            "keywords": len(self.keywords),
+        }
+
+
+def _file_version(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_registry_file(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "rb") as f:
+            if path.endswith(".toml"):
+                import tomllib  # Python 3.11+
+
+                return tomllib.load(f)
+            return json.load(f)
+    except (OSError, ValueError, ImportError) as e:
+        raise RegistryError(f"cannot read {path}: {e}")
+
+
+def load_registry(path: Optional[str]) -> Registry:
+    """Registry compiled from `path`, or from the built-in literals when there is no file"""
+    version = _file_version(path) if path else None
+    if version is None:
+        return Registry(builtin_registry_data())
+    return Registry(read_registry_file(path), source=path, version=version)
+
+
+class RegistryWatcher:
+    """Holds the live snapshot and swaps in a new one whenever the file changes"""
+
+    def __init__(self, path: Optional[str], interval: float):
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._rejected: Optional[Tuple[int, int]] = None
+        try:
+            self.registry = load_registry(path)
+        except RegistryError as e:
+            print(f"Registry {path} is invalid, using built-in vibes: {e}")
+            self._rejected = _file_version(path)
+            self.registry = Registry(builtin_registry_data())
+        if path and interval > 0:
+            threading.Thread(target=self._run, name="registry-watcher", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.reload()
+
+    def reload(self, force: bool = False) -> bool:
+        """Swap in the file's current contents if they changed; True when swapped"""
+        with self._lock:
+            version = _file_version(self.path) if self.path else None
+            if not force and version in (self.registry.version, self._rejected):
+                return False
+            try:
+                registry = load_registry(self.path)
+            except RegistryError as e:
+                print(f"Registry reload rejected, keeping {self.registry.source}: {e}")
+                self._rejected = version
+                return False
+            self.registry = registry  # atomic swap; readers holding the old snapshot keep it
+            self._rejected = None
+            print(f"Registry reloaded from {registry.source}: {len(registry.vibes)} vibes")
+            return True
+
+
+_watcher: Optional[RegistryWatcher] = None
+_watcher_lock = threading.Lock()
+
+
+def _get_watcher() -> RegistryWatcher:
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = RegistryWatcher(Settings.REGISTRY_PATH, Settings.REGISTRY_RELOAD_INTERVAL)
+        return _watcher
+
+
+def get_registry() -> Registry:
+    """The live registry snapshot"""
+    watcher = _watcher
+    if watcher is None:
+        watcher = _get_watcher()
+    return watcher.registry
+
+
+def reload_registry(force: bool = False) -> bool:
+    """Reload now instead of waiting for the watcher; True when a new snapshot was swapped in"""
+    return _get_watcher().reload(force)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Export or validate the vibe/scenario registry")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--export", metavar="PATH", help="write the built-in registry as JSON to PATH")
+    group.add_argument("--check", metavar="PATH", help="validate a registry file")
+    args = parser.parse_args(argv)
+
+    if args.export:
+        with open(args.export, "w", encoding="utf-8") as f:
+            json.dump(builtin_registry_data(), f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"Wrote {args.export}")
+        return 0
+
+    try:
+        registry = Registry(read_registry_file(args.check), source=args.check)
+    except RegistryError as e:
+        print(f"INVALID: {e}")
+        return 1
+    print(f"OK: {registry.to_dict()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,17 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from config.settings import Settings
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_worker_pool() -> ThreadPoolExecutor:
+    """Process-wide pool that runs generation jobs off the Streamlit script threads"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=Settings.WORKER_POOL_SIZE, thread_name_prefix="generation")
+        return _pool
@@ -1,27 +1,14 @@
 import streamlit as st
 import json
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, Callable, List, Optional, Tuple
 from PIL import Image
 
 # Config imports
-from config.vibe_configs import VIBE_CONFIGS
-# Ensure config/consumption_data.py exists as per previous instructions
-try:
-    from config.consumption_data import CONSUMPTION_SCENARIOS, SUBJECT_TO_SCENARIO_MAP
-except ImportError:
-    # Fallback to prevent crash if file missing, though functionality will be limited
-    CONSUMPTION_SCENARIOS = {"default": []}
-    SUBJECT_TO_SCENARIO_MAP = {}
-
-# -----------------------------
-# Asset Definitions
-# -----------------------------
-MARKETPLACE_CAMERA_ANGLES = [
-    {"label": "Eye Level", "image_path": "assets/angles/eye_level.jpg", "value": "eye_level"},
-    {"label": "Low Angle", "image_path": "assets/angles/low_angle.jpg", "value": "low_angle"},
-    {"label": "High Angle", "image_path": "assets/angles/high_angle.jpg", "value": "high_angle"},
-    {"label": "Bird's Eye", "image_path": "assets/angles/birds_eye.jpg", "value": "birds_eye"},
-]
+from config.settings import Settings
+from services.analysis_model import ImageAnalysis
+from services.speculation import match_scenario_category
+from services.campaign_planner import CampaignSpec
+from services.vibe_registry import get_registry
 
 class UIComponents:
     """Reusable UI components for the application"""
@@ -41,7 +28,8 @@ class UIComponents:
         uploaded_file = st.file_uploader(
             "Choose a product image (PNG/JPG)",
             type=["png", "jpg", "jpeg"],
-            help="Upload a clear product image with transparent or simple background for best results"
+            help="Upload a clear product image with transparent or simple background for best results",
+            key="product_upload"
         )
 
         if uploaded_file is not None:
@@ -53,71 +41,157 @@ class UIComponents:
 
         return None
 
+    @staticmethod
+    def render_restored_upload(image: Image.Image, on_start_fresh: Callable[[], None]):
+        """Show the upload of a resumed session, with a way to start over"""
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col2:
+            st.info("♻️ Resumed your previous session: analysis and generated assets were restored.")
+            st.image(image, caption="📦 Source Asset (restored)", use_container_width=True)
+            if st.button("🆕 Start Fresh", use_container_width=True):
+                on_start_fresh()
+
+    @staticmethod
+    def seed_vibe_selection(selected_vibes: List[str], configurations: Dict[str, Any]):
+        """Pre-set the selection widgets from a resumed session (before they are rendered)"""
+        seeds = {}
+        for vibe_name in selected_vibes:
+            config = configurations.get(vibe_name) or {}
+            if vibe_name == "Marketplace Clean":
+                seeds["vibe_check_marketplace"] = True
+                if config.get("camera_angle"):
+                    seeds["selected_mp_angle"] = config["camera_angle"]
+            elif vibe_name == "Consumption/Active":
+                seeds["vibe_check_consumption"] = True
+                if config.get("scenario_id"):
+                    seeds["selected_consumption_scenario"] = config["scenario_id"]
+            else:
+                seeds[f"vibe_{vibe_name}"] = True
+            if config.get("variants"):
+                seeds[f"variants_{vibe_name}"] = config["variants"]
+        for key, value in seeds.items():
+            if key not in st.session_state:
+                st.session_state[key] = value
+
     @staticmethod
     def render_analysis_section(
             image: Image.Image,
-            analysis: Dict[str, Any],
+            analysis: Optional[ImageAnalysis],
             on_analyze_callback,
-            on_reanalyze_callback
+            on_reanalyze_callback,
+            similar_match: Optional[Tuple[Any, int]] = None,
+            on_reuse_callback=None
     ):
         """Render image analysis section with controls"""
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
             if analysis is None:
+                if similar_match and on_reuse_callback:
+                    entry, distance = similar_match
+                    st.info(f"♻️ A near-identical product was analyzed before ({distance}/64 bits differ).")
+                    if st.button("♻️ Reuse Previous Analysis", use_container_width=True):
+                        on_reuse_callback(entry, distance)
                 if st.button("🔍 Analyze Image with Gemini", use_container_width=True):
                     on_analyze_callback()
             else:
                 if st.button("🔄 Re-analyze Image", use_container_width=True):
                     on_reanalyze_callback()
 
-        if analysis:
+        if analysis is not None:
             UIComponents._render_analysis_display(analysis)
 
     @staticmethod
-    def _render_analysis_display(analysis: Dict[str, Any]):
+    def _render_analysis_display(analysis: ImageAnalysis):
         """Display analysis results"""
         with st.expander("🔬 View Gemini Image Analysis", expanded=False):
-            st.json(analysis)
+            st.json(analysis.to_dict())
 
             st.markdown("### 📊 Key Insights")
             col1, col2, col3 = st.columns(3)
 
             with col1:
-                st.metric("Scene Type", analysis.get("scene_type", "unknown"))
+                st.metric("Scene Type", analysis.scene_type or "unknown")
             with col2:
-                st.metric("Lighting", analysis.get("lighting", {}).get("type", "unknown"))
+                st.metric("Lighting", analysis.lighting.type or "unknown")
             with col3:
-                confidence = analysis.get('metadata_confidence', 0)
+                confidence = analysis.metadata_confidence or 0
                 st.metric("Confidence", f"{confidence:.0%}")
 
+            local_metrics = analysis.local_metrics
+            if local_metrics:
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("Brightness", f"{local_metrics['brightness']:.0%}")
+                with col2:
+                    st.metric("Contrast", f"{local_metrics['contrast']:.0%}")
+                with col3:
+                    st.metric("Background Uniformity", f"{local_metrics['background_uniformity']:.0%}")
+
             st.markdown("**Scene Description:**")
-            st.write(analysis.get("global_description", "N/A"))
+            st.write(analysis.global_description or "N/A")
+            if analysis.analysis_model:
+                escalated = " (escalated: the faster model was not confident)" if analysis.model_tier else ""
+                st.caption(f"🤖 Analyzed by {analysis.analysis_model}{escalated}")
 
     @staticmethod
-    def _get_consumption_scenarios(image_analysis: Dict[str, Any]) -> List[Dict[str, str]]:
+    def render_partial_analysis(placeholder, partial: ImageAnalysis):
+        """Show the analysis fields received so far, with the scenarios they already suggest"""
+        with placeholder.container():
+            st.caption("🔬 Analysis streaming in...")
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("Scene Type", partial.scene_type or "...")
+            with col2:
+                st.metric("Lighting", partial.lighting.type or "...")
+
+            description = partial.subjects[0].detailed_description if partial.subjects else None
+            if description:
+                st.markdown(f"**Subject:** {description}")
+                scenarios = UIComponents._get_consumption_scenarios(partial)
+                if scenarios:
+                    st.markdown("**Suggested scenarios:** " + ", ".join(s["label"] for s in scenarios))
+
+    @staticmethod
+    def _get_consumption_scenarios(image_analysis: Optional[ImageAnalysis]) -> List[Dict[str, str]]:
         """
         Determines which consumption scenarios to show based on Gemini analysis.
         """
-        if not image_analysis or "subjects" not in image_analysis:
-            return CONSUMPTION_SCENARIOS.get("default", [])
+        return list(get_registry().scenarios_for(match_scenario_category(image_analysis)))
 
-        product_desc = image_analysis["subjects"][0].get("detailed_description", "").lower()
-        
-        # Default to 'default' if no better match is found
-        scenario_category = "default"
+    @staticmethod
+    def render_analysis_mode_selector() -> str:
+        """Sidebar choice between full Gemini, hybrid and local-only analysis"""
+        labels = {
+            "hybrid": "⚖️ Hybrid (Gemini semantics + local colors)",
+            "gemini": "🤖 Full Gemini analysis",
+            "local_only": "⚡ Local only (known SKUs, no API call)",
+        }
+        return st.sidebar.selectbox(
+            "Analysis mode",
+            options=list(Settings.ANALYSIS_MODES),
+            index=list(Settings.ANALYSIS_MODES).index(Settings.ANALYSIS_MODE),
+            format_func=labels.get,
+            key="analysis_mode",
+        )
 
-        # Find the best matching scenario category
-        for keyword, category in SUBJECT_TO_SCENARIO_MAP.items():
-            if keyword in product_desc:
-                scenario_category = category
-                break  # Stop at first match
+    @staticmethod
+    def render_speculation_toggle() -> bool:
+        """Sidebar opt-in for speculative preview renders after analysis"""
+        return st.sidebar.toggle(
+            "⚡ Speculative pre-generation",
+            value=Settings.SPECULATIVE_GENERATION,
+            key="speculative_generation",
+            help=(
+                "Start low-resolution renders of the likeliest vibes right after analysis. "
+                f"Up to {Settings.SPECULATION_MAX_RENDERS_PER_SESSION} preview renders per session."
+            ),
+        )
 
-        return CONSUMPTION_SCENARIOS.get(scenario_category, CONSUMPTION_SCENARIOS.get("default", []))
     # -------------------------------------------------------
     # NEW: Unified Vibe & Config Renderer
     # -------------------------------------------------------
     @staticmethod
-    def render_vibe_selection_and_config(image_analysis: Dict[str, Any]) -> Tuple[List[str], Dict[str, Any]]:
+    def render_vibe_selection_and_config(image_analysis: Optional[ImageAnalysis]) -> Tuple[List[str], Dict[str, Any]]:
         """
         Unified render function that handles Vibe Selection AND their specific configurations.
         Returns: (selected_vibes_list, configuration_dict)
@@ -147,7 +221,7 @@ class UIComponents:
                         st.markdown("##### 🎥 Camera Angle")
                         # Use the Grid Selector
                         selected_angle = UIComponents._render_image_grid_selector(
-                            options=MARKETPLACE_CAMERA_ANGLES,
+                            options=list(get_registry().camera_angles),
                             key_prefix="mp_angle",
                             default_value="eye_level"
                         )
@@ -205,7 +279,7 @@ class UIComponents:
         
         # Filter vibes to be rendered in the generic loop
         other_vibes = {
-            name: data for name, data in VIBE_CONFIGS.items() 
+            name: data for name, data in get_registry().vibes.items() 
             if name not in manual_vibes
         }
 
@@ -223,6 +297,18 @@ class UIComponents:
                 # Simple card description
                 st.caption(vibe_data.get('description', ''))
 
+        # Several renders of a vibe come back from a single Bria call
+        if selected_vibes:
+            st.markdown("#### 🎲 Variants per Vibe")
+            cols = st.columns(min(len(selected_vibes), 4))
+            for idx, vibe_name in enumerate(selected_vibes):
+                with cols[idx % len(cols)]:
+                    count = st.number_input(
+                        vibe_name, min_value=1, max_value=Settings.MAX_VARIANTS, step=1, key=f"variants_{vibe_name}"
+                    )
+                if count > 1:
+                    configurations.setdefault(vibe_name, {})["variants"] = int(count)
+
         return selected_vibes, configurations
 
     @staticmethod
@@ -268,6 +354,43 @@ class UIComponents:
         
         return st.session_state.get(ss_key)
 
+    @staticmethod
+    def render_campaign_matrix(image_analysis: Optional[ImageAnalysis]) -> Optional[CampaignSpec]:
+        """Multi-select vibe x camera angle x scenario grid; None until a vibe is picked"""
+        with st.expander("🧮 Campaign Matrix (grid generation)", expanded=False):
+            st.caption("Every combination is rendered once; combinations that yield the same payload are merged.")
+            registry = get_registry()
+            vibes = st.multiselect("Vibes", options=list(registry.vibes), key="matrix_vibes")
+            angle_labels = {a["value"]: a["label"] for a in registry.camera_angles}
+            angles = st.multiselect(
+                "Camera angles", options=list(angle_labels), format_func=angle_labels.get, key="matrix_angles"
+            )
+            scenarios = UIComponents._get_consumption_scenarios(image_analysis) if image_analysis else []
+            scenario_labels = {s["id"]: s["label"] for s in scenarios}
+            scenario_ids = st.multiselect(
+                "Scenarios", options=list(scenario_labels), format_func=scenario_labels.get, key="matrix_scenarios"
+            )
+            previews = st.checkbox("Render previews first", value=True, key="matrix_previews")
+
+        if not vibes:
+            return None
+        return CampaignSpec(vibes, angles, scenario_ids, previews)
+
+    @staticmethod
+    def render_campaign_plan(plan: Dict[str, Any]):
+        """Render pre-launch estimates for a planned campaign"""
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Unique Renders", plan["unique_renders"], help=f"{plan['matrix_cells']} matrix cells")
+        with col2:
+            st.metric("Est. Time", f"{plan['estimated_seconds'] / 60:.1f} min")
+        with col3:
+            st.metric("Est. API Spend", f"${plan['estimated_cost']:.2f}")
+        if plan["collapsed"]:
+            st.caption(f"♻️ {plan['collapsed']} cells share a payload with another cell and are rendered once.")
+        with st.expander("📋 Job order", expanded=False):
+            st.json(plan["jobs"])
+
     @staticmethod
     def render_technical_details(selected_vibes: List[str], vibe_configs: Dict[str, Any] = None):
         """Render technical payload details for selected vibes"""
@@ -282,8 +405,9 @@ class UIComponents:
                 st.markdown(f"**{vibe_name}**")
                 
                 # Get base payload
-                if vibe_name in VIBE_CONFIGS:
-                    payload = VIBE_CONFIGS[vibe_name]["payload"].copy()
+                vibe = get_registry().vibes.get(vibe_name)
+                if vibe is not None:
+                    payload = vibe["payload"].copy()
                 else:
                     payload = {"note": "Dynamic generation payload"}
 
@@ -294,33 +418,136 @@ class UIComponents:
                 st.json(payload)
 
     @staticmethod
-    def render_generation_results(generated_images: Dict[str, Image.Image]):
-        """Render generated images with download buttons"""
+    def render_scheduler_metrics(metrics: Dict[str, Any]):
+        """Render outbound API queue depth and wait times"""
+        if not metrics:
+            return
+
+        with st.expander("🚦 API Queue Metrics", expanded=False):
+            for lane, data in metrics.items():
+                st.markdown(f"**{lane}**")
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("Interactive Queued", data["queue_depth"]["interactive"])
+                with col2:
+                    st.metric("Batch Queued", data["queue_depth"]["batch"])
+                with col3:
+                    st.metric("p95 Wait (interactive)", f"{data['wait_times']['interactive']['p95_s']:.2f}s")
+                st.json(data)
+
+    @staticmethod
+    def render_usage_summary(
+        session_totals: Dict[str, Any],
+        user_totals: Dict[str, Any],
+        export_csv: Callable[[], str],
+        export_json: Callable[[], str],
+    ):
+        """Render API spend for this session and user, with exports for capacity planning"""
+        with st.expander("💰 Usage & Budgets", expanded=False):
+            budget = Settings.USAGE_BUDGETS.get("session") or {}
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                limit = budget.get("cost")
+                st.metric("Session Spend", f"${session_totals['cost']:.3f}", help=f"Budget ${limit}" if limit else None)
+            with col2:
+                st.metric(
+                    "8K Renders",
+                    session_totals["full_renders"],
+                    delta=f"{session_totals['preview_renders']} previews",
+                    delta_color="off",
+                )
+            with col3:
+                st.metric("Gemini Tokens", f"{session_totals['gemini_tokens']:,}")
+            st.caption(
+                f"User total: ${user_totals['cost']:.3f} · {user_totals['calls']} calls · "
+                f"{user_totals['seconds']:.0f}s provider time"
+            )
+
+            # Passed as callables: an export is only built when its button is clicked
+            col1, col2 = st.columns(2)
+            with col1:
+                st.download_button(
+                    "⬇️ Export CSV", export_csv, file_name="usage.csv", mime="text/csv", use_container_width=True
+                )
+            with col2:
+                st.download_button(
+                    "⬇️ Export JSON", export_json, file_name="usage.json", mime="application/json",
+                    use_container_width=True,
+                )
+
+    @staticmethod
+    def render_generation_results(
+            generated_images: Dict[str, Any], on_select_variant: Optional[Callable[[str, int], None]] = None
+    ):
+        """Render generated images with download buttons, and a picker for vibes rendered as variants"""
         if not generated_images:
             return
 
         st.markdown("---")
         st.markdown("### 🖼️ Generated Marketing Assets")
 
-        cols = st.columns(len(generated_images))
+        # Campaign grids can hold many results; wrap into rows
+        cols = st.columns(min(len(generated_images), 4))
 
-        for idx, (vibe_name, image) in enumerate(generated_images.items()):
-            with cols[idx]:
+        for idx, (vibe_name, result) in enumerate(generated_images.items()):
+            with cols[idx % len(cols)]:
                 # Try to find emoji, default to sparkle
-                emoji = VIBE_CONFIGS.get(vibe_name, {}).get("emoji", "✨")
-                st.image(image, caption=f"{emoji} {vibe_name}", use_container_width=True)
-
-                from services.image_service import ImageService
-                img_bytes = ImageService.image_to_bytes(image)
-
+                emoji = get_registry().emoji(result.metadata.get("vibe_name", vibe_name))
+
+                # A thumbnail made when the result arrived; the full file stays on the CDN
+                UIComponents._render_preview(result, caption=f"{emoji} {vibe_name}")
+                if result.metadata.get("speculative"):
+                    st.caption("⚡ Promoted from a speculative preview render")
+                if result.metadata.get("budget_downgraded"):
+                    st.caption("💰 Rendered at preview resolution: usage budget reached")
+                if len(result.variants) > 1:
+                    UIComponents._render_variant_picker(vibe_name, result, on_select_variant)
+
+                if not result.is_fetched:
+                    if result.expired:
+                        st.caption("⌛ Link expired - regenerate to download.")
+                    elif st.button("📥 Prepare Full-Res Download", key=f"fetch_{vibe_name}", use_container_width=True):
+                        with st.spinner("Fetching full-resolution files..."):
+                            # All variants at once, so picking another one downloads instantly
+                            result.fetch_variants()
+                        st.rerun()
+                    continue
+
+                # Serve the provider's encoded bytes as-is: no decode, no PNG re-encode
+                asset = result.fetch()
                 st.download_button(
                     label="⬇️ Download",
-                    data=img_bytes,
-                    file_name=f"{vibe_name.replace(' ', '_').lower()}_asset.png",
-                    mime="image/png",
+                    data=asset.getvalue(),
+                    file_name=f"{vibe_name.replace(' · ', '_').replace(' ', '_').lower()}_asset.{asset.extension}",
+                    mime=asset.mime_type,
                     use_container_width=True
                 )
 
+    @staticmethod
+    def _render_preview(result, caption: Optional[str] = None):
+        preview = result.preview_source
+        if preview is None:
+            st.caption(f"🖼️ Preview unavailable{f' · {caption}' if caption else ''}")
+            return
+        st.image(preview, caption=caption, use_container_width=True)
+
+    @staticmethod
+    def _render_variant_picker(vibe_name: str, result, on_select_variant: Optional[Callable[[str, int], None]]):
+        """Thumbnails of every variant of a result; picking one makes it the shown and downloaded image"""
+        selected = result.variants.index(result)
+        cols = st.columns(len(result.variants))
+        for idx, variant in enumerate(result.variants):
+            with cols[idx]:
+                UIComponents._render_preview(variant)
+                if st.button(
+                    "⭐" if idx == selected else f"#{idx + 1}",
+                    key=f"variant_{vibe_name}_{idx}",
+                    disabled=idx == selected or on_select_variant is None,
+                    use_container_width=True,
+                ):
+                    on_select_variant(vibe_name, idx)
+                    st.rerun()
+
     @staticmethod
     def render_placeholder_content():
         """Render placeholder content when no image is uploaded"""
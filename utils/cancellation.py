@@ -0,0 +1,95 @@
+import threading
+import time
+from typing import Callable, List, Optional
+
+
+class CancelledError(Exception):
+    """Raised at a checkpoint once a cancellation token has been cancelled"""
+
+
+class DeadlineExceeded(CancelledError):
+    """Raised at a checkpoint once a token's deadline has passed"""
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation signal with an optional deadline.
+
+    Long-running work checks the token at its checkpoints (between polls,
+    between download chunks, while queued) and stops with CancelledError or
+    DeadlineExceeded. Child tokens are cancelled together with their parent
+    and never outlive its deadline. `is_set()`/`wait()` mirror threading.Event.
+    """
+
+    def __init__(self, timeout: Optional[float] = None, parent: Optional["CancellationToken"] = None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self.reason: Optional[str] = None
+
+        deadlines = [d for d in (
+            time.monotonic() + timeout if timeout is not None else None,
+            parent.deadline if parent is not None else None,
+        ) if d is not None]
+        self.deadline: Optional[float] = min(deadlines) if deadlines else None
+
+        if parent is not None:
+            parent.add_callback(lambda: self.cancel(parent.reason))
+
+    def child(self, timeout: Optional[float] = None) -> "CancellationToken":
+        return CancellationToken(timeout=timeout, parent=self)
+
+    def cancel(self, reason: Optional[str] = "cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        """Run `callback` on cancellation (immediately if already cancelled)"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the deadline, or None without one"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def clamp(self, timeout: float) -> float:
+        """Shorten a network timeout so it never runs past the deadline"""
+        remaining = self.remaining()
+        return timeout if remaining is None else max(0.1, min(timeout, remaining))
+
+    def is_set(self) -> bool:
+        return self.cancelled or self.expired
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Sleep up to `timeout` seconds, returning early (True) on cancel or deadline"""
+        remaining = self.remaining()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        self._event.wait(timeout)
+        return self.is_set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise CancelledError(self.reason or "cancelled")
+        if self.expired:
+            raise DeadlineExceeded("deadline exceeded")
+
@@ -0,0 +1,118 @@
+import json
+from typing import Any, List, Optional
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class IncrementalJSONParser:
+    """
+    Parses a JSON document while it is still arriving.
+
+    Text is fed in chunks as a streamed model reply comes in. After each
+    chunk, `feed` returns the document as far as it is complete: every value
+    that has fully arrived, with the open objects and arrays closed. Strings,
+    numbers and literals that are still being written are left out, so a
+    partial result never contains a truncated value. Markdown code fences
+    around the JSON are ignored.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._started = False
+        self._stack: List[List[str]] = []  # [opening bracket, what comes next]
+        self._in_string = False
+        self._escaped = False
+        self._string_is_key = False
+        self._in_scalar = False
+        self._cut = 0  # end of the complete prefix
+        self._cut_closers = ""  # brackets that close the prefix ending at _cut
+        self._start = 0
+        self._done = False
+        self._published = 0
+
+    def feed(self, chunk: str) -> Optional[Any]:
+        """Add `chunk`; returns the new partial document when more of it is complete, else None"""
+        self.text += chunk
+        self._scan()
+        if self._cut <= self._published:
+            return None
+        try:
+            partial = json.loads(self.text[self._start:self._cut] + self._cut_closers)
+        except ValueError:
+            return None
+        self._published = self._cut
+        return partial
+
+    def result(self) -> Any:
+        """The complete document; raises ValueError when the text is not valid JSON"""
+        self._scan()
+        if not self._started:
+            raise ValueError("no JSON document in the text")
+        # raw_decode stops at the end of the document, before any closing code fence
+        return json.JSONDecoder().raw_decode(self.text, self._start)[0]
+
+    def _complete_value(self, end: int):
+        """A value ended just before `end`"""
+        if not self._stack:
+            self._done = True
+            self._mark(end)
+            return
+        self._stack[-1][1] = "comma"
+        self._mark(end)
+
+    def _mark(self, end: int):
+        self._cut = end
+        self._cut_closers = "".join(_CLOSERS[opening] for opening, _ in reversed(self._stack))
+
+    def _scan(self):
+        text = self.text
+        while self._pos < len(text) and not self._done:
+            char = text[self._pos]
+
+            if not self._started:
+                if char in "{[":
+                    self._started = True
+                    self._start = self._pos
+                else:
+                    self._pos += 1  # code fence or other preamble
+                    continue
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._string_is_key:
+                        self._stack[-1][1] = "colon"
+                    else:
+                        self._complete_value(self._pos + 1)
+                self._pos += 1
+                continue
+
+            if self._in_scalar:
+                if char not in ",]} \t\r\n":
+                    self._pos += 1
+                    continue
+                # A number or literal only counts once something follows it
+                self._in_scalar = False
+                self._complete_value(self._pos)
+
+            if char in "{[":
+                self._stack.append([char, "key" if char == "{" else "value"])
+                self._mark(self._pos + 1)
+            elif char in "}]":
+                self._stack.pop()
+                self._complete_value(self._pos + 1)
+            elif char == '"':
+                self._in_string = True
+                self._string_is_key = bool(self._stack) and self._stack[-1][1] == "key"
+            elif char == ":":
+                self._stack[-1][1] = "value"
+            elif char == ",":
+                self._stack[-1][1] = "key" if self._stack[-1][0] == "{" else "value"
+            elif not char.isspace():
+                self._in_scalar = True
+            self._pos += 1
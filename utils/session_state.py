@@ -1,8 +1,32 @@
 
+import uuid
+import weakref
 import streamlit as st
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from PIL import Image
 
+from config.settings import Settings
+from services.analysis_model import ImageAnalysis
+from services.assets import RemoteResult
+from services.image_service import ImageService
+from services.phash_index import PerceptualEntry, dhash, get_phash_index, phash
+from services.session_store import SessionSnapshot, SessionStore
+from services.speculation import SpeculativeSession
+from utils.cancellation import CancellationToken
+
+
+class _GenerationGuard:
+    """
+    Lives only in session state and owns the running campaign's token.
+
+    Worker threads hold the token, never the guard, so when Streamlit drops a
+    closed session the guard is collected and its finalizer cancels the work.
+    """
+
+    def __init__(self, token: CancellationToken):
+        self.token = token
+        weakref.finalize(self, token.cancel, "session closed")
+
 
 class SessionState:
     """Manages Streamlit session state"""
@@ -21,11 +45,176 @@ class SessionState:
         
         if "image_analysis" not in st.session_state:
             st.session_state.image_analysis = None
+
+        if "session_id" not in st.session_state:
+            SessionState._resume_or_start()
+
+        if "speculation" not in st.session_state:
+            st.session_state.speculation = SpeculativeSession()
+
+        if "user_id" not in st.session_state:
+            # No login: attribute usage to ?user=<id> when given
+            st.session_state.user_id = st.query_params.get("user", "anonymous")
+    
+    @staticmethod
+    def _resume_or_start():
+        """Adopt the ?session= token from the URL, restoring its snapshot, or mint a new one"""
+        token = st.query_params.get("session")
+        if not SessionStore.valid_token(token):
+            token = uuid.uuid4().hex
+            st.query_params["session"] = token
+        st.session_state.session_id = token
+
+        snapshot = SessionStore.load(token) if Settings.SESSION_SNAPSHOTS else None
+        if snapshot is None:
+            return
+        # Handles and JSON only: images and assets come back lazily from the shared cache
+        st.session_state.image_analysis = snapshot.analysis
+        st.session_state.generated_images = snapshot.generated_images()
+        st.session_state.restored_upload_digest = snapshot.upload_digest
+        st.session_state.snapshot_upload_digest = snapshot.upload_digest
+        st.session_state.restored_selection = (snapshot.selected_vibes, snapshot.vibe_configs)
+        st.session_state.snapshot_bytes = snapshot.to_bytes()
+
+    @staticmethod
+    def persist():
+        """Save the session snapshot if anything in it changed"""
+        if not Settings.SESSION_SNAPSHOTS:
+            return
+        snapshot = SessionSnapshot(
+            upload_digest=st.session_state.get("snapshot_upload_digest"),
+            analysis=st.session_state.get("image_analysis"),
+            selected_vibes=st.session_state.get("snapshot_selected_vibes"),
+            vibe_configs=st.session_state.get("snapshot_vibe_configs"),
+        )
+        for label, result in st.session_state.get("generated_images", {}).items():
+            handle = SessionSnapshot.result_handle(result)
+            if handle is not None:
+                snapshot.results[label] = handle
+
+        data = snapshot.to_bytes()
+        if data != st.session_state.get("snapshot_bytes"):
+            SessionStore.save(st.session_state.session_id, data)
+            st.session_state.snapshot_bytes = data
+
+    @staticmethod
+    def get_restored_upload() -> Optional[Image.Image]:
+        """The upload of a resumed session, until the user uploads another image"""
+        digest = st.session_state.get("restored_upload_digest")
+        if not digest:
+            return None
+        image = st.session_state.get("uploaded_image")
+        if image is None:
+            image = SessionStore.load_upload(digest)
+            if image is None:
+                st.session_state.restored_upload_digest = None  # expired from the cache
+        return image
+
+    @staticmethod
+    def take_restored_selection() -> Optional[Tuple[List[str], Dict[str, Any]]]:
+        """(selected vibes, configs) of a resumed session, handed out once to seed the widgets"""
+        return st.session_state.pop("restored_selection", None)
+
+    @staticmethod
+    def set_selection(selected_vibes: List[str], vibe_configs: Dict[str, Any]):
+        """Record the current vibe selection in the snapshot"""
+        st.session_state.snapshot_selected_vibes = list(selected_vibes)
+        st.session_state.snapshot_vibe_configs = dict(vibe_configs)
+        SessionState.persist()
+
+    @staticmethod
+    def start_fresh():
+        """Forget the resumed session and start a new one with a new token"""
+        SessionState.cancel_generation("started a new session")
+        SessionStore.delete(st.session_state.session_id)
+        for key in list(st.session_state.keys()):
+            del st.session_state[key]
+        st.query_params.clear()
+
+    @staticmethod
+    def get_session_id() -> str:
+        """Get the stable id used for per-session fair queuing of API calls"""
+        return st.session_state.session_id
     
     @staticmethod
-    def set_uploaded_image(image: Optional[Image.Image]):
+    def get_user_id() -> str:
+        """Get the id usage is accounted to across sessions"""
+        return st.session_state.user_id
+
+    @staticmethod
+    def start_generation() -> CancellationToken:
+        """Cancel any campaign still running for this session and return a token for a new one"""
+        guard = st.session_state.get("generation_guard")
+        if guard is not None:
+            guard.token.cancel("superseded by a new campaign")
+        token = CancellationToken()
+        st.session_state.generation_guard = _GenerationGuard(token)
+        return token
+
+    @staticmethod
+    def cancel_generation(reason: str = "cancelled"):
+        """Cancel in-flight generations (campaign and speculative) for this session"""
+        guard = st.session_state.get("generation_guard")
+        if guard is not None:
+            guard.token.cancel(reason)
+            st.session_state.generation_guard = None
+        if "speculation" in st.session_state:
+            st.session_state.speculation.cancel_all()
+
+    @staticmethod
+    def get_upload_digest(image: Optional[Image.Image]) -> Optional[str]:
+        """Digest of the current upload, hashed once per uploaded file rather than on every rerun"""
+        if image is None:
+            return None
+        uploaded_file = st.session_state.get("product_upload")
+        if uploaded_file is None:
+            # A resumed session's image was loaded by its digest
+            return st.session_state.get("restored_upload_digest") or ImageService.image_digest(image)
+        cached = st.session_state.get("upload_digest_cache")
+        if cached is not None and cached[0] == uploaded_file.file_id:
+            return cached[1]
+        digest = ImageService.image_digest(image)
+        st.session_state.upload_digest_cache = (uploaded_file.file_id, digest)
+        return digest
+
+    @staticmethod
+    def get_similar_match(image: Image.Image, digest: str) -> Optional[Tuple[PerceptualEntry, int]]:
+        """Closest previously analyzed upload; the upload's hashes are computed once per digest"""
+        cached = st.session_state.get("upload_hashes")
+        if cached is None or cached[0] != digest:
+            cached = (digest, phash(image), dhash(image))
+            st.session_state.upload_hashes = cached
+        # The index keeps growing while the session waits, so only the hashes are cached
+        return get_phash_index().nearest_hash(cached[1], cached[2], Settings.PHASH_MAX_DISTANCE)
+
+    @staticmethod
+    def track_upload(digest: Optional[str]):
+        """Cancel in-flight work when the uploaded image changes"""
+        previous = st.session_state.get("upload_digest")
+        if previous is not None and previous != digest:
+            SessionState.cancel_generation("uploaded image changed")
+        if digest is not None and digest != st.session_state.get("restored_upload_digest"):
+            st.session_state.restored_upload_digest = None  # a new upload replaces the resumed one
+        st.session_state.upload_digest = digest
+
+    @staticmethod
+    def get_speculation() -> SpeculativeSession:
+        """Get this session's speculative pre-generation state"""
+        return st.session_state.speculation
+
+    @staticmethod
+    def set_uploaded_image(image: Optional[Image.Image], digest: Optional[str] = None):
         """Set the uploaded image in session state"""
         st.session_state.uploaded_image = image
+        if image is None or not digest or digest == st.session_state.get("snapshot_upload_digest"):
+            return
+        try:
+            # The same cached PNG Bria uploads, so a resumed session can reopen it
+            ImageService.encode_image(image, "PNG", digest)
+            st.session_state.snapshot_upload_digest = digest
+        except Exception as e:
+            print(f"Upload not kept for resume: {e}")
+        SessionState.persist()
     
     @staticmethod
     def get_uploaded_image() -> Optional[Image.Image]:
@@ -33,22 +222,43 @@ class SessionState:
         return st.session_state.uploaded_image
     
     @staticmethod
-    def set_image_analysis(analysis: Optional[Dict[str, Any]]):
+    def set_image_analysis(analysis: Optional[ImageAnalysis]):
         """Set image analysis results"""
         st.session_state.image_analysis = analysis
+        st.session_state.partial_analysis = None
+        SessionState.persist()
+
+    @staticmethod
+    def set_partial_analysis(partial: Optional[ImageAnalysis]):
+        """Publish the fields of an analysis that is still streaming in (not persisted)"""
+        st.session_state.partial_analysis = partial
+
+    @staticmethod
+    def get_partial_analysis() -> Optional[ImageAnalysis]:
+        """Fields received so far of an analysis in progress"""
+        return st.session_state.get("partial_analysis")
     
     @staticmethod
-    def get_image_analysis() -> Optional[Dict[str, Any]]:
+    def get_image_analysis() -> Optional[ImageAnalysis]:
         """Get image analysis results"""
         return st.session_state.image_analysis
     
     @staticmethod
-    def add_generated_image(vibe_name: str, image: Image.Image):
-        """Add a generated image to session state"""
-        st.session_state.generated_images[vibe_name] = image
+    def add_generated_image(vibe_name: str, result: RemoteResult):
+        """Add a generated image handle to session state"""
+        st.session_state.generated_images[vibe_name] = result
+        SessionState.persist()
     
     @staticmethod
-    def get_generated_images() -> Dict[str, Image.Image]:
+    def select_variant(vibe_name: str, index: int):
+        """Make another render of the same variant set the result shown and downloaded for `vibe_name`"""
+        current = st.session_state.generated_images.get(vibe_name)
+        if current is not None and 0 <= index < len(current.variants):
+            st.session_state.generated_images[vibe_name] = current.variants[index]
+            SessionState.persist()
+
+    @staticmethod
+    def get_generated_images() -> Dict[str, RemoteResult]:
         """Get all generated images"""
         return st.session_state.generated_images
     
@@ -56,3 +266,4 @@ class SessionState:
     def clear_generated_images():
         """Clear all generated images"""
         st.session_state.generated_images = {}
+        SessionState.persist()